@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Bogons: Recognize addresses that can not be reached on the public Internet, such as private, loopback, link-local, multicast and documentation addresses.
+
+DNS answers sometimes contain such addresses. Testing them with ``ecn_spider.py`` only burns connection attempts and timeouts (link-local IPv6 addresses even fail with "Invalid argument"), so ``resolution.py`` and ``ecn_spider.py`` can flag or drop them.
+
+The prefixes are compiled into one multibit trie per address family, with a stride of 8 bits: an address is looked up one byte at a time, in at most 4 steps for IPv4 and 16 steps for IPv6. Prefixes whose length is not a multiple of 8 are expanded to all the byte values they cover, so every step is a single list index. When prefixes overlap, the longest one matches.
+
+This file is part of ECN-Spider.
+'''
+
+import socket
+
+#: Built-in list of bogon prefixes, as tuples (prefix, description), following RFC 6890 and the IANA special-purpose address registries.
+BUILTIN_BOGONS = [
+	('0.0.0.0/8', 'this network'),
+	('10.0.0.0/8', 'private'),
+	('100.64.0.0/10', 'shared address space'),
+	('127.0.0.0/8', 'loopback'),
+	('169.254.0.0/16', 'link-local'),
+	('172.16.0.0/12', 'private'),
+	('192.0.0.0/24', 'IETF protocol assignments'),
+	('192.0.2.0/24', 'documentation'),
+	('192.168.0.0/16', 'private'),
+	('198.18.0.0/15', 'benchmarking'),
+	('198.51.100.0/24', 'documentation'),
+	('203.0.113.0/24', 'documentation'),
+	('224.0.0.0/4', 'multicast'),
+	('240.0.0.0/4', 'reserved'),
+	('::/3', 'not global unicast'),
+	('::/128', 'unspecified'),
+	('::1/128', 'loopback'),
+	('::ffff:0:0/96', 'IPv4-mapped'),
+	('4000::/2', 'not global unicast'),
+	('8000::/1', 'not global unicast'),
+	('2001:2::/48', 'benchmarking'),
+	('2001:10::/28', 'ORCHID'),
+	('2001:db8::/32', 'documentation'),
+	('3ffe::/16', '6bone'),
+	('fc00::/7', 'unique local'),
+	('fe80::/10', 'link-local'),
+	('fec0::/10', 'site-local'),
+	('ff00::/8', 'multicast'),
+]
+
+
+class PrefixTrie:
+	'''
+	A multibit trie with a stride of 8 bits, mapping address prefixes to labels by longest-prefix match.
+	'''
+	def __init__(self, width):
+		'''
+		:param int width: Length of the addresses in bytes, 4 for IPv4 and 16 for IPv6.
+		'''
+		self.width = width
+		# Node n occupies the slots n * 256 to n * 256 + 255 of each list. A slot holds the offset of the child node's slots, or -1, the label index of the longest prefix ending at that slot, or 0, and that prefix's length.
+		self._children = [-1] * 256
+		self._labels = [0] * 256
+		self._lengths = [-1] * 256
+		self._names = [None]
+	
+	def insert(self, network, length, label):
+		'''
+		Add a prefix.
+		
+		:param bytes network: The network address.
+		:param int length: The prefix length in bits.
+		:param label: The value returned by :meth:`lookup` for addresses in the prefix.
+		'''
+		if not 0 <= length <= 8 * self.width:
+			raise ValueError('Invalid prefix length: {}.'.format(length))
+		self._names.append(label)
+		index = len(self._names) - 1
+		
+		base = 0
+		if length == 0:
+			last, span = 0, 256
+		else:
+			# The prefix ends in byte number ``last``, and covers ``span`` values of that byte.
+			last = (length - 1) // 8
+			span = 1 << (8 * (last + 1) - length)
+		for level in range(last):
+			i = base + network[level]
+			if self._children[i] < 0:
+				self._children[i] = len(self._children)
+				self._children.extend([-1] * 256)
+				self._labels.extend([0] * 256)
+				self._lengths.extend([-1] * 256)
+			base = self._children[i]
+		first = network[last] & ~(span - 1) & 0xFF if length > 0 else 0
+		for i in range(base + first, base + first + span):
+			if self._lengths[i] <= length:
+				self._labels[i] = index
+				self._lengths[i] = length
+	
+	def lookup(self, address):
+		'''
+		Find the longest prefix containing an address.
+		
+		:param bytes address: The packed address.
+		:returns: The label of the prefix, or None if no prefix contains the address.
+		'''
+		children = self._children
+		labels = self._labels
+		base = 0
+		best = 0
+		for b in address:
+			i = base + b
+			if labels[i]:
+				best = labels[i]
+			base = children[i]
+			if base < 0:
+				break
+		return self._names[best]
+
+
+class BogonFilter:
+	'''
+	Classify IPv4 and IPv6 addresses by a list of bogon prefixes.
+	'''
+	def __init__(self, prefixes=BUILTIN_BOGONS):
+		'''
+		:param prefixes: An iterable of tuples (prefix, description), where the prefix is a string such as "10.0.0.0/8".
+		'''
+		self._v4 = PrefixTrie(4)
+		self._v6 = PrefixTrie(16)
+		self.count = 0
+		for prefix, description in prefixes:
+			self.add(prefix, description)
+	
+	def add(self, prefix, description=''):
+		'''
+		Add a prefix.
+		
+		:param str prefix: The prefix, such as "10.0.0.0/8" or "fe80::/10". A single address is a prefix of full length.
+		:param str description: The label returned by :meth:`match` for addresses in the prefix. Defaults to the prefix itself.
+		:raises: ValueError if ``prefix`` is malformed.
+		'''
+		address, _, length = prefix.strip().partition('/')
+		v6 = ':' in address
+		try:
+			network = socket.inet_pton(socket.AF_INET6 if v6 else socket.AF_INET, address)
+			length = int(length) if length else 8 * len(network)
+		except (OSError, ValueError):
+			raise ValueError('Not a valid prefix: {}.'.format(prefix))
+		(self._v6 if v6 else self._v4).insert(network, length, description or prefix.strip())
+		self.count += 1
+	
+	def load(self, file_name):
+		'''
+		Add the prefixes from a file. Each line holds one prefix, optionally followed by whitespace and a description. Empty lines and lines starting with "#" are ignored.
+		'''
+		with open(file_name) as f:
+			for n, line in enumerate(f, 1):
+				line = line.strip()
+				if line == '' or line.startswith('#'):
+					continue
+				fields = line.split(None, 1)
+				try:
+					self.add(fields[0], fields[1] if len(fields) > 1 else '')
+				except ValueError as e:
+					raise ValueError('{}, line {}: {}'.format(file_name, n, e))
+	
+	def match(self, ip):
+		'''
+		Check whether an address is a bogon.
+		
+		:param str ip: An IPv4 or IPv6 address. IPv6 addresses may be enclosed in square brackets.
+		:returns: The description of the longest matching prefix, "invalid address" if ``ip`` can not be parsed, or None if the address is not a bogon.
+		'''
+		try:
+			if ':' in ip:
+				if ip[:1] == '[':
+					ip = ip[1:-1]
+				return self._v6.lookup(socket.inet_pton(socket.AF_INET6, ip))
+			return self._v4.lookup(socket.inet_pton(socket.AF_INET, ip))
+		except OSError:
+			return 'invalid address'
+
+
+def load(file_names=(), builtin=True):
+	'''
+	Create a :class:`BogonFilter`.
+	
+	:param file_names: Files with further prefixes, in the format read by :meth:`BogonFilter.load`.
+	:param bool builtin: Whether to start with the prefixes of :data:`BUILTIN_BOGONS`.
+	'''
+	f = BogonFilter(BUILTIN_BOGONS if builtin else ())
+	for name in file_names:
+		f.load(name)
+	return f
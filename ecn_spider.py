@@ -28,6 +28,8 @@ from collections import namedtuple
 import csv
 #import errno
 import logging
+import logging.handlers
+import itertools
 import threading
 import queue
 from time import sleep
@@ -36,9 +38,26 @@ import time
 import argparse
 import datetime
 import socket
+import struct
 import bisect
+import json
+import os
+import errno
+import gzip
+import shutil
+import getpass
+import resource
+import selectors
+import signal
+import socketserver
+import concurrent.futures
+from collections import deque
 from math import floor
 
+import metrics
+import unique
+import bogons
+
 E = {
 	'timeout': 'socket.timeout',
 	'refused': 'Connection refused',
@@ -46,20 +65,38 @@ E = {
 	'invalid': 'Invalid argument',
 	'perm': 'Permission denied',
 	'unreach': 'Network is unreachable',
+	'local': 'local.error',
 	'success': 'success'}  #: Error strings used by ecn_spider
 
+LOCAL_ERRNOS = frozenset([errno.EADDRINUSE, errno.EADDRNOTAVAIL, errno.EMFILE, errno.ENFILE])  #: Errors of binding and connecting that are caused by the local host, e.g. by running out of ports or file descriptors, and say nothing about the target. They are recorded as E['local'].
+LOCAL_ATTEMPTS = 3  #: Number of sockets a connect is tried with before it fails with E['local']
+
 NO_RETRY = frozenset([None, E['invalid'], E['perm']])
 DLOGGER = None  #: DataLogger instance shared between all threads
 RETRY_LOGGER = None  #: DataLogger instance shared for writing the retry data file
+TRIAGE_LOGGER = None  #: DataLogger instance for writing the --triage-file, or None
+SOURCES = None  #: SourcePool the sockets of outgoing connections are bound with, or None to leave binding to the kernel
+MODE_SOURCES = {}  #: SourcePool by connection mode ('eoff' or 'eon'), for the connections of modes with their own port range
+REQUEST_POOL = None  #: concurrent.futures.ThreadPoolExecutor making the HTTP requests with --request-mode immediate
+REQUEST_SLOTS = None  #: threading.BoundedSemaphore with one token per job whose requests may be under way at once with --request-mode immediate, see :meth:`request_slots`
+OFF_TASKS = queue.Queue()  #: Functions that the master thread runs at the start of a round, while ECN is off and the workers wait
+WAKE = threading.Event()  #: Set when jobs or OFF_TASKS are queued, or the run ends, to wake up a parked master, see :meth:`master`
 USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64; rv:28.0) Gecko/20100101 Firefox/28.0'  #: User agent string used for HTTP requests
 RUN = False  #: Signal end to master and worker threads
 VERBOSITY = 100  #: Print message about processing speed every VERBOSITY jobs.
 Q_SIZE = 100  #: Maximum job queue size
+SLOT_WAIT = 0.1  #: Time in seconds a worker waits for a token of REQUEST_SLOTS before it sits a round out
 PER = None
 count = None  #: Shared counter instance to keep track of completed jobs.
 retry_count = None  #: Shared counter instance for keeping track of number of jobs to be retried.
 ARGS = None  #: argparse configuration
 START_TIME = None  #: Start time. Used to calculate runtime.
+TRACER = None  #: PhaseTracer instance shared between all threads
+LOG_LISTENER = None  #: QueueListener that runs the logging handlers
+METRICS_SERVER = None  #: HTTP server of the metrics endpoint, or None
+CAPTURE = None  #: CaptureManager running tcpdump with --capture, or None
+DEBUG_SAMPLE = 1  #: Only log every DEBUG_SAMPLE-th debug message from the critical path. 0 disables them.
+_HOT_DEBUG_COUNT = itertools.count()  #: Shared counter of debug messages from the critical path. next() on it is atomic.
 
 ECN_STATE = {
 	'never': 0,
@@ -67,8 +104,24 @@ ECN_STATE = {
 	'on_demand': 2
 }  #: Mapping of human-readable strings to values used for /proc/net/ipv4/tcp_ecn .
 
+M_JOBS = metrics.Counter('ecnspider_jobs_total', 'Number of completed jobs.')
+M_CONN_ERRORS = metrics.Counter('ecnspider_connect_results_total', 'Outcomes of connection attempts by ECN mode and error class.', ('mode', 'error'))
+M_HTTP_ERRORS = metrics.Counter('ecnspider_request_results_total', 'Outcomes of HTTP requests by ECN mode and error class.', ('mode', 'error'))
+M_CONN_TIME = metrics.Histogram('ecnspider_connect_seconds', 'Connection setup latency.', ('mode', ))
+M_REQ_TIME = metrics.Histogram('ecnspider_request_seconds', 'HTTP request latency.', ('mode', ))
+M_FLIPS = metrics.Counter('ecnspider_ecn_flips_total', 'Number of changes of the kernel\'s ECN setting.', ('state', ))
+M_BARRIER = metrics.Histogram('ecnspider_barrier_wait_seconds', 'Time spent waiting for the other threads at a synchronization point.', ('barrier', ))
+M_SYSCTL = metrics.Histogram('ecnspider_sysctl_seconds', 'Latency of changing the kernel\'s ECN setting.', ('state', ))
+M_RETRIES = metrics.Counter('ecnspider_retries_total', 'Number of jobs scheduled for a retry.')
+M_BOGONS = metrics.Counter('ecnspider_bogons_total', 'Number of bogon addresses in the input, by prefix description.', ('prefix', ))
+M_TRIAGE = metrics.Counter('ecnspider_triage_results_total', 'Outcomes of the connects of the --triage sweep by stage and error class.', ('stage', 'error'))
+M_TRIAGE_RTT = metrics.Histogram('ecnspider_triage_rtt_seconds', 'Connection setup latency measured by the --triage sweep.')
+
 Record = namedtuple('Record', ['rank', 'domain', 'ipv4', 'ipv6'])  #: Type used to parse the input CSV file into
-Job = namedtuple('Job', ['rank', 'domain', 'ip'])  #: Type of elements in job queue
+Job = namedtuple('Job', ['rank', 'domain', 'ip', 'sink'], defaults=(None, ))  #: Type of elements in job queue. ``sink`` is None, or a function that is also called with the output record of the job.
+
+#: Names of the fields of an output record, in the order they are written.
+OUTPUT_FIELDS = ['record_time', 'rank', 'domain', 'ip', 'eoff_err', 'port_eoff', 'eon_err', 'port_eon', 'pre_conn_eoff_time', 'post_conn_eoff_time', 'pre_conn_eon_time', 'post_conn_eon_time', 'pre_req_time', 'inter_req_time', 'post_req_time', 'http_err_eoff', 'status_eoff', 'headers_eoff', 'http_err_eon', 'status_eon', 'headers_eon']
 
 
 class SharedCounter:
@@ -186,6 +239,186 @@ class SemaphoreN(threading.BoundedSemaphore):
 			pass
 
 
+class SourcePool:
+	'''
+	Local addresses and ports to bind the sockets of outgoing connections to, handed out round-robin.
+	
+	Every connection closed by us stays in TIME_WAIT for a minute, and blocks its (local address, local port, remote address, remote port) tuple. Spreading the connections over several local addresses and a wide port range keeps enough tuples free at high connection rates, so that connects do not fail locally with errors that look like failures of the target.
+	'''
+	def __init__(self, addresses=(), ports=None):
+		'''
+		:param addresses: A list of local IPv4 and IPv6 addresses. For a family without addresses, the kernel picks the local address.
+		:param ports: A tuple (first, last) of the local port range, or None to let the kernel pick the ports.
+		'''
+		self._addresses = {socket.AF_INET: [], socket.AF_INET6: []}
+		for a in addresses:
+			self._addresses[socket.AF_INET6 if ':' in a else socket.AF_INET].append(a)
+		self._ports = ports
+		self._next_address = itertools.count()  # next() on it is atomic.
+		self._next_port = itertools.count()
+	
+	def bind(self, sock, family):
+		'''
+		Bind a socket to the next local address and port.
+		
+		:param sock: The unconnected socket.
+		:param family: The address family of ``sock``.
+		:raises: OSError if no port of the range is free.
+		'''
+		addresses = self._addresses[family]
+		if len(addresses) == 0 and self._ports is None:
+			return
+		address = addresses[next(self._next_address) % len(addresses)] if addresses else ('::' if family == socket.AF_INET6 else '0.0.0.0')
+		
+		if self._ports is None:
+			# Leave the choice of the port to connect(), where the kernel can reuse a port for different destinations.
+			try:
+				sock.setsockopt(socket.IPPROTO_IP, getattr(socket, 'IP_BIND_ADDRESS_NO_PORT', 24), 1)
+			except OSError:
+				pass
+			sock.bind((address, 0))
+			return
+		
+		first, last = self._ports
+		n = last - first + 1
+		# Ports of our own connections in TIME_WAIT can be bound again, the kernel only refuses a connect that would reuse a whole tuple.
+		sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		for _ in range(n):
+			port = first + next(self._next_port) % n
+			try:
+				sock.bind((address, port))
+				return
+			except OSError as e:
+				if e.errno != errno.EADDRINUSE:
+					raise
+		raise OSError(errno.EADDRINUSE, 'No free local port in {}-{}'.format(first, last))
+
+
+class CaptureManager:
+	'''
+	Run a packet capture for the duration of a run.
+	
+	``tcpdump`` is started as a subprocess with a BPF filter for the test connections. Its output is rotated into segments by size or time. A monitor thread compresses every completed segment with gzip, and appends a record to the manifest ``manifest.jsonl`` in the capture directory, with the time span of the segment and the range of output rows written during that time. Analysis of a part of the output then only needs to read the segments of that part.
+	
+	Segment boundaries are only noticed every ``poll`` seconds, and the packets of an output row precede the row by up to the duration of its connects and requests, so the row ranges of adjacent segments should be read with this margin.
+	'''
+	PREFIX = 'ecnspider-'  #: Prefix of the names of the capture segments.
+	
+	def __init__(self, directory, bpf, interface='any', snaplen=128, rotate_size=0, rotate_time=0, compress=True, rows=None, poll=1.0, popen=subprocess.Popen):
+		'''
+		:param str directory: Directory for the capture segments and the manifest.
+		:param str bpf: The BPF filter expression.
+		:param str interface: The interface to capture on.
+		:param int snaplen: Number of bytes captured per packet.
+		:param int rotate_size: Size in millions of bytes after which a new segment is started, or 0.
+		:param int rotate_time: Time in seconds after which a new segment is started, or 0.
+		:param bool compress: Whether to gzip the completed segments.
+		:param rows: A function without arguments that returns the number of output rows written so far.
+		:param float poll: Interval in seconds at which the monitor thread looks for completed segments.
+		:param popen: Replacement for :class:`subprocess.Popen` that starts the capture process, e.g. a stub for tests.
+		'''
+		self.directory = directory
+		self.bpf = bpf
+		self.interface = interface
+		self.snaplen = snaplen
+		self.rotate_size = rotate_size
+		self.rotate_time = rotate_time
+		self.compress = compress
+		self._rows = rows if rows is not None else (lambda: 0)
+		self._poll = poll
+		self._popen = popen
+		self._proc = None
+		self._stderr = None
+		self._done = set()
+		self._mark = None  # Tuple (time, number of rows) of the end of the last completed segment
+		self._stop = threading.Event()
+		self._monitor = None
+		self._manifest = None
+	
+	def command(self):
+		'''
+		:returns: The command line of the capture process.
+		'''
+		name = self.PREFIX + ('%Y%m%d-%H%M%S' if self.rotate_time > 0 else 'capture') + '.pcap'
+		cmd = ['sudo', '-n', 'tcpdump', '-i', self.interface, '-n', '-U', '-s', str(self.snaplen), '-Z', getpass.getuser(), '-w', os.path.join(self.directory, name)]
+		if self.rotate_size > 0:
+			cmd += ['-C', str(self.rotate_size)]
+		if self.rotate_time > 0:
+			cmd += ['-G', str(self.rotate_time)]
+		return cmd + [self.bpf]
+	
+	def start(self):
+		'''
+		Start the capture process and the monitor thread.
+		
+		:raises: RuntimeError if the capture process exits right away.
+		'''
+		logger = logging.getLogger('default')
+		os.makedirs(self.directory, exist_ok=True)
+		self._manifest = open(os.path.join(self.directory, 'manifest.jsonl'), 'a')
+		self._stderr = open(os.path.join(self.directory, 'tcpdump.log'), 'a')
+		cmd = self.command()
+		logger.info('Starting capture: %s', ' '.join(cmd))
+		self._proc = self._popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=self._stderr)
+		self._mark = (time.time(), self._rows())
+		# Give tcpdump the time to open the interface, so that the first connects are captured.
+		sleep(1)
+		if self._proc.poll() is not None:
+			raise RuntimeError('The capture process exited with status {}, see {}.'.format(self._proc.returncode, self._stderr.name))
+		self._monitor = threading.Thread(target=self._run, name='capture', daemon=True)
+		self._monitor.start()
+	
+	def stop(self):
+		'''
+		Stop the capture process, and complete the last segment.
+		'''
+		logger = logging.getLogger('default')
+		if self._proc.poll() is None:
+			self._proc.terminate()
+			try:
+				self._proc.wait(10)
+			except subprocess.TimeoutExpired:
+				logger.warning('The capture process did not stop, killing it.')
+				self._proc.kill()
+				self._proc.wait()
+		self._stop.set()
+		self._monitor.join()
+		self._collect(final=True)
+		self._manifest.close()
+		self._stderr.close()
+		logger.info('Capture stopped, %d segments in %s.', len(self._done), self.directory)
+	
+	def _run(self):
+		while not self._stop.wait(self._poll):
+			self._collect()
+			if self._proc.poll() is not None:
+				logging.getLogger('default').error('The capture process exited with status %s, see %s.', self._proc.returncode, self._stderr.name)
+				break
+	
+	def _segments(self):
+		# The segments written by tcpdump, oldest first. Every segment but the newest one is complete.
+		names = [n for n in os.listdir(self.directory) if n.startswith(self.PREFIX) and not n.endswith('.gz') and n not in self._done]
+		paths = [os.path.join(self.directory, n) for n in names]
+		return sorted(paths, key=lambda p: os.stat(p).st_mtime)
+	
+	def _collect(self, final=False):
+		segments = self._segments()
+		if not final:
+			segments = segments[:-1]
+		for path in segments:
+			end = (time.time(), self._rows())
+			name = os.path.basename(path)
+			self._done.add(name)
+			if self.compress:
+				with open(path, 'rb') as f, gzip.open(path + '.gz', 'wb') as g:
+					shutil.copyfileobj(f, g)
+				os.remove(path)
+				name += '.gz'
+			self._manifest.write(json.dumps({'segment': name, 'start': self._mark[0], 'end': end[0], 'first_row': self._mark[1], 'rows': end[1] - self._mark[1]}) + '\n')
+			self._manifest.flush()
+			self._mark = end
+
+
 class BigPer():
 	'''
 	A thread-safe class that allows the calculation of percentiles of an internal list of values that can be continually added to.
@@ -223,6 +456,106 @@ class BigPer():
 		return len(self._d)
 
 
+class PhaseTracer():
+	'''
+	A thread-safe recorder of how long each thread spends in each named phase of its work.
+	
+	Times are taken with :func:`time.perf_counter_ns`. Each thread appends to its own list of events, so recording a phase does not take a lock. When disabled, :meth:`add` returns immediately.
+	'''
+	def __init__(self, enabled=False, keep_events=False):
+		'''
+		:param bool enabled: If False, nothing is recorded.
+		:param bool keep_events: If True, keep every single event for :meth:`write_chrome_trace`, otherwise only keep per-phase totals.
+		'''
+		self.enabled = enabled
+		self.keep_events = keep_events
+		self._t0 = time.perf_counter_ns()
+		self._local = threading.local()
+		self._threads = []  # List of (thread name, thread id, totals, events) of every thread that has recorded something.
+		self._s = threading.BoundedSemaphore()
+	
+	@staticmethod
+	def now():
+		'''
+		:returns: The current value of the monotonic clock, in nanoseconds.
+		'''
+		return time.perf_counter_ns()
+	
+	def _slot(self):
+		try:
+			return self._local.slot
+		except AttributeError:
+			t = threading.current_thread()
+			slot = (t.name, t.ident, {}, [])
+			with self._s:
+				self._threads.append(slot)
+			self._local.slot = slot
+			return slot
+	
+	def add(self, name, start, end=None):
+		'''
+		Record that the calling thread spent the time from ``start`` to ``end`` in the phase ``name``.
+		
+		:param str name: Name of the phase.
+		:param int start: Start time, as returned by :meth:`now`.
+		:param int end: End time, as returned by :meth:`now`. Defaults to the current time.
+		'''
+		if not self.enabled:
+			return
+		if end is None:
+			end = time.perf_counter_ns()
+		_, _, totals, events = self._slot()
+		t = totals.get(name)
+		if t is None:
+			totals[name] = [1, end - start, end - start]
+		else:
+			t[0] += 1
+			t[1] += end - start
+			if end - start > t[2]:
+				t[2] = end - start
+		if self.keep_events:
+			events.append((name, start, end - start))
+	
+	def write_chrome_trace(self, file_name):
+		'''
+		Write all recorded events to a file in Chrome's trace event format, viewable with ``chrome://tracing`` or Perfetto.
+		'''
+		pid = os.getpid()
+		with self._s:
+			threads = list(self._threads)
+		with open(file_name, 'w') as f:
+			f.write('{"displayTimeUnit": "ms", "traceEvents": [\n')
+			first = True
+			for tname, tid, _, events in threads:
+				meta = {'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': tname}}
+				f.write(('' if first else ',\n') + json.dumps(meta))
+				first = False
+				for name, start, dur in list(events):
+					e = {'name': name, 'cat': 'phase', 'ph': 'X', 'pid': pid, 'tid': tid, 'ts': (start - self._t0) / 1000, 'dur': dur / 1000}
+					f.write(',\n' + json.dumps(e))
+			f.write('\n]}\n')
+	
+	def summary(self):
+		'''
+		Aggregate the recorded phases over all threads.
+		
+		:returns: A list of tuples (name, count, total seconds, mean seconds, max seconds, share of all recorded time), sorted by decreasing total time.
+		'''
+		agg = {}
+		with self._s:
+			threads = list(self._threads)
+		for _, _, totals, _ in threads:
+			for name, (c, total, mx) in list(totals.items()):
+				a = agg.setdefault(name, [0, 0, 0])
+				a[0] += c
+				a[1] += total
+				a[2] = max(a[2], mx)
+		grand = sum(a[1] for a in agg.values()) or 1
+		ret = [(name, c, total / 1e9, total / c / 1e9, mx / 1e9, total / grand) for name, (c, total, mx) in agg.items()]
+		ret.sort(key=lambda x: x[2], reverse=True)
+		return ret
+
+
 def get_ecn():
 	'''
 	Use sysctl to get the kernel's ECN behavior.
@@ -280,11 +613,11 @@ def print_platform():
 	''' Print information about the platform. '''
 	logger = logging.getLogger('default')
 	p_info = platform.platform()
-	logger.info('Platform Information: {}.'.format(p_info))
+	logger.info('Platform Information: %s.', p_info)
 	logger.info(sys.version_info)
 
 
-def master(num_workers, ecn_on, ecn_on_rdy, ecn_off, ecn_off_rdy):
+def master(num_workers, ecn_on, ecn_on_rdy, ecn_off, ecn_off_rdy, queue_=None):
 	'''
 	Master thread for controlling the kernel's ECN behavior.
 	
@@ -304,19 +637,58 @@ def master(num_workers, ecn_on, ecn_on_rdy, ecn_off, ecn_off_rdy):
 	
 	The five semaphores must have been created before this thread is started, and their values must have been set to zero, i.e. acquiring a token is not possible.
 	
+	At the start of every round, after ECN has been turned off and before the workers are released, the master runs the functions waiting in :data:`OFF_TASKS`, see :meth:`run_while_ecn_off`.
+	
+	If ``queue_`` is given, the master parks before a round while no job is queued or in progress and :data:`OFF_TASKS` is empty, until :data:`WAKE` is set. The workers then wait for the next round, so an idle daemon does not flip ECN at all.
+	
 	:param int num_workers: Number of worker threads (that perform HTTP requests)
 	:param SemaphoreN ecn_on, ecn_on_rdy, ecn_off, ecn_off_rdy, end: The semaphores described above.
+	:param queue_: The job queue, or None to run the rounds without a break.
 	'''
 	logger = logging.getLogger('default')
+	now = PhaseTracer.now
 	while RUN:
+		if queue_ is not None:
+			# Clear first, so that a job queued after the check still wakes the master.
+			WAKE.clear()
+			# Jobs count as unfinished from the time they are queued until their record is written, including those that a worker has taken but not yet connected for.
+			if queue_.unfinished_tasks == 0 and OFF_TASKS.empty():
+				logger.debug('No jobs queued, parking.')
+				WAKE.wait()
+				continue
+		t = now()
 		disable_ecn()
-		logger.debug('ECN off connects from here onwards.')
+		t1 = now()
+		TRACER.add('sysctl_off', t, t1)
+		M_SYSCTL.observe((t1 - t) / 1e9, ('off', ))
+		M_FLIPS.inc(labels=('off', ))
+		while True:
+			try:
+				task = OFF_TASKS.get_nowait()
+			except queue.Empty:
+				break
+			t = now()
+			task()
+			TRACER.add('off_task', t)
+		hot_debug(logger, 'ECN off connects from here onwards.')
 		ecn_off.release_n(num_workers)
+		t = now()
 		ecn_on_rdy.acquire_n(num_workers)
+		t1 = now()
+		TRACER.add('wait_ecn_on_rdy', t, t1)
+		M_BARRIER.observe((t1 - t) / 1e9, ('ecn_on_rdy', ))
 		enable_ecn()
-		logger.debug('ECN on connects from here onwards.')
+		t = now()
+		TRACER.add('sysctl_on', t1, t)
+		M_SYSCTL.observe((t - t1) / 1e9, ('on', ))
+		M_FLIPS.inc(labels=('on', ))
+		hot_debug(logger, 'ECN on connects from here onwards.')
 		ecn_on.release_n(num_workers)
+		t = now()
 		ecn_off_rdy.acquire_n(num_workers)
+		t1 = now()
+		TRACER.add('wait_ecn_off_rdy', t, t1)
+		M_BARRIER.observe((t1 - t) / 1e9, ('ecn_off_rdy', ))
 	
 	# In case the master exits the run loop before all workers have, these tokens will allow all workers to run through again, until the next check at the start of the RUN loop
 	ecn_off.release_n(num_workers)
@@ -325,29 +697,123 @@ def master(num_workers, ecn_on, ecn_on_rdy, ecn_off, ecn_off_rdy):
 	logger.debug('Master thread ending.')
 
 
-def setup_socket(ip, timeout):
+def prepare_socket(ip, timeout, mode=None):
 	'''
-	Open a socket using an instance of http.client.HTTPConnection.
+	Create and configure the socket for a connection with :meth:`setup_socket`, without connecting it yet.
+	
+	This moves the allocation of the ``http.client.HTTPConnection``, the parsing of the address and the ``socket()`` system call out of the time between an ECN flip and the connect.
 	
 	:param ip: IP address
 	:param timeout: Timeout for socket operations
-	:returns: A tuple of: Error message or None, an instance of http.client.HTTPConnection.
+	:param mode: The connection mode, 'eoff' or 'eon', see :meth:`configure_socket`.
+	:returns: A tuple of: Error message or None, a tuple (instance of http.client.HTTPConnection with an unconnected socket, address to connect to) or None.
 	'''
 	logger = logging.getLogger('default')
 	client = http.client.HTTPConnection(ip, timeout=timeout)
 	client.auto_open = 0
 	try:
-		client.connect()
+		family, type_, proto, _, address = socket.getaddrinfo(client.host, client.port, 0, socket.SOCK_STREAM, 0, socket.AI_NUMERICHOST)[0]
+		sock = socket.socket(family, type_, proto)
+	except OSError as e:
+		logger.error('Preparing a socket for %s failed: %s', ip, e)
+		return (error_string(e), None)
+	try:
+		configure_socket(sock, family, mode)
+	except OSError as e:
+		sock.close()
+		logger.error('Binding a socket for %s failed: %s', ip, e)
+		return (error_string(e), None)
+	sock.settimeout(timeout)
+	# As set by http.client.HTTPConnection.connect
+	sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+	client.sock = sock
+	return (None, (client, address))
+
+
+def configure_socket(sock, family, mode=None):
+	'''
+	Apply ``--source-address``, ``--port-range``, ``--eoff-ports``, ``--eon-ports`` and ``--linger-rst`` to a new socket.
+	
+	:param mode: The connection mode, 'eoff' or 'eon'. The socket is bound to a port of the range of the mode, if it has one. None for connections that are not part of the paired test.
+	:raises: OSError if the socket can not be bound.
+	'''
+	if ARGS is not None and ARGS.linger_rst:
+		# Close with a RST instead of a FIN, which leaves no TIME_WAIT state behind.
+		sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+	sources = MODE_SOURCES.get(mode, SOURCES)
+	if sources is not None:
+		sources.bind(sock, family)
+
+
+def discard_socket(prepared):
+	'''
+	Close a socket returned by :meth:`prepare_socket` that is not going to be connected.
+	'''
+	if prepared is not None and prepared[1] is not None:
+		prepared[1][0].sock.close()
+
+
+def error_string(e):
+	'''
+	:param OSError e: An error of creating, binding or connecting a socket.
+	:returns: The error string of the output record: E['local'] for the errors of :data:`LOCAL_ERRNOS`, the error message otherwise.
+	'''
+	if e.errno in LOCAL_ERRNOS:
+		return E['local']
+	return str(e) if e.strerror is None else e.strerror
+
+
+def setup_socket(ip, timeout, prepared=None, mode=None):
+	'''
+	Open a socket using an instance of http.client.HTTPConnection.
+	
+	A connect that fails because of the local host, see :data:`LOCAL_ERRNOS`, is tried again with a new socket, bound to the next local address and port, up to :data:`LOCAL_ATTEMPTS` times. This happens e.g. when the port a socket is bound to still has a connection to the same target in TIME_WAIT.
+	
+	:param ip: IP address
+	:param timeout: Timeout for socket operations
+	:param prepared: The return value of :meth:`prepare_socket`. If given, only the connect is made here.
+	:param mode: The connection mode, 'eoff' or 'eon', see :meth:`configure_socket`.
+	:returns: A tuple of: Error message or None, an instance of http.client.HTTPConnection. The error message is E['local'] if all attempts failed locally.
+	'''
+	logger = logging.getLogger('default')
+	for _ in range(LOCAL_ATTEMPTS):
+		err, client = _connect(ip, timeout, prepared, mode)
+		if err != E['local']:
+			return (err, client)
+		prepared = None
+	logger.error('Connecting to %s failed locally %d times, giving up.', ip, LOCAL_ATTEMPTS)
+	return (err, None)
+
+
+def _connect(ip, timeout, prepared, mode):
+	# One attempt of setup_socket.
+	logger = logging.getLogger('default')
+	if prepared is None and (SOURCES is not None or mode in MODE_SOURCES or ARGS.linger_rst):
+		prepared = prepare_socket(ip, timeout, mode)
+	if prepared is None:
+		client = http.client.HTTPConnection(ip, timeout=timeout)
+		client.auto_open = 0
+		connect = client.connect
+	else:
+		err, prepared = prepared
+		if err is not None:
+			return (err, None)
+		client, address = prepared
+		connect = lambda: client.sock.connect(address)
+	try:
+		connect()
 	except socket.timeout:
-		logger.error('Connecting to {} timed out.'.format(ip))
+		logger.error('Connecting to %s timed out.', ip)
+		client.close()
 		return ('socket.timeout', None)
 	except OSError as e:
+		client.close()
 		if e.errno is None:
-			logger.error('Connecting to {} failed: {}'.format(ip, e))
+			logger.error('Connecting to %s failed: %s', ip, e)
 			return (str(e), None)
 		else:
-			logger.error('Connecting to {} failed: {}'.format(ip, e.strerror))
-			return (e.strerror, None)
+			logger.error('Connecting to %s failed: %s', ip, e.strerror)
+			return (error_string(e), None)
 	else:
 		return (None, client)
 
@@ -374,12 +840,13 @@ def make_get(client, domain, note):
 	stat_name = 'status_' + note
 	hdr_name = 'headers_' + note
 	
+	t = time.perf_counter()
 	try:
 		client.request('GET', '/', headers=h)
 		r = client.getresponse()
 		client.close()
 		
-		logger.debug('Request for {} ({}) returned status code {}.'.format(client.host, note, r.status))
+		hot_debug(logger, 'Request for %s (%s) returned status code %s.', client.host, note, r.status)
 		
 		d[stat_name] = r.status
 		if ARGS.save_headers:
@@ -389,20 +856,22 @@ def make_get(client, domain, note):
 		d[err_name] = None
 	except OSError as e:
 		if e.errno is None:
-			logger.error('Request for {} failed (errno None): {}'.format(client.host, e))
+			logger.error('Request for %s failed (errno None): %s', client.host, e)
 			d[err_name] = str(e)
 			d[stat_name] = None
 			d[hdr_name] = None
 		else:
-			logger.error('Request for {} failed (with errno): {}'.format(client.host, e.strerror))
+			logger.error('Request for %s failed (with errno): %s', client.host, e.strerror)
 			d[err_name] = e.strerror
 			d[stat_name] = None
 			d[hdr_name] = None
 	except Exception as e:
-		logger.error('Request for {} failed ({}): {}.'.format(client.host, type(e), e))
+		logger.error('Request for %s failed (%s): %s.', client.host, type(e), e)
 		d[err_name] = str(e)
 		d[stat_name] = None
 		d[hdr_name] = None
+	M_REQ_TIME.observe(time.perf_counter() - t, (note, ))
+	M_HTTP_ERRORS.inc(labels=(note, E['success'] if d[err_name] is None else d[err_name]))
 	return d
 
 
@@ -410,6 +879,178 @@ def retry(eoff_err, eon_err):
 	return not ((eoff_err in NO_RETRY) and (eon_err in NO_RETRY))
 
 
+def schedule_retry(rank, domain, ip):
+	'''
+	Write a job to the retry data file.
+	
+	:param ip: The address of the job, IPv6 addresses enclosed in square brackets.
+	'''
+	stripped_ip = ip.lstrip('[').rstrip(']')
+	if stripped_ip == ip:
+		# This is a v4 address, since it did not have square brackets
+		RETRY_LOGGER.writerow([rank, domain, stripped_ip, ''])
+	else:
+		RETRY_LOGGER.writerow([rank, domain, '', stripped_ip])
+	retry_count.incr()
+	M_RETRIES.inc()
+
+
+def run_while_ecn_off(fn, *args):
+	'''
+	Have the master thread call ``fn(*args)`` at the start of its next round, while ECN is off and no worker is connecting.
+	
+	:returns: The return value of ``fn``, once it has been called.
+	:raises: The exception raised by ``fn``.
+	'''
+	f = concurrent.futures.Future()
+	
+	def task():
+		try:
+			f.set_result(fn(*args))
+		except Exception as e:
+			f.set_exception(e)
+	
+	OFF_TASKS.put(task)
+	WAKE.set()
+	return f.result()
+
+
+def connect_sweep(ips, timeout, concurrency, port=80):
+	'''
+	Make plain TCP connects to many addresses at once, and measure the time until each connection is set up. Nothing is sent over the connections, they are closed as soon as they are established.
+	
+	The connects are non-blocking and all waited for with one selector, so that a single thread can have ``concurrency`` connects outstanding.
+	
+	:param ips: A list of addresses, IPv6 addresses enclosed in square brackets.
+	:param float timeout: Timeout for connection setup in seconds.
+	:param int concurrency: Maximum number of outstanding connects.
+	:param int port: TCP port to connect to.
+	:returns: A list with one tuple (error, connection setup time in seconds) per address, in the order of ``ips``. The error is None for a successful connect, otherwise one of the error strings of :data:`E`.
+	'''
+	results = [None] * len(ips)
+	sel = selectors.DefaultSelector()
+	deadlines = deque()  # (deadline, index, socket) in order of the start of the connects, which is also the order of their deadlines.
+	outstanding = 0
+	todo = iter(enumerate(ips))
+	more = True
+	
+	while True:
+		while more and outstanding < concurrency:
+			try:
+				i, ip = next(todo)
+			except StopIteration:
+				more = False
+				break
+			address = ip.lstrip('[').rstrip(']')
+			t0 = time.monotonic()
+			family = socket.AF_INET6 if ':' in address else socket.AF_INET
+			try:
+				sock = socket.socket(family, socket.SOCK_STREAM)
+			except OSError as e:
+				results[i] = (error_string(e), 0.0)
+				continue
+			try:
+				configure_socket(sock, family)
+			except OSError as e:
+				results[i] = (error_string(e), 0.0)
+				sock.close()
+				continue
+			sock.setblocking(False)
+			err = sock.connect_ex((address, port))
+			if err not in (0, errno.EINPROGRESS):
+				results[i] = (E['local'] if err in LOCAL_ERRNOS else os.strerror(err), time.monotonic() - t0)
+				sock.close()
+				continue
+			sel.register(sock, selectors.EVENT_WRITE, (i, t0))
+			deadlines.append((t0 + timeout, i, sock))
+			outstanding += 1
+		
+		if outstanding == 0 and not more:
+			break
+		
+		for key, _ in sel.select(max(0.0, deadlines[0][0] - time.monotonic())):
+			i, t0 = key.data
+			err = key.fileobj.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+			results[i] = (None if err == 0 else os.strerror(err), time.monotonic() - t0)
+			sel.unregister(key.fileobj)
+			key.fileobj.close()
+			outstanding -= 1
+		
+		now = time.monotonic()
+		while deadlines and (deadlines[0][0] <= now or results[deadlines[0][1]] is not None):
+			_, i, sock = deadlines.popleft()
+			if results[i] is None:
+				results[i] = (E['timeout'], timeout)
+				sel.unregister(sock)
+				sock.close()
+				outstanding -= 1
+	
+	sel.close()
+	return results
+
+
+def triage(jobs, timeout, triage_timeout, concurrency):
+	'''
+	Sort out the jobs whose addresses can not be reached before they are tested with and without ECN.
+	
+	All addresses get a connect with the short ``triage_timeout``. This pass runs in the calling thread, while the workers go on with their rounds, so some of its connects are made with ECN on. Those that time out, whatever the reason, get a second, confirming connect with the full ``timeout``. Only this pass runs with ECN off, in the master thread, see :meth:`run_while_ecn_off`. The results are written to the ``--triage-file``.
+	
+	:param jobs: A list of ``Job``.
+	:param int timeout: Timeout for connection setup of the confirming pass.
+	:param float triage_timeout: Timeout for connection setup of the first pass.
+	:param int concurrency: Maximum number of outstanding connects.
+	:returns: A tuple of the reachable jobs, ordered by their connection setup time, and a list of tuples (job, error, time before the confirming connect, time after it) of the jobs that were not reachable in either pass.
+	'''
+	def sweep(stage, jobs, timeout):
+		results = connect_sweep([j.ip for j in jobs], timeout, concurrency)
+		for j, (err, rtt) in zip(jobs, results):
+			M_TRIAGE.inc(labels=(stage, E['success'] if err is None else err))
+			if err is None:
+				M_TRIAGE_RTT.observe(rtt)
+			if TRIAGE_LOGGER is not None:
+				TRIAGE_LOGGER.writerow([time.time(), j.rank, j.domain, j.ip, stage, E['success'] if err is None else err, round(rtt * 1000, 3)])
+		return results
+	
+	results = sweep('triage', jobs, triage_timeout)
+	reachable = sorted((rtt, n) for n, (err, rtt) in enumerate(results) if err is None)
+	ordered = [jobs[n] for _, n in reachable]
+	
+	# Anything but a timeout is a definite answer from the host or the network, and is tested as usual.
+	late = [j for j, (err, _) in zip(jobs, results) if err == E['timeout']]
+	ordered.extend(j for j, (err, _) in zip(jobs, results) if err is not None and err != E['timeout'])
+	
+	def confirm():
+		pre = time.time()
+		results = sweep('confirm', late, timeout)
+		return results, pre, time.time()
+	
+	dead = []
+	if late:
+		confirmed, pre, post = run_while_ecn_off(confirm)
+		for j, (err, _) in zip(late, confirmed):
+			if err is None:
+				ordered.append(j)
+			else:
+				dead.append((j, err, pre, post))
+	
+	return ordered, dead
+
+
+def log_unreachable(job, err, pre, post):
+	'''
+	Write the output record of a job that was sorted out by :meth:`triage`, as if its connect with ECN off had failed with ``err``, and no connect with ECN on had been attempted.
+	'''
+	d = time.time()
+	row = [d, job.rank, job.domain, job.ip, err, 0, 'no_attempt', 0, pre, post, post, post, post, post, post, 'no_attempt', None, None, 'no_attempt', None, None]
+	DLOGGER.writerow(row)
+	if job.sink is not None:
+		job.sink(row)
+	if retry(err, 'no_attempt'):
+		schedule_retry(job.rank, job.domain, job.ip)
+	count.incr()
+	M_JOBS.inc()
+
+
 def worker(queue_, timeout, ecn_on, ecn_on_rdy, ecn_off, ecn_off_rdy):
 	'''
 	Worker thread for crawling websites with and without ECN.
@@ -424,10 +1065,16 @@ def worker(queue_, timeout, ecn_on, ecn_on_rdy, ecn_off, ecn_off_rdy):
 	'''
 	logger = logging.getLogger('default')
 	tl = datetime.datetime.now()  # Timestamp for measuring frequency of job processing for this worker
+	now = PhaseTracer.now
 	
 	while RUN:
 		queue_job = False  #: If the current job was taken from the queue this is True
+		t = now()
+		# With all request threads taken, wait for one briefly, and otherwise sit the round out instead of connecting for a job whose requests would wait for a thread.
+		starved = REQUEST_SLOTS is not None and not REQUEST_SLOTS.acquire(timeout=SLOT_WAIT)
 		try:
+			if starved:
+				raise queue.Empty
 			job = queue_.get_nowait()
 			tt = datetime.datetime.now()
 			PER.append((tt - tl).total_seconds())
@@ -456,58 +1103,106 @@ def worker(queue_, timeout, ecn_on, ecn_on_rdy, ecn_off, ecn_off_rdy):
 				#status_eon
 				#headers_eon
 		except queue.Empty:
-			sleep(0.5)
-			logger.debug('Not a queue job, skipping processing.')
+			if starved:
+				# The master may be waiting for this worker already, so it joins the round right away.
+				hot_debug(logger, 'No request thread free, skipping processing.')
+			else:
+				if REQUEST_SLOTS is not None:
+					REQUEST_SLOTS.release()
+				sleep(0.5)
+				hot_debug(logger, 'Not a queue job, skipping processing.')
+		
+		t1 = now()
+		TRACER.add('queue_get', t, t1)
+		
+		eoff_prep = None
+		eon_prep = None
+		if queue_job and ARGS.prealloc_sockets:
+			eoff_prep = prepare_socket(job.ip, timeout, 'eoff')
+			t = t1
+			t1 = now()
+			TRACER.add('prepare_socket', t, t1)
 		
 		ecn_off.acquire()
+		t = now()
+		TRACER.add('wait_ecn_off', t1, t)
+		M_BARRIER.observe((t - t1) / 1e9, ('ecn_off', ))
 		
 		if queue_job:
-			logger.debug('Connecting with ECN off...')
+			hot_debug(logger, 'Connecting with ECN off...')
 			
 			d['ip'] = job.ip
 			d['rank'] = job.rank
 			d['domain'] = job.domain
+			d['sink'] = job.sink
 			d['pre_conn_eoff_time'] = time.time()
 			
-			eoff_err, eoff = setup_socket(job.ip, timeout=timeout)
+			eoff_err, eoff = setup_socket(job.ip, timeout=timeout, prepared=eoff_prep, mode='eoff')
 			
 			d['post_conn_eoff_time'] = time.time()
+			TRACER.add('connect_eoff', t)
+			M_CONN_TIME.observe(d['post_conn_eoff_time'] - d['pre_conn_eoff_time'], ('eoff', ))
+			M_CONN_ERRORS.inc(labels=('eoff', E['success'] if eoff_err is None else eoff_err))
 			d['eoff_err'] = eoff_err
 			if isinstance(eoff, http.client.HTTPConnection):
 				d['port_eoff'] = eoff.sock.getsockname()[1]
+				if REQUEST_POOL is not None:
+					f_eoff = REQUEST_POOL.submit(timed_get, eoff, job.domain, 'eoff')
 			else:
 				d['port_eoff'] = 0
+				f_eoff = None
 		
 		ecn_on_rdy.release()
+		t = now()
+		if queue_job and ARGS.prealloc_sockets:
+			# The master is flipping ECN on in the meantime.
+			eon_prep = prepare_socket(job.ip, timeout, 'eon')
+			TRACER.add('prepare_socket', t)
 		ecn_on.acquire()
+		t1 = now()
+		TRACER.add('wait_ecn_on', t, t1)
+		M_BARRIER.observe((t1 - t) / 1e9, ('ecn_on', ))
 		
 		if queue_job:
-			logger.debug('Connecting with ECN on...')
+			hot_debug(logger, 'Connecting with ECN on...')
 			
 			d['pre_conn_eon_time'] = time.time()
 			
 			if ARGS.fast_fail and eoff_err == 'socket.timeout':
 				eon_err = 'no_attempt'
 				eon = None
+				discard_socket(eon_prep)
 			else:
-				eon_err, eon = setup_socket(job.ip, timeout=timeout)
+				eon_err, eon = setup_socket(job.ip, timeout=timeout, prepared=eon_prep, mode='eon')
 			
 			d['post_conn_eon_time'] = time.time()
+			TRACER.add('connect_eon', t1)
+			if eon_err != 'no_attempt':
+				M_CONN_TIME.observe(d['post_conn_eon_time'] - d['pre_conn_eon_time'], ('eon', ))
+			M_CONN_ERRORS.inc(labels=('eon', E['success'] if eon_err is None else eon_err))
 			d['eon_err'] = eon_err
 			if isinstance(eon, http.client.HTTPConnection):
 				d['port_eon'] = eon.sock.getsockname()[1]
+				if REQUEST_POOL is not None:
+					f_eon = REQUEST_POOL.submit(timed_get, eon, job.domain, 'eon')
 			else:
 				d['port_eon'] = 0
+				f_eon = None
 		
 		ecn_off_rdy.release()
 		
-		if queue_job:
-			logger.debug('Making GET requests...')
+		if queue_job and REQUEST_POOL is not None:
+			# The requests are under way already, the record is written when both are done.
+			complete_later(queue_, d, f_eoff, f_eon)
+		elif queue_job:
+			hot_debug(logger, 'Making GET requests...')
 			
 			d['pre_req_time'] = time.time()
 			
 			if isinstance(eon, http.client.HTTPConnection):
+				t = now()
 				d_ = make_get(eon, job.domain, 'eon')
+				TRACER.add('request_eon', t)
 				d.update(d_)
 			else:
 				d['http_err_eon'] = 'no_attempt'
@@ -517,7 +1212,9 @@ def worker(queue_, timeout, ecn_on, ecn_on_rdy, ecn_off, ecn_off_rdy):
 			d['inter_req_time'] = time.time()
 			
 			if isinstance(eoff, http.client.HTTPConnection):
+				t = now()
 				d_ = make_get(eoff, job.domain, 'eoff')
+				TRACER.add('request_eoff', t)
 				d.update(d_)
 			else:
 				d['http_err_eoff'] = 'no_attempt'
@@ -525,27 +1222,100 @@ def worker(queue_, timeout, ecn_on, ecn_on_rdy, ecn_off, ecn_off_rdy):
 				d['headers_eoff'] = None
 			
 			d['post_req_time'] = time.time()
-			d['record_time'] = time.time()
-			
-			DLOGGER.writerow([d['record_time'], d['rank'], d['domain'], d['ip'], d['eoff_err'], d['port_eoff'], d['eon_err'], d['port_eon'], d['pre_conn_eoff_time'], d['post_conn_eoff_time'], d['pre_conn_eon_time'], d['post_conn_eon_time'], d['pre_req_time'], d['inter_req_time'], d['post_req_time'], d['http_err_eoff'], d['status_eoff'], d['headers_eoff'], d['http_err_eon'], d['status_eon'], d['headers_eon']])
-			
-			if retry(d['eoff_err'], d['eon_err']):
-				# This test needs to be retried.
-				logger.debug('eoff_err == {}, eon_err == {}.'.format(d['eoff_err'], d['eon_err']))
-				stripped_ip = d['ip'].lstrip('[').rstrip(']')
-				if stripped_ip == d['ip']:
-					# This is a v4 address, since it did not have square brackets
-					RETRY_LOGGER.writerow([d['rank'], d['domain'], stripped_ip, ''])
-				else:
-					RETRY_LOGGER.writerow([d['rank'], d['domain'], '', stripped_ip])
-				retry_count.incr()
 			
-			queue_.task_done()
-			count.incr()
+			finish_job(queue_, d)
 	
 	logger.debug('Worker thread ending.')
 
 
+def finish_job(queue_, d):
+	'''
+	Write the output record of a job, schedule it for a retry if necessary, and mark it as done.
+	
+	:param Queue queue_: The job queue the job was taken from.
+	:param dict d: The values of the output record, as collected by :meth:`worker`.
+	'''
+	logger = logging.getLogger('default')
+	d['record_time'] = time.time()
+	
+	t = TRACER.now()
+	row = [d[f] for f in OUTPUT_FIELDS]
+	DLOGGER.writerow(row)
+	if d.get('sink') is not None:
+		d['sink'](row)
+	
+	if retry(d['eoff_err'], d['eon_err']):
+		# This test needs to be retried.
+		hot_debug(logger, 'eoff_err == %s, eon_err == %s.', d['eoff_err'], d['eon_err'])
+		schedule_retry(d['rank'], d['domain'], d['ip'])
+	TRACER.add('write_record', t)
+	
+	queue_.task_done()
+	count.incr()
+	M_JOBS.inc()
+
+
+def request_slots(args):
+	'''
+	:param args: The return value of :meth:`arguments`.
+	:returns: The number of jobs whose requests may be under way at once with ``--request-mode immediate``. Each job makes up to two requests, so that every one of them gets a thread of the request pool right away. With the default pool, every worker has two jobs, so that it can go on with the next job while the requests of the last one are still under way.
+	'''
+	return max(1, (args.request_workers or 4 * args.workers) // 2)
+
+
+def timed_get(client, domain, note):
+	'''
+	Call :meth:`make_get`, and note when the request was started.
+	
+	:returns: A tuple of the start time and the return value of :meth:`make_get`.
+	'''
+	t = time.time()
+	t1 = TRACER.now()
+	d = make_get(client, domain, note)
+	TRACER.add('request_' + note, t1)
+	return (t, d)
+
+
+def complete_later(queue_, d, f_eoff, f_eon):
+	'''
+	Finish a job with ``--request-mode immediate`` once its requests have been answered, without waiting for them. The job's token of :data:`REQUEST_SLOTS` is released after its record has been written.
+	
+	The record gets the start of the request on the ECN off connection as ``pre_req_time``, the start of the request on the ECN on connection as ``inter_req_time``, and the end of the later of the two as ``post_req_time``.
+	
+	:param Queue queue_: The job queue the job was taken from.
+	:param dict d: The values of the output record collected so far.
+	:param f_eoff, f_eon: The futures of the requests made by :meth:`timed_get` on the two connections, or None where the connect failed.
+	'''
+	futures = [f for f in (f_eoff, f_eon) if f is not None]
+	remaining = [len(futures)]
+	lock = threading.Lock()
+	
+	def done(_=None):
+		with lock:
+			remaining[0] -= 1
+			if remaining[0] > 0:
+				return
+		for note, f in (('eoff', f_eoff), ('eon', f_eon)):
+			if f is None:
+				d['http_err_' + note] = 'no_attempt'
+				d['status_' + note] = None
+				d['headers_' + note] = None
+				t = time.time()
+			else:
+				t, d_ = f.result()
+				d.update(d_)
+			d['pre_req_time' if note == 'eoff' else 'inter_req_time'] = t
+		d['post_req_time'] = time.time()
+		finish_job(queue_, d)
+		REQUEST_SLOTS.release()
+	
+	if len(futures) == 0:
+		remaining[0] = 1
+		done()
+	for f in futures:
+		f.add_done_callback(done)
+
+
 def domain_reader(max_lines, *args, **kwargs):
 	'''
 	A wrapper around csv reader, that makes it a generator. Reads records from the input file, and returns them as the ``namedtuple`` ``Record``.
@@ -578,6 +1348,26 @@ def limited_reader(max_lines=0, *args, **kwargs):
 			break
 
 
+def parse_port_range(name, value):
+	'''
+	Parse a port range option.
+	
+	:param str name: Name of the option, for the error message.
+	:param str value: The option value in the format "FIRST-LAST", or None.
+	:returns: A tuple (first, last), or None if ``value`` is None.
+	:raises: ValueError if ``value`` is malformed.
+	'''
+	if value is None:
+		return None
+	try:
+		first, last = (int(p) for p in value.split('-'))
+	except ValueError:
+		raise ValueError('{} must have the format "FIRST-LAST", it was set to {}.'.format(name, value))
+	if not 1 <= first <= last <= 65535:
+		raise ValueError('{} must be a range of valid TCP port numbers, it was set to {}.'.format(name, value))
+	return (first, last)
+
+
 def arguments(argv):
 	'''
 	Parse the command-line arguments.
@@ -587,18 +1377,48 @@ def arguments(argv):
 	'''
 	parser = argparse.ArgumentParser(description='%(prog)s: Crawl web pages using TCP connections with and without ECN simultaneously.', epilog='This program is part of ECN-Spider.')
 	
-	parser.add_argument('input', type=str, help='CSV format input data file with domain names and associated IP addresses. Each record has the format: "domain,IPv4,IPv6".')
+	parser.add_argument('input', type=str, nargs='?', help='CSV format input data file with domain names and associated IP addresses. Each record has the format: "domain,IPv4,IPv6". Left out with --daemon.')
 	parser.add_argument('retry_data_file', type=str, help='CSV format output data file for running retries of failed tests with %(prog)s. This file will consist of a subset of the information of the input data. Each domain will have at most one IP, but a domain may appear twice if it had both an IPv4 and IPv6 address originally.')
 	parser.add_argument('output', type=str, help='CSV format output data file with meta-data and data of HTTP GET requests that were answered.')
 	parser.add_argument('logfile', type=str, help='Log file with all further messages about the run.')
 	
+	parser.add_argument('--no-logfile', action='store_true', dest='no_logfile', help='If set, do not write the logfile. The "logfile" argument is ignored.')
+	parser.add_argument('--debug-sample', type=int, default='1', dest='debug_sample', help='Only log every Nth debug message from the measurement critical path (ECN flips, connects, requests). 0 disables these messages altogether.')
 	parser.add_argument('--verbosity', '-v', default='DEBUG', choices=['CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG'], help='Verbosity of logging to stdout. Writing to output files will not be affected by this setting.')
 	parser.add_argument('--workers', '-w', type=int, default='5', help='The number of worker threads used for making HTTP requests.')
 	parser.add_argument('--timeout', '-t', type=int, default='10', help='Timeout for connection setup.')
 	parser.add_argument('--no-tcpdump-check', action='store_true', dest='no_tcpdump_check', help='If set, ECN-Spider will not fail when it can\'t find tcpdump running already at startup.')
 	parser.add_argument('--save-headers', '-s', action='store_true', dest='save_headers', help='If set, write the HTTP response headers to the CSV file, otherwise leave the header field empty in the CSV output.')
 	parser.add_argument('--no-IPv6', '-6', action='store_true', dest='no_ipv6', help='If set, do not attempt to test any IPv6 addresses. Use this switch on machines with no IPv6 address.')
+	parser.add_argument('--unique', '-u', action='store_true', help='If set, test every IP address only once, even if it appears for several domains in the input file. Only the first domain of an address is tested.')
+	parser.add_argument('--bogons', default='keep', choices=['drop', 'flag', 'keep'], help='Handling of bogon addresses in the input: private, loopback, link-local, multicast, documentation and other addresses that are not reachable on the public Internet. "drop" does not test them. "flag" tests them, but logs a warning. "keep", the default, does not check addresses.')
+	parser.add_argument('--bogon-file', action='append', default=[], dest='bogon_file', help='File with further bogon prefixes, one per line, optionally followed by a description. May be given multiple times.')
 	parser.add_argument('--debug-count', '-d', type=int, default='0', dest='debug_count', help='Perform test for at most N domains. All of them if this value is set to 0.')
+	parser.add_argument('--metrics-port', type=int, default='0', dest='metrics_port', help='If set, serve live counters and histograms in the Prometheus text format on http://127.0.0.1:PORT/metrics.')
+	parser.add_argument('--trace', type=str, default=None, help='If set, record how long each thread spends in each phase (barrier waits, sysctl calls, connects, requests, queue waits) and write every event to this file in Chrome\'s trace event format. Implies --profile.')
+	parser.add_argument('--profile', action='store_true', help='If set, log a summary at the end of the run ranking the phases by the total time spent in them.')
+	parser.add_argument('--source-address', action='append', default=[], dest='source_address', help='Local address to make the connections from. May be given multiple times, also for IPv4 and IPv6, the connections are spread over the addresses of their family round-robin.')
+	parser.add_argument('--port-range', type=str, default=None, dest='port_range', help='Range of local ports to make the connections from, e.g. "20000-59999". The ports are used round-robin. Defaults to the kernel\'s ephemeral port range. A connect that fails because no local port is free is tried again on the next ports, and recorded as "local.error" if that fails, too.')
+	parser.add_argument('--eoff-ports', type=str, default=None, dest='eoff_ports', help='Range of local ports for the connections without ECN, e.g. "40000-44999". Together with --eon-ports, the mode of every test connection can be told by its local port, and captures can be filtered by port, see --print-filter.')
+	parser.add_argument('--eon-ports', type=str, default=None, dest='eon_ports', help='Range of local ports for the connections with ECN, e.g. "45000-49999". It must not overlap --eoff-ports.')
+	parser.add_argument('--capture', type=str, default=None, help='If set, run tcpdump for the duration of the run, and write the capture into this directory. Only the packets of the test connections are captured, see --print-filter. This replaces the check for a running tcpdump.')
+	parser.add_argument('--capture-interface', type=str, default='any', dest='capture_interface', help='Interface to capture on with --capture.')
+	parser.add_argument('--capture-snaplen', type=int, default='128', dest='capture_snaplen', help='Number of bytes captured per packet with --capture.')
+	parser.add_argument('--capture-all', action='store_true', dest='capture_all', help='If set, --capture captures all packets of the test connections, instead of only SYN and SYN-ACK packets.')
+	parser.add_argument('--rotate-size', type=int, default='0', dest='rotate_size', help='Start a new capture segment after this many millions of bytes.')
+	parser.add_argument('--rotate-time', type=int, default='0', dest='rotate_time', help='Start a new capture segment after this many seconds.')
+	parser.add_argument('--no-compress', action='store_true', dest='no_compress', help='If set, do not gzip completed capture segments.')
+	parser.add_argument('--print-filter', action='store_true', dest='print_filter', help='Print a tcpdump filter expression matching the test connections, and exit.')
+	parser.add_argument('--linger-rst', action='store_true', dest='linger_rst', help='If set, close connections with a RST instead of a FIN, so that they leave no TIME_WAIT state behind. Use this at high connection rates, when local ports run out.')
+	parser.add_argument('--prealloc-sockets', action='store_true', dest='prealloc_sockets', help='If set, create and configure the socket of each connection before the ECN flip it waits for, so that only the connect itself happens after the flip. The connects with and without ECN of a round then go out closer together.')
+	parser.add_argument('--request-mode', default='deferred', choices=['deferred', 'immediate'], dest='request_mode', help='When to send the HTTP requests. "deferred" sends both requests after both connects of a round. "immediate" hands each request to a separate pool of threads right after its connect, so that no connection sits idle for a barrier cycle, and the workers go on to their next job without waiting for the answers.')
+	parser.add_argument('--request-workers', type=int, default='0', dest='request_workers', help='Number of threads making the HTTP requests with --request-mode immediate. Defaults to four times the number of workers. A worker only takes a job when two of them are free, and sits the round out if none become free within 0.1 s, so no connection waits for a thread, and the open connections are bounded.')
+	parser.add_argument('--triage', action='store_true', help='If set, first make plain connects to all addresses, many at once and with a short timeout, alongside the test, and only test the reachable ones with and without ECN, fastest first. Addresses that time out get a second connect with ECN off and the full --timeout, and are only tested if that one succeeds. For the others, an output record without an ECN connect is written, as with --fast-fail.')
+	parser.add_argument('--triage-timeout', type=float, default='1.0', dest='triage_timeout', help='Timeout for connection setup of the --triage sweep in seconds.')
+	parser.add_argument('--triage-concurrency', type=int, default='256', dest='triage_concurrency', help='Maximum number of connects the --triage sweep has outstanding at once.')
+	parser.add_argument('--triage-batch', type=int, default='1000', dest='triage_batch', help='Number of addresses swept by --triage at a time. The workers wait while the addresses of a batch that timed out get their confirming connect.')
+	parser.add_argument('--triage-file', type=str, default=None, dest='triage_file', help='If set, write a CSV record "time,rank,domain,ip,stage,result,rtt_ms" for every connect of the --triage sweep to this file.')
+	parser.add_argument('--daemon', type=str, default=None, metavar='SOCKET', help='If set, keep running and accept batches of jobs on the Unix socket SOCKET instead of reading an input file, which must be left out. While no jobs are queued, the test is parked and ECN is not flipped. A batch is sent in the format of the input file or in JSON lines, ended by shutting down the sending side of the connection, and the output records of its jobs are streamed back as they are written, e.g. "socat - UNIX-CONNECT:SOCKET < jobs.csv". The output and retry data files get the records of all batches. Stop the daemon with SIGTERM or SIGINT.')
 	parser.add_argument('--fast-fail', '-f', action='store_true', dest='fast_fail', help='For debugging only. If set, do not attempt to make connections with ECN when the non-ECN connections times out. Using this switch makes the assumption that there will be no server that allows ECN connections, while allowing non-ECN connections. Also, the information for retries may be inaccurate when this option is used.')
 	
 	args = parser.parse_args(argv)
@@ -608,17 +1428,79 @@ def arguments(argv):
 		raise ValueError('Workers must be a positive integer, it was set to {}.'.format(args.workers))
 	if args.timeout <= 0:
 		raise ValueError('Timeout must be a positive integer, it was set to {}.'.format(args.timeout))
-	if not args.no_tcpdump_check:
+	if not args.no_tcpdump_check and not args.print_filter and args.capture is None:
 		import psutil
 		ps = [p for p in psutil.process_iter() if 'tcpdump' in str(p.name)]
 		if len(ps) == 0:
 			raise Exception('No tcpdump process is running. To skip this check, use "--no-tcpdump-check".')
 	if args.debug_count < 0:
 		raise ValueError('Debug_count must be a positive integer, it was set to {}.'.format(args.debug_count))
+	if args.metrics_port < 0 or args.metrics_port > 65535:
+		raise ValueError('Metrics-port must be a valid TCP port number, it was set to {}.'.format(args.metrics_port))
+	if args.debug_sample < 0:
+		raise ValueError('Debug-sample must be a non-negative integer, it was set to {}.'.format(args.debug_sample))
+	for a in args.source_address:
+		try:
+			socket.inet_pton(socket.AF_INET6 if ':' in a else socket.AF_INET, a)
+		except OSError:
+			raise ValueError('Source-address must be an IPv4 or IPv6 address, it was set to {}.'.format(a))
+	args.port_range = parse_port_range('Port-range', args.port_range)
+	args.eoff_ports = parse_port_range('Eoff-ports', args.eoff_ports)
+	args.eon_ports = parse_port_range('Eon-ports', args.eon_ports)
+	ranges = [p for p in (args.port_range, args.eoff_ports, args.eon_ports) if p is not None]
+	for i, a in enumerate(ranges):
+		for b in ranges[i + 1:]:
+			if a[0] <= b[1] and b[0] <= a[1]:
+				raise ValueError('The port ranges of --port-range, --eoff-ports and --eon-ports must not overlap, {}-{} and {}-{} do.'.format(a[0], a[1], b[0], b[1]))
+	if args.capture_snaplen <= 0:
+		raise ValueError('Capture-snaplen must be a positive integer, it was set to {}.'.format(args.capture_snaplen))
+	if args.rotate_size < 0:
+		raise ValueError('Rotate-size must be a non-negative integer, it was set to {}.'.format(args.rotate_size))
+	if args.rotate_time < 0:
+		raise ValueError('Rotate-time must be a non-negative integer, it was set to {}.'.format(args.rotate_time))
+	if args.request_workers < 0:
+		raise ValueError('Request-workers must be a non-negative integer, it was set to {}.'.format(args.request_workers))
+	if args.triage_timeout <= 0:
+		raise ValueError('Triage-timeout must be a positive float, it was set to {}.'.format(args.triage_timeout))
+	if args.triage_concurrency <= 0:
+		raise ValueError('Triage-concurrency must be a positive integer, it was set to {}.'.format(args.triage_concurrency))
+	if args.triage_batch <= 0:
+		raise ValueError('Triage-batch must be a positive integer, it was set to {}.'.format(args.triage_batch))
+	if args.daemon is None and args.input is None:
+		raise ValueError('The input file is required, unless --daemon is set.')
+	if args.daemon is not None and args.input is not None:
+		raise ValueError('The input file can not be used with --daemon, whose jobs are sent over the socket, it was set to {}.'.format(args.input))
 	
 	return args
 
 
+def without_bogons(records, bogon_filter, drop=True):
+	'''
+	A generator that checks the addresses of input records for bogons.
+	
+	:param records: An iterable of ``Record``.
+	:param bogons.BogonFilter bogon_filter: The bogon prefixes.
+	:param bool drop: If True, bogon addresses are removed from the records. Otherwise, they are kept and a warning is logged.
+	:returns: One ``Record`` on each call to :meth:`next()`.
+	'''
+	logger = logging.getLogger('default')
+	for record in records:
+		ips = [record.ipv4, record.ipv6]
+		for i, ip in enumerate(ips):
+			if ip == '':
+				continue
+			label = bogon_filter.match(ip)
+			if label is None:
+				continue
+			M_BOGONS.inc(labels=(label, ))
+			if drop:
+				logger.info('Skipping %s for "%s", it is a bogon (%s).', ip, record.domain, label)
+				ips[i] = ''
+			else:
+				logger.warning('Testing %s for "%s", although it is a bogon (%s).', ip, record.domain, label)
+		yield record._replace(ipv4=ips[0], ipv6=ips[1])
+
+
 def filler(file_name, queue_):
 	'''
 	Fill a queue with jobs from the input file.
@@ -626,63 +1508,305 @@ def filler(file_name, queue_):
 	:param file_name: Input file with jobs.
 	:param queue_: Job queue to fill.
 	'''
+	with open(file_name) as inf:
+		fill(domain_reader(ARGS.debug_count, inf), queue_)
+
+
+def fill(records, queue_, sink=None):
+	'''
+	Fill a queue with jobs for the addresses of a stream of input records.
+	
+	Bogons and, with ``--unique``, addresses that were already queued are skipped. Every remaining address becomes one job.
+	
+	With ``--triage``, the jobs are collected into batches, and every batch is swept by :meth:`triage` first. Only the reachable jobs of a batch are queued, ordered by their connection setup time, so that dead hosts do not hold up the rounds of the workers.
+	
+	:param records: An iterable of ``Record``.
+	:param queue_: Job queue to fill. It is bounded, so this blocks while the workers are busy.
+	:param sink: If not None, a function that is called with the output record of every job, in addition to writing it to the output file.
+	:returns: The number of jobs created. Every one of them gets an output record.
+	'''
 	logger = logging.getLogger('default')
 	
-	with open(file_name) as inf:
-		reader = domain_reader(ARGS.debug_count, inf)
+	reader = records
+	q = queue_
+	seen = unique.IPSet() if ARGS.unique else None
+	#t0 = datetime.datetime.now()  # Start time of job queue population
+	#tl = t0  # Time since last printed message
+	#c = 0  # Counter of added jobs
+	
+	if ARGS.bogons != 'keep':
+		reader = without_bogons(reader, bogons.load(ARGS.bogon_file), ARGS.bogons == 'drop')
+	
+	if seen is not None:
+		reader = (Record._make(r) for r in unique.unique_records(reader, seen, lambda r: logger.debug('Skipping %s for "%s", already tested for rank %s.', r[2], r[1], r[3])))
+	
+	def put(j):
+		t = TRACER.now()
+		q.put(j)
+		WAKE.set()
+		TRACER.add('queue_put', t)
+	
+	batch = []  # Jobs waiting for the --triage sweep
+	jobs = 0
+	
+	def flush():
+		ordered, dead = triage(batch, ARGS.timeout, ARGS.triage_timeout, ARGS.triage_concurrency)
+		logger.info('Triage: %d of %d addresses passed on to the test, %d unreachable.', len(ordered), len(batch), len(dead))
+		for j, err, pre, post in dead:
+			log_unreachable(j, err, pre, post)
+		for j in ordered:
+			put(j)
+		batch.clear()
+	
+	for job in reader:
+		hot_debug(logger, 'Parsing job %s.', job)
+		if job.ipv4 == '' and job.ipv6 == '':
+			logger.debug('No IP for "%s"', job.domain)
+			continue
+		js = []
+		if job.ipv4 != '':
+			js.append(Job(rank=job.rank, domain=job.domain, ip=job.ipv4, sink=sink))
+		if job.ipv6 != '' and not ARGS.no_ipv6:
+			js.append(Job(rank=job.rank, domain=job.domain, ip='[' + job.ipv6 + ']', sink=sink))
+		jobs += len(js)
+		for j in js:
+			if ARGS.triage:
+				batch.append(j)
+			else:
+				put(j)
+		if len(batch) >= ARGS.triage_batch:
+			flush()
+	
+	if batch:
+		flush()
+	
+	logger.debug('Filler thread ending.')
+	return jobs
+
+
+def batch_records(lines):
+	'''
+	A generator of the input records of a batch submitted to the daemon of ``--daemon``.
+	
+	A batch is either in the format of the input file, one CSV record "rank,domain,ipv4,ipv6" per line, or in JSON lines, one object with the keys "rank", "domain", "ipv4" and "ipv6" per line. The format is taken from the first line that is not empty. Malformed lines are skipped with a warning.
+	
+	:param lines: An iterable of the lines of the batch.
+	:returns: One ``Record`` on each call to :meth:`next()`.
+	'''
+	logger = logging.getLogger('default')
+	lines = (l for l in lines if l.strip() != '')
+	first = next(lines, None)
+	if first is None:
+		return
+	lines = itertools.chain([first], lines)
+	
+	if first.lstrip().startswith('{'):
+		for line in lines:
+			try:
+				o = json.loads(line)
+				yield Record(str(o.get('rank', '')), o['domain'], o.get('ipv4') or '', o.get('ipv6') or '')
+			except (ValueError, KeyError, AttributeError):
+				logger.warning('Skipping malformed line of a batch: %s', line.strip())
+	else:
+		for row in csv.reader(lines):
+			if len(row) != len(Record._fields):
+				logger.warning('Skipping malformed line of a batch: %s', ','.join(row))
+				continue
+			yield Record._make(row)
+
+
+class BatchHandler(socketserver.StreamRequestHandler):
+	'''
+	Handle one connection to the daemon of ``--daemon``: read a batch of jobs until the client shuts down its side of the connection, and stream the output record of every job back as soon as it is written.
+	
+	The records are sent back in the format of the output file, or as JSON objects with the keys of :data:`OUTPUT_FIELDS` if the batch was in JSON lines. The connection is closed once every job of the batch has its record. Jobs with bogon addresses or no address at all get no record.
+	
+	Results are passed from the workers to the handler through a queue, so a slow client never holds up the workers.
+	'''
+	def handle(self):
+		logger = logging.getLogger('default')
+		results = queue.Queue()
+		jobs = [None]  # Number of jobs in the batch, once it has been read completely
+		jsonl = [None]  # Whether the batch is in JSON lines, once its first line has been read
+		
+		def lines():
+			for line in self.rfile:
+				line = line.decode('utf-8', 'replace')
+				if jsonl[0] is None and line.strip() != '':
+					jsonl[0] = line.lstrip().startswith('{')
+				yield line
+		
+		def read():
+			try:
+				jobs[0] = fill(batch_records(lines()), self.server.jobs, results.put)
+			except Exception:
+				logger.exception('Failed to read a batch.')
+			finally:
+				results.put(None)
 		
-		q = queue_
-		#t0 = datetime.datetime.now()  # Start time of job queue population
-		#tl = t0  # Time since last printed message
-		#c = 0  # Counter of added jobs
+		t = threading.Thread(target=read, name='batch', daemon=True)
+		t.start()
 		
-		for job in reader:
-			logger.debug('Parsing job {}.'.format(job))
-			if job.ipv4 == '' and job.ipv6 == '':
-				logger.debug('No IP for "{}"'.format(job.domain))
+		strio = io.StringIO()
+		writer = csv.writer(strio, quoting=csv.QUOTE_MINIMAL)
+		done = 0
+		read_all = False
+		while not read_all or (jobs[0] is not None and done < jobs[0]):
+			try:
+				row = results.get(timeout=1)
+			except queue.Empty:
+				if not RUN:
+					break
+				continue
+			if row is None:
+				read_all = True
 				continue
-			if job.ipv4 != '':
-				j = Job(rank=job.rank, domain=job.domain, ip=job.ipv4)
-				q.put(j)
-			if job.ipv6 != '' and not ARGS.no_ipv6:
-				j = Job(rank=job.rank, domain=job.domain, ip='[' + job.ipv6 + ']')
-				q.put(j)
+			done += 1
+			if jsonl[0]:
+				line = json.dumps(dict(zip(OUTPUT_FIELDS, row)), default=str) + '\n'
+			else:
+				strio.seek(0)
+				strio.truncate()
+				writer.writerow(row)
+				line = strio.getvalue()
+			try:
+				self.wfile.write(line.encode('utf-8'))
+			except OSError:
+				# The client went away, the remaining jobs of the batch are still written to the output file.
+				logger.info('Client went away before the end of its batch.')
+				return
+		
+		logger.info('Finished a batch of %s jobs.', done)
+
+
+def serve(path, queue_):
+	'''
+	Run the daemon of ``--daemon``: accept batches of jobs on a Unix socket, see :class:`BatchHandler`, until SIGTERM or SIGINT is received.
 	
-	logger.debug('Filler thread ending.')
+	Batches that are still being read at that time are cut short.
+	
+	:param str path: The path of the Unix socket. A stale socket file left behind by an earlier daemon is replaced.
+	:param queue_: The job queue.
+	'''
+	logger = logging.getLogger('default')
+	
+	if os.path.exists(path):
+		probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		try:
+			probe.connect(path)
+		except OSError:
+			os.unlink(path)
+		else:
+			raise RuntimeError('Another process is already listening on {}.'.format(path))
+		finally:
+			probe.close()
+	
+	server = socketserver.ThreadingUnixStreamServer(path, BatchHandler)
+	server.daemon_threads = True
+	server.jobs = queue_
+	# The daemon changes the kernel's ECN setting for every batch, so only its user may submit them.
+	os.chmod(path, 0o600)
+	
+	stopping = threading.Event()
+	
+	def on_signal(signum, frame):
+		stopping.set()
+	
+	signal.signal(signal.SIGTERM, on_signal)
+	signal.signal(signal.SIGINT, on_signal)
+	
+	t = threading.Thread(target=server.serve_forever, name='daemon', daemon=True)
+	t.start()
+	logger.info('Accepting batches of jobs on %s.', path)
+	
+	while not stopping.wait(1):
+		pass
+	
+	logger.info('Shutting down the daemon.')
+	server.shutdown()
+	server.server_close()
+	os.unlink(path)
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+	'''
+	A QueueHandler that passes records on unformatted.
+	
+	The standard QueueHandler merges the message and its arguments in the logging thread. As the listener runs in the same process, this is not necessary, and the formatting is left to the handlers in the listener's thread.
+	'''
+	def prepare(self, record):
+		return record
+
+
+def hot_debug(logger, msg, *args):
+	'''
+	Log a debug message from the measurement critical path, subject to sampling.
+	
+	Only every DEBUG_SAMPLE-th call results in a log record. If DEBUG_SAMPLE is 0, no record is produced at all.
+	
+	:param logger: The logger to log with.
+	:param str msg: The message, with %-style placeholders for ``args``.
+	'''
+	if DEBUG_SAMPLE == 0 or not logger.isEnabledFor(logging.DEBUG):
+		return
+	if DEBUG_SAMPLE == 1 or next(_HOT_DEBUG_COUNT) % DEBUG_SAMPLE == 0:
+		logger.debug(msg, *args)
 
 
 def set_up_logging(logfile, verbosity):
 	'''
 	Configure logging.
 	
-	:param file logfile: Filename of logfile.
+	All handlers sit behind a queue, and are run in a separate thread by a ``QueueListener``, so that writing log messages never blocks a worker. Call :meth:`stop_logging` to flush the queue at the end of a run.
+	
+	:param file logfile: Filename of logfile. If None, no logfile is written.
 	:param verbosity verbosity: Stdout logging verbosity.
 	'''
 	#logging.basicConfig(filemode='w')
 	logger = logging.getLogger('default')
-	logger.setLevel(logging.DEBUG)
 	
-	fileHandler = logging.FileHandler(logfile)
-	fileFormatter = logging.Formatter('%(created)f,%(threadName)s,%(levelname)s,%(message)s')
-	fileHandler.setFormatter(fileFormatter)
-	fileHandler.setLevel(logging.DEBUG)
-	logger.addHandler(fileHandler)
+	handlers = []
+	if logfile is not None:
+		fileHandler = logging.FileHandler(logfile)
+		fileFormatter = logging.Formatter('%(created)f,%(threadName)s,%(levelname)s,%(message)s')
+		fileHandler.setFormatter(fileFormatter)
+		fileHandler.setLevel(logging.DEBUG)
+		handlers.append(fileHandler)
 	
 	consoleHandler = logging.StreamHandler(sys.stdout)
 	consoleFormatter = logging.Formatter('%(asctime)s [%(threadName)-10.10s] [%(levelname)-5.5s]  %(message)s')
 	consoleHandler.setFormatter(consoleFormatter)
 	consoleHandler.setLevel(verbosity)
-	logger.addHandler(consoleHandler)
+	handlers.append(consoleHandler)
+	
+	# Without a logfile, records below the console verbosity are dropped by the logger itself, before they are even created.
+	logger.setLevel(logging.DEBUG if logfile is not None else verbosity)
 	
-	logger.debug('All logging handlers: {}.'.format(logger.handlers))
+	# The handlers do their formatting and I/O in the listener's thread, the logging threads only enqueue records.
+	global LOG_LISTENER
+	LOG_LISTENER = logging.handlers.QueueListener(queue.SimpleQueue(), *handlers, respect_handler_level=True)
+	logger.addHandler(LazyQueueHandler(LOG_LISTENER.queue))
+	LOG_LISTENER.start()
+	
+	logger.debug('All logging handlers: %s.', handlers)
 	
 	logger.info('The logging level is set to %s.', logging.getLevelName(logger.getEffectiveLevel()))
 	logger.info('Running Python %s.', platform.python_version())
-	logger.info('ECN: {}.'.format(get_ecn()))
+	logger.info('ECN: %s.', get_ecn())
 	
 	return logger
 
 
+def stop_logging():
+	'''
+	Write out all queued log records, and stop the logging thread.
+	'''
+	global LOG_LISTENER
+	if LOG_LISTENER is not None:
+		LOG_LISTENER.stop()
+		LOG_LISTENER = None
+
+
 def reporter(queue_):
 	'''
 	Periodically report on the length of the job queue.
@@ -718,36 +1842,120 @@ def reporter(queue_):
 		tl = tt
 		
 		# NOTE The last stats might be printed before all jobs were processed, it's a race condition.
-		logger.info('Queue: {q_len:4}, {q_util:5.1f}%. Done: {jobs:6}. Med. job ival: {med:5.2f}s. Rate: now: {cur:6.2f} Hz; avg: {avg:6.2f} Hz. Runtime {rtime}. Sched. retries: {rtry}'.format(q_len=queue_length, q_util=queue_utilization, jobs=completed_jobs, med=med_job_interval, cur=current_rate, avg=average_rate, rtime=runtime, rtry=retries))
+		logger.info('Queue: %4d, %5.1f%%. Done: %6d. Med. job ival: %5.2fs. Rate: now: %6.2f Hz; avg: %6.2f Hz. Runtime %s. Sched. retries: %s', queue_length, queue_utilization, completed_jobs, med_job_interval, current_rate, average_rate, runtime, retries)
 	
 	logger.debug('Reporter thread ending.')
 
 
-def main(argv):
+def log_phase_summary(tracer, runtime):
 	'''
-	Method to be called when run from the command line.
+	Log where the threads spent their time, ranked by total time per phase.
+	
+	:param PhaseTracer tracer: The tracer holding the recorded phases.
+	:param datetime.timedelta runtime: Wall-clock runtime of the test.
 	'''
-	args = arguments(argv)
+	logger = logging.getLogger('default')
+	logger.info('Phase summary over a runtime of %s:', runtime)
+	logger.info('%18s %9s %11s %10s %10s %6s', 'phase', 'count', 'total [s]', 'mean [ms]', 'max [ms]', 'share')
+	for name, c, total, mean, mx, share in tracer.summary():
+		logger.info('%18s %9d %11.2f %10.3f %10.3f %5.1f%%', name, c, total, mean * 1000, mx * 1000, share * 100)
+
+
+def local_port_range():
+	'''
+	Read the kernel's ephemeral port range.
+	
+	:returns: A tuple (first, last), or None if it can not be read.
+	'''
+	try:
+		with open('/proc/sys/net/ipv4/ip_local_port_range') as f:
+			first, last = (int(p) for p in f.read().split())
+	except (OSError, ValueError):
+		return None
+	return (first, last)
+
+
+def capture_filter(args, syn_only=False):
+	'''
+	Build a BPF filter expression for tcpdump that matches the test connections.
+	
+	With ``--eoff-ports`` and ``--eon-ports``, the filter matches exactly the connections of the paired test, and the mode of a flow can be told by its local port alone. Otherwise, it matches all HTTP traffic from the ``--port-range``, or all HTTP traffic.
+	
+	:param args: The return value of :meth:`arguments`.
+	:param bool syn_only: If True, only match SYN and SYN-ACK packets, which carry the ECN negotiation. For IPv6, this assumes that the TCP header follows the IPv6 header directly.
+	:returns: The filter expression.
+	'''
+	ranges = [p for p in (args.eoff_ports, args.eon_ports) if p is not None]
+	if len(ranges) == 0 and args.port_range is not None:
+		ranges = [args.port_range]
+	expr = 'tcp port 80'
+	if ranges:
+		expr = 'tcp and ({})'.format(' or '.join('portrange {}-{}'.format(*p) for p in ranges))
+	if args.source_address:
+		expr += ' and ({})'.format(' or '.join('host ' + a for a in args.source_address))
+	if syn_only:
+		expr += ' and (tcp[tcpflags] & tcp-syn != 0 or (ip6 and ip6[6] == 6 and ip6[53] & 0x02 != 0))'
+	return expr
+
+
+def raise_nofile_limit(needed):
+	'''
+	Make sure that the process may open at least ``needed`` file descriptors, raising the soft limit up to the hard limit if necessary.
 	
+	:returns: The soft limit.
+	:raises: ValueError if the hard limit is too low.
+	'''
+	soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+	if soft != resource.RLIM_INFINITY and soft < needed:
+		if hard != resource.RLIM_INFINITY and hard < needed:
+			raise ValueError('ECN-Spider needs up to {} file descriptors with these settings, but their hard limit is {}. Raise it with "ulimit -Hn", or lower the concurrency.'.format(needed, hard))
+		resource.setrlimit(resource.RLIMIT_NOFILE, (needed, hard))
+		soft = needed
+	return soft
+
+
+def set_up(args):
+	'''
+	Prepare a run: set the module globals from the command-line arguments, and set up logging and the output files.
+	
+	:param args: The return value of :meth:`arguments`.
+	:returns: The default logger.
+	'''
 	global ARGS
 	ARGS = args
 	
+	# Two sockets per job in progress, the sweep of --triage, and some spare for files and the metrics server. With --request-mode immediate, the jobs in progress are bounded by the request slots.
+	needed = 2 * (request_slots(args) if args.request_mode == 'immediate' else args.workers) + 64
+	if args.triage:
+		needed += args.triage_concurrency
+	nofile = raise_nofile_limit(needed)
+	
+	global SOURCES
+	if args.source_address or args.port_range is not None:
+		SOURCES = SourcePool(args.source_address, args.port_range)
+	for mode in ('eoff', 'eon'):
+		ports = getattr(args, mode + '_ports')
+		if ports is not None:
+			MODE_SOURCES[mode] = SourcePool(args.source_address, ports)
+	
 	global count
 	count = SharedCounter()
 	
 	global retry_count
 	retry_count = SharedCounter()
 	
-	# Test that the kernel's ECN-related behavior can be changed
-	# This will raise subprocess.CalledProcessError if there is a problem
-	try:
-		check_ecn()
-	except subprocess.CalledProcessError:
-		print('Error running the necessary commands as root. Make sure that you can execute "sudo /sbin/sysctl -w net.ipv4.tcp_ecn=$MODE" for $MODE = 0, 1 or 2 as the user ECN-Spider runs as.')
-		return 1
-	
 	# Set up logging
-	logger = set_up_logging(args.logfile, args.verbosity)
+	global DEBUG_SAMPLE
+	DEBUG_SAMPLE = args.debug_sample
+	logger = set_up_logging(None if args.no_logfile else args.logfile, args.verbosity)
+	logger.debug('File descriptor limit: %s.', nofile)
+	
+	ephemeral = local_port_range()
+	for option, ports in (('--port-range', args.port_range), ('--eoff-ports', args.eoff_ports), ('--eon-ports', args.eon_ports)):
+		if ports is not None and ephemeral is not None and ports[0] <= ephemeral[1] and ephemeral[0] <= ports[1]:
+			logger.warning('%s %d-%d overlaps the kernel\'s ephemeral port range %d-%d. Other connections may take these ports. Set net.ipv4.ip_local_port_range or net.ipv4.ip_local_reserved_ports to avoid this.', option, ports[0], ports[1], ephemeral[0], ephemeral[1])
+	if args.eoff_ports is not None or args.eon_ports is not None:
+		logger.info('Capture filter for the test connections: %s', capture_filter(args))
 	
 	# FIXME See that everyone can use getLogger instead of having a global instance instead.
 	global DLOGGER
@@ -756,9 +1964,29 @@ def main(argv):
 	global RETRY_LOGGER
 	RETRY_LOGGER = DataLogger(args.retry_data_file)
 	
+	global TRIAGE_LOGGER
+	if args.triage_file is not None:
+		TRIAGE_LOGGER = DataLogger(args.triage_file)
+	
 	global PER
 	PER = BigPer()
 	
+	global TRACER
+	TRACER = PhaseTracer(enabled=args.profile or args.trace is not None, keep_events=args.trace is not None)
+	
+	return logger
+
+
+def start(args, q):
+	'''
+	Start the reporter, the master and the worker threads, which take their jobs from ``q``.
+	
+	:param args: The return value of :meth:`arguments`.
+	:param q: The job queue.
+	:returns: A dictionary of the started thread instances by name.
+	'''
+	logger = logging.getLogger('default')
+	
 	ecn_on = SemaphoreN(args.workers)
 	ecn_on.empty()
 	ecn_on_rdy = SemaphoreN(args.workers)
@@ -777,7 +2005,22 @@ def main(argv):
 	
 	ts = {}  #: Dictionary of thread instances.
 	
-	q = queue.Queue(Q_SIZE)
+	metrics.Gauge('ecnspider_queue_size', 'Number of jobs waiting in the job queue.', function=q.qsize)
+	if args.metrics_port != 0:
+		global METRICS_SERVER
+		METRICS_SERVER = metrics.start_server(args.metrics_port)
+		logger.info('Serving metrics on port %s.', args.metrics_port)
+	
+	global REQUEST_POOL
+	global REQUEST_SLOTS
+	if args.request_mode == 'immediate':
+		REQUEST_POOL = concurrent.futures.ThreadPoolExecutor(args.request_workers or 4 * args.workers, thread_name_prefix='request')
+		REQUEST_SLOTS = threading.BoundedSemaphore(request_slots(args))
+	
+	global CAPTURE
+	if args.capture is not None:
+		CAPTURE = CaptureManager(args.capture, capture_filter(args, syn_only=not args.capture_all), args.capture_interface, args.capture_snaplen, args.rotate_size, args.rotate_time, not args.no_compress, rows=lambda: count.value)
+		CAPTURE.start()
 	
 	global START_TIME
 	START_TIME = datetime.datetime.now()
@@ -786,11 +2029,8 @@ def main(argv):
 	t.start()
 	ts[t.name] = t
 	
-	t = threading.Thread(target=filler, name='filler', args=(args.input, q), daemon=True)
-	t.start()
-	ts[t.name] = t
-	
-	t = threading.Thread(target=master, name='master', args=(args.workers, ecn_on, ecn_on_rdy, ecn_off, ecn_off_rdy), daemon=True)
+	# The daemon parks the test while it has no jobs.
+	t = threading.Thread(target=master, name='master', args=(args.workers, ecn_on, ecn_on_rdy, ecn_off, ecn_off_rdy, q if args.daemon is not None else None), daemon=True)
 	t.start()
 	ts[t.name] = t
 	
@@ -799,19 +2039,85 @@ def main(argv):
 		t.start()
 		ts[t.name] = t
 	
-	# When the filler thread ends, and the queue is empty (both conditions necessary), continue to shutdown.
-	ts['filler'].join()
+	return ts
+
+
+def stop(args, ts, q):
+	'''
+	Finish a run once no more jobs will be added to ``q``: wait for the queued jobs, stop the threads, and write the summaries.
+	
+	:param args: The return value of :meth:`arguments`.
+	:param ts: The dictionary of thread instances returned by :meth:`start`.
+	:param q: The job queue.
+	'''
+	logger = logging.getLogger('default')
+	
 	q.join()
 	
+	global RUN
 	RUN = False
+	WAKE.set()
 	
 	for i in ts.values():
 		i.join()
 	
+	if REQUEST_POOL is not None:
+		REQUEST_POOL.shutdown()
+	
+	if CAPTURE is not None:
+		CAPTURE.stop()
+	
 	logger.info('All done.')
 	
+	if TRACER.enabled:
+		log_phase_summary(TRACER, datetime.datetime.now() - START_TIME)
+	if args.trace is not None:
+		TRACER.write_chrome_trace(args.trace)
+		logger.info('Wrote phase trace to %s.', args.trace)
+	
+	if METRICS_SERVER is not None:
+		METRICS_SERVER.shutdown()
+	
 	set_ecn('on_demand')
 	
+	stop_logging()
+
+
+def main(argv):
+	'''
+	Method to be called when run from the command line.
+	'''
+	args = arguments(argv)
+	
+	if args.print_filter:
+		print(capture_filter(args))
+		return 0
+	
+	# Test that the kernel's ECN-related behavior can be changed
+	# This will raise subprocess.CalledProcessError if there is a problem
+	try:
+		check_ecn()
+	except subprocess.CalledProcessError:
+		print('Error running the necessary commands as root. Make sure that you can execute "sudo /sbin/sysctl -w net.ipv4.tcp_ecn=$MODE" for $MODE = 0, 1 or 2 as the user ECN-Spider runs as.')
+		return 1
+	
+	set_up(args)
+	
+	q = queue.Queue(Q_SIZE)
+	
+	ts = start(args, q)
+	
+	if args.daemon is not None:
+		serve(args.daemon, q)
+	else:
+		t = threading.Thread(target=filler, name='filler', args=(args.input, q), daemon=True)
+		t.start()
+		
+		# When the filler thread ends, and the queue is empty (both conditions necessary), continue to shutdown.
+		t.join()
+	
+	stop(args, ts, q)
+	
 	return 0
 
 
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Fake_DNS: A stand-in DNS server for testing and benchmarking ``resolution.py`` without touching real resolvers.
+
+The server answers every A and AAAA query with a synthetic address derived from a hash of the query name, so the same name always resolves to the same address. The addresses are taken from 10.0.0.0/8 and fd00::/8, which are bogons, so run ``resolution.py`` with ``--bogons keep`` or ``--bogons flag`` against this server. The first label of the name selects special behavior:
+
+``nx...``
+	The answer is NXDOMAIN.
+
+``nodata...``
+	AAAA queries are answered with NOERROR and no records (NODATA).
+
+``fail...``
+	The answer is SERVFAIL.
+
+``www.nowww...``
+	The answer is NXDOMAIN, while the name without "www." resolves. This exercises the fallback of ``--www preferred``.
+
+With ``--records N``, answers hold N records in random order, as load-balanced names do. With ``--providers P``, names are spread over P hosting providers, and each name's records are a fixed selection from the 2N addresses of its provider, so that many names share addresses.
+
+Answers can be delayed by a fixed latency, and a fraction of the queries can be dropped or answered with SERVFAIL, to emulate slow or overloaded upstream resolvers. Delayed answers are scheduled, not slept for, so latency does not limit the throughput of the server.
+
+This file is part of ECN-Spider.
+'''
+
+import sys
+import socket
+import struct
+import hashlib
+import random
+import heapq
+import select
+import time
+import argparse
+
+
+def parse_query(q):
+	'''
+	Extract the query name and type from a DNS query in wire format.
+	
+	:param bytes q: The query.
+	:returns: A tuple (name, query type, offset of the end of the question section).
+	'''
+	i = 12
+	labels = []
+	while q[i] != 0:
+		labels.append(q[i + 1:i + 1 + q[i]].decode('ascii', 'replace'))
+		i += 1 + q[i]
+	qtype = struct.unpack('!H', q[i + 1:i + 3])[0]
+	return ('.'.join(labels).lower(), qtype, i + 5)
+
+
+def _address_hashes(name, records, providers, rng):
+	# The hashes the addresses of the answer for ``name`` are derived from.
+	if records == 1 and providers == 0:
+		return [hashlib.md5(name.encode('ascii', 'replace')).digest()]
+	if providers > 0:
+		h = int.from_bytes(hashlib.md5(name.encode('ascii', 'replace')).digest()[:8], 'big')
+		pool = [hashlib.md5('{}/{}'.format(h % providers, i).encode('ascii')).digest() for i in range(2 * records)]
+		# The same name always gets the same records, only their order changes.
+		hashes = random.Random(h).sample(pool, records)
+		rng.shuffle(hashes)
+		return hashes
+	hashes = [hashlib.md5('{}/{}'.format(name, i).encode('ascii', 'replace')).digest() for i in range(records)]
+	rng.shuffle(hashes)
+	return hashes
+
+
+def make_response(q, ttl=300, servfail=False, records=1, providers=0, rng=random):
+	'''
+	Build the response to a DNS query in wire format.
+	
+	:param bytes q: The query.
+	:param int ttl: TTL of the answer records.
+	:param bool servfail: If True, answer with SERVFAIL.
+	:param int records: Number of records in an answer.
+	:param int providers: If not 0, the number of hosting providers whose addresses the names share.
+	:param rng: Source of randomness for the order of the records.
+	:returns: The response in wire format.
+	'''
+	name, qtype, qend = parse_query(q)
+	labels = name.split('.')
+	first = labels[0]
+	rcode = 0
+	answer = b''
+	n = 0
+	if servfail or first.startswith('fail'):
+		rcode = 2
+	elif first.startswith('nx') or (first == 'www' and len(labels) > 1 and labels[1].startswith('nowww')):
+		rcode = 3
+	elif qtype == 1:
+		hashes = _address_hashes(name, records, providers, rng)
+		answer = b''.join(b'\xc0\x0c' + struct.pack('!HHIH', 1, 1, ttl, 4) + bytes([10]) + h[:3] for h in hashes)
+		n = len(hashes)
+	elif qtype == 28 and not first.startswith('nodata'):
+		hashes = _address_hashes(name, records, providers, rng)
+		answer = b''.join(b'\xc0\x0c' + struct.pack('!HHIH', 28, 1, ttl, 16) + b'\xfd\x00' + h[:14] for h in hashes)
+		n = len(hashes)
+	# QR, RD (copied), RA, and the response code
+	flags = 0x8080 | (struct.unpack('!H', q[2:4])[0] & 0x0100) | rcode
+	return q[:2] + struct.pack('!HHHHH', flags, 1, n, 0, 0) + q[12:qend] + answer
+
+
+def serve(address, port, latency=0.0, loss=0.0, servfail=0.0, ttl=300, seed=None, records=1, providers=0):
+	'''
+	Answer queries until interrupted.
+	
+	:param str address: Address to listen on.
+	:param int port: UDP port to listen on.
+	:param float latency: Delay of every answer in seconds.
+	:param float loss: Fraction of queries that are silently dropped.
+	:param float servfail: Fraction of queries that are answered with SERVFAIL.
+	:param int ttl: TTL of the answer records.
+	:param seed: Seed for the random drops and failures.
+	:param int records: Number of records in an answer.
+	:param int providers: If not 0, the number of hosting providers whose addresses the names share.
+	'''
+	rng = random.Random(seed)
+	family = socket.AF_INET6 if ':' in address else socket.AF_INET
+	s = socket.socket(family, socket.SOCK_DGRAM)
+	s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+	s.bind((address, port))
+	s.setblocking(False)
+	pending = []  # Heap of (due time, sequence number, response, client address)
+	seq = 0
+	while True:
+		timeout = None
+		if pending:
+			timeout = max(0, pending[0][0] - time.monotonic())
+		r, _, _ = select.select([s], [], [], timeout)
+		if r:
+			# Drain everything that has arrived, so a burst is answered in one go.
+			while True:
+				try:
+					q, client = s.recvfrom(4096)
+				except BlockingIOError:
+					break
+				if len(q) < 17 or rng.random() < loss:
+					continue
+				try:
+					resp = make_response(q, ttl, rng.random() < servfail, records, providers, rng)
+				except (IndexError, struct.error):
+					continue
+				if latency > 0:
+					heapq.heappush(pending, (time.monotonic() + latency, seq, resp, client))
+					seq += 1
+				else:
+					s.sendto(resp, client)
+		now = time.monotonic()
+		while pending and pending[0][0] <= now:
+			_, _, resp, client = heapq.heappop(pending)
+			s.sendto(resp, client)
+
+
+def arguments(argv):
+	'''
+	Parse the command-line arguments.
+	
+	:param argv: The command line.
+	:returns: The return value of ``argparse.ArgumentParser.parse_args``.
+	'''
+	parser = argparse.ArgumentParser(description='Fake_DNS: A stand-in DNS server answering A and AAAA queries with synthetic addresses.', epilog='This program is part of ECN-Spider.')
+	
+	parser.add_argument('--address', '-a', type=str, default='127.0.0.1', help='Address to listen on.')
+	parser.add_argument('--port', '-p', type=int, default='5353', help='UDP port to listen on.')
+	parser.add_argument('--latency', '-l', type=float, default='0', help='Delay of every answer in seconds.')
+	parser.add_argument('--loss', type=float, default='0', help='Fraction of queries that are silently dropped.')
+	parser.add_argument('--servfail', type=float, default='0', help='Fraction of queries that are answered with SERVFAIL.')
+	parser.add_argument('--ttl', type=int, default='300', help='TTL of the answer records.')
+	parser.add_argument('--records', type=int, default='1', help='Number of records in an answer, in random order.')
+	parser.add_argument('--providers', type=int, default='0', help='If set, spread the names over N hosting providers, and draw the records of each name from the addresses of its provider.')
+	parser.add_argument('--seed', type=int, default=None, help='Seed for the random drops and failures.')
+	
+	args = parser.parse_args(argv)
+	
+	if args.latency < 0:
+		raise ValueError('Latency must be a non-negative float, it was set to {}.'.format(args.latency))
+	if not 0 <= args.loss <= 1:
+		raise ValueError('Loss must be between 0 and 1, it was set to {}.'.format(args.loss))
+	if args.records <= 0:
+		raise ValueError('Records must be a positive integer, it was set to {}.'.format(args.records))
+	if args.providers < 0:
+		raise ValueError('Providers must be a non-negative integer, it was set to {}.'.format(args.providers))
+	if not 0 <= args.servfail <= 1:
+		raise ValueError('Servfail must be between 0 and 1, it was set to {}.'.format(args.servfail))
+	
+	return args
+
+
+def main(argv):
+	'''
+	Method to be called when run from the command line.
+	'''
+	args = arguments(argv)
+	print('Answering DNS queries on {}#{}.'.format(args.address, args.port))
+	try:
+		serve(args.address, args.port, args.latency, args.loss, args.servfail, args.ttl, args.seed, args.records, args.providers)
+	except KeyboardInterrupt:
+		pass
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
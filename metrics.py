@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Metrics: Lock-light counters, gauges and histograms with a Prometheus-style HTTP endpoint.
+
+Both ``ecn_spider.py`` and ``resolution.py`` record their telemetry into the shared :data:`REGISTRY`. The endpoint is only started when a ``--metrics-port`` is given, recording itself always happens.
+
+Every metric keeps one shard per thread. A thread only ever writes to its own shard, so recording a counter value does not take a lock (apart from once, when a thread records its first value). A scrape sums up copies of all shards. Histograms update several values per observation, so each of their shards has its own lock, which the owning thread and a scrape take: the lock is only contended during a scrape, and the count, sum and buckets of a scrape always agree.
+
+This file is part of ECN-Spider.
+'''
+
+import threading
+import bisect
+import time
+import logging
+from collections import deque
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)  #: Default histogram bucket upper bounds in seconds.
+
+
+class Registry:
+	'''
+	A collection of metrics that are rendered together.
+	'''
+	def __init__(self):
+		self._metrics = {}
+		self._lock = threading.Lock()
+	
+	def register(self, metric):
+		'''
+		Add a metric to the registry. A metric with the same name replaces an existing one.
+		
+		:returns: The metric passed in.
+		'''
+		with self._lock:
+			self._metrics[metric.name] = metric
+		return metric
+	
+	def render(self):
+		'''
+		Render all metrics in the Prometheus text exposition format (version 0.0.4).
+		'''
+		with self._lock:
+			ms = list(self._metrics.values())
+		lines = []
+		for m in ms:
+			lines.append('# HELP {} {}'.format(m.name, m.documentation))
+			lines.append('# TYPE {} {}'.format(m.name, m.kind))
+			lines.extend(m.samples())
+		return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()  #: Registry shared by all ECN-Spider components of one process.
+
+
+def _format_labels(labelnames, labels, extra=None):
+	pairs = list(zip(labelnames, labels))
+	if extra is not None:
+		pairs.append(extra)
+	if len(pairs) == 0:
+		return ''
+	return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in pairs) + '}'
+
+
+def _format_value(value):
+	if value == float('inf'):
+		return '+Inf'
+	return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _ShardedMetric:
+	'''
+	Base class of the metrics that keep one shard of values per thread.
+	'''
+	kind = 'untyped'
+	
+	def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+		self.name = name
+		self.documentation = documentation
+		self.labelnames = tuple(labelnames)
+		self._local = threading.local()
+		self._shards = []
+		self._lock = threading.Lock()
+		if registry is not None:
+			registry.register(self)
+	
+	def _new_shard(self):
+		return {}
+	
+	def _shard(self):
+		try:
+			return self._local.shard
+		except AttributeError:
+			shard = self._new_shard()
+			with self._lock:
+				self._shards.append(shard)
+			self._local.shard = shard
+			return shard
+	
+	def _copies(self):
+		with self._lock:
+			shards = list(self._shards)
+		# dict.copy() is atomic with respect to the thread owning the shard.
+		return [s.copy() for s in shards]
+
+
+class Counter(_ShardedMetric):
+	'''
+	A monotonically increasing counter, optionally with labels.
+	'''
+	kind = 'counter'
+	
+	def inc(self, amount=1, labels=()):
+		'''
+		Increment the counter.
+		
+		:param amount: Increment, must not be negative.
+		:param tuple labels: Label values, in the order of ``labelnames``.
+		'''
+		shard = self._shard()
+		shard[labels] = shard.get(labels, 0) + amount
+	
+	def values(self):
+		'''
+		:returns: A dictionary mapping label value tuples to the current totals.
+		'''
+		totals = {}
+		for shard in self._copies():
+			for k, v in shard.items():
+				totals[k] = totals.get(k, 0) + v
+		return totals
+	
+	@property
+	def value(self):
+		'''
+		The total over all label values.
+		'''
+		return sum(self.values().values())
+	
+	def samples(self):
+		return ['{}{} {}'.format(self.name, _format_labels(self.labelnames, k), _format_value(v)) for k, v in sorted(self.values().items())]
+
+
+class Histogram(_ShardedMetric):
+	'''
+	A histogram with fixed bucket boundaries, optionally with labels.
+	'''
+	kind = 'histogram'
+	
+	def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+		self.buckets = tuple(sorted(buckets))
+		super().__init__(name, documentation, labelnames, registry)
+	
+	def observe(self, value, labels=()):
+		'''
+		Record one observation.
+		
+		:param value: The observed value.
+		:param tuple labels: Label values, in the order of ``labelnames``.
+		'''
+		lock, shard = self._shard()
+		with lock:
+			cell = shard.get(labels)
+			if cell is None:
+				# One slot per bucket, one for +Inf, then the sum of observations.
+				cell = [0] * (len(self.buckets) + 2)
+				shard[labels] = cell
+			cell[bisect.bisect_left(self.buckets, value)] += 1
+			cell[-1] += value
+	
+	def _new_shard(self):
+		return (threading.Lock(), {})
+	
+	def _copies(self):
+		with self._lock:
+			shards = list(self._shards)
+		copies = []
+		for lock, shard in shards:
+			with lock:
+				copies.append({k: list(cell) for k, cell in shard.items()})
+		return copies
+	
+	def values(self):
+		'''
+		:returns: A dictionary mapping label value tuples to a list of per-bucket counts followed by the sum.
+		'''
+		totals = {}
+		for shard in self._copies():
+			for k, cell in shard.items():
+				if k in totals:
+					totals[k] = [a + b for a, b in zip(totals[k], cell)]
+				else:
+					totals[k] = cell
+		return totals
+	
+	def samples(self):
+		lines = []
+		for k, cell in sorted(self.values().items()):
+			cumulative = 0
+			for bound, c in zip(self.buckets + (float('inf'), ), cell):
+				cumulative += c
+				lines.append('{}_bucket{} {}'.format(self.name, _format_labels(self.labelnames, k, ('le', _format_value(float(bound)))), cumulative))
+			lines.append('{}_sum{} {}'.format(self.name, _format_labels(self.labelnames, k), _format_value(cell[-1])))
+			lines.append('{}_count{} {}'.format(self.name, _format_labels(self.labelnames, k), cumulative))
+		return lines
+
+
+class Gauge:
+	'''
+	A gauge whose value is either set explicitly or obtained from a function at scrape time.
+	'''
+	kind = 'gauge'
+	
+	def __init__(self, name, documentation, function=None, registry=REGISTRY):
+		'''
+		:param function: If given, a callable without arguments that returns the current value.
+		'''
+		self.name = name
+		self.documentation = documentation
+		self.labelnames = ()
+		self._function = function
+		self._value = 0
+		if registry is not None:
+			registry.register(self)
+	
+	def set(self, value):
+		''' Set the value of the gauge. '''
+		self._value = value
+	
+	@property
+	def value(self):
+		'''
+		The current value of the gauge.
+		'''
+		if self._function is not None:
+			return self._function()
+		return self._value
+	
+	def samples(self):
+		try:
+			value = self.value
+		except Exception:
+			return []
+		return ['{} {}'.format(self.name, _format_value(value))]
+
+
+class RateGauge(Gauge):
+	'''
+	A gauge reporting the per-second rate of a :class:`Counter` over a sliding window.
+	
+	The counter is sampled whenever the gauge is read. The rate is taken from the newest sample that is at least ``window`` seconds old, or from the oldest sample if there is none, to the current value. So with scrapes more frequent than the window, it is the rate over the last ``window`` seconds.
+	'''
+	def __init__(self, name, documentation, counter, window=60.0, registry=REGISTRY):
+		'''
+		:param Counter counter: The counter whose rate is reported.
+		:param float window: Length of the window in seconds.
+		'''
+		self._counter = counter
+		self.window = window
+		self._samples = deque([(time.monotonic(), counter.value)])
+		self._samples_lock = threading.Lock()
+		super().__init__(name, documentation, function=self._rate, registry=registry)
+	
+	def _rate(self):
+		now = time.monotonic()
+		value = self._counter.value
+		with self._samples_lock:
+			samples = self._samples
+			while len(samples) > 1 and samples[1][0] <= now - self.window:
+				samples.popleft()
+			t0, v0 = samples[0]
+			samples.append((now, value))
+		if now <= t0:
+			return 0.0
+		return (value - v0) / (now - t0)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+
+
+def start_server(port, address='127.0.0.1', registry=REGISTRY):
+	'''
+	Serve the metrics of ``registry`` on ``http://address:port/metrics`` from a daemon thread.
+	
+	:param int port: TCP port to listen on.
+	:param str address: Address to bind to. Defaults to localhost only.
+	:returns: The server instance. Call its :meth:`shutdown` method to stop serving.
+	'''
+	class Handler(BaseHTTPRequestHandler):
+		def do_GET(self):
+			if self.path.split('?')[0] not in ('/', '/metrics'):
+				self.send_error(404)
+				return
+			body = registry.render().encode('utf-8')
+			self.send_response(200)
+			self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+			self.send_header('Content-Length', str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+		
+		def log_message(self, format, *args):
+			logging.getLogger('default').debug('Metrics request from %s: %s', self.address_string(), format % args)
+	
+	server = _ThreadingHTTPServer((address, port), Handler)
+	t = threading.Thread(target=server.serve_forever, name='metrics', daemon=True)
+	t.start()
+	return server
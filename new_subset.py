@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+New_Subset: Select a subset of a ranked list of domains in a single pass.
+
+The subset consists of the first N unique domains of the input, and M unique domains drawn at random from the remainder. The random part is drawn with reservoir sampling, so the input is read only once and only the sample is held in memory (apart from the set of domains seen so far, which is needed to remove duplicates). With ``--strata``, the remainder is split into rank buckets, and an equal share of the M domains is drawn from each bucket.
+
+Domains are cleaned up on the way: surrounding whitespace and a trailing dot are removed, and domains are converted to lower case. Duplicates are detected after clean-up.
+
+The output has the format "rank,domain", as read by ``resolution.py``, and is ordered by rank.
+
+This file is part of ECN-Spider.
+'''
+
+import sys
+import csv
+import random
+import bisect
+import argparse
+
+
+def clean_domain(domain):
+	'''
+	Normalize a domain name.
+	
+	:param str domain: The domain name as read from the input.
+	:returns: The domain in lower case, without surrounding whitespace and without a trailing dot.
+	'''
+	return domain.strip().rstrip('.').lower()
+
+
+def ranked_domains(rows):
+	'''
+	A generator of the unique, cleaned-up domains of a ranked list.
+	
+	:param rows: An iterable of records in the format [rank, domain].
+	:returns: One tuple (rank, domain) for every domain that was not seen before, on each call to :meth:`next()`.
+	'''
+	seen = set()
+	for row in rows:
+		if len(row) < 2:
+			continue
+		domain = clean_domain(row[1])
+		if domain == '' or domain in seen:
+			continue
+		seen.add(domain)
+		yield (row[0].strip(), domain)
+
+
+class Reservoir():
+	'''
+	A uniform random sample of fixed size from a stream of unknown length (Algorithm R).
+	'''
+	def __init__(self, size, rng):
+		'''
+		:param int size: Number of items in the sample.
+		:param random.Random rng: Source of randomness.
+		'''
+		self.size = size
+		self.items = []
+		self._seen = 0
+		self._rng = rng
+	
+	def offer(self, item):
+		'''
+		Present the next item of the stream to the reservoir.
+		'''
+		self._seen += 1
+		if len(self.items) < self.size:
+			self.items.append(item)
+		else:
+			j = self._rng.randrange(self._seen)
+			if j < self.size:
+				self.items[j] = item
+
+
+def subset(rows, n, m, seed=None, strata=None):
+	'''
+	Select the first ``n`` unique domains, and ``m`` unique domains at random from the remainder.
+	
+	:param rows: An iterable of records in the format [rank, domain].
+	:param int n: Number of top domains.
+	:param int m: Number of randomly selected domains.
+	:param seed: Seed of the random number generator. The same seed on the same input yields the same subset.
+	:param strata: A sorted list of rank boundaries. If given, the remainder is split into buckets (0, b1], (b1, b2], ..., (bk, inf), and ``m`` is split evenly between them.
+	:returns: A generator of (rank, domain) tuples, ordered by rank.
+	'''
+	rng = random.Random(seed)
+	strata = sorted(strata) if strata else []
+	buckets = len(strata) + 1
+	reservoirs = [Reservoir(m // buckets + (1 if i < m % buckets else 0), rng) for i in range(buckets)]
+	
+	domains = ranked_domains(rows)
+	top = 0
+	for rank, domain in domains:
+		if top < n:
+			top += 1
+			yield (rank, domain)
+			continue
+		if m == 0:
+			break
+		if buckets == 1:
+			reservoirs[0].offer((rank, domain))
+		else:
+			reservoirs[bisect.bisect_left(strata, _rank_key(rank))].offer((rank, domain))
+	
+	sample = [item for r in reservoirs for item in r.items]
+	sample.sort(key=lambda x: _rank_key(x[0]))
+	for item in sample:
+		yield item
+
+
+def _rank_key(rank):
+	try:
+		return int(rank)
+	except ValueError:
+		return float('inf')
+
+
+def arguments(argv):
+	'''
+	Parse the command-line arguments.
+	
+	:param argv: The command line.
+	:returns: The return value of ``argparse.ArgumentParser.parse_args``.
+	'''
+	parser = argparse.ArgumentParser(description='New_Subset: Select the first N unique domains and M random unique domains from the remainder of a ranked list.', epilog='This program is part of ECN-Spider.')
+	
+	parser.add_argument('n', type=int, help='Number of top domains to select.')
+	parser.add_argument('m', type=int, help='Number of domains to select at random from the remainder.')
+	parser.add_argument('input_file', type=str, help='CSV format input data file with records in the format "rank,domain", such as Alexa\'s top 1M list.')
+	parser.add_argument('output_file', type=str, help='CSV format output data file with records in the format "rank,domain", as read by resolution.py.')
+	
+	parser.add_argument('--seed', type=int, default=None, help='Seed for the random selection. Runs with the same seed on the same input produce the same subset.')
+	parser.add_argument('--strata', type=str, default=None, help='Comma-separated list of rank boundaries, e.g. "1000,10000,100000". The remainder is split into rank buckets at these boundaries, and the M random domains are split evenly between the buckets. A bucket with fewer domains than its share contributes all of its domains.')
+	
+	args = parser.parse_args(argv)
+	
+	if args.n < 0:
+		raise ValueError('N must be a non-negative integer, it was set to {}.'.format(args.n))
+	if args.m < 0:
+		raise ValueError('M must be a non-negative integer, it was set to {}.'.format(args.m))
+	if args.strata is not None:
+		try:
+			args.strata = [int(s) for s in args.strata.split(',')]
+		except ValueError:
+			raise ValueError('Strata must be a comma-separated list of integers, it was set to {}.'.format(args.strata))
+	
+	return args
+
+
+def main(argv):
+	'''
+	Method to be called when run from the command line.
+	'''
+	args = arguments(argv)
+	
+	c = 0
+	with open(args.input_file, newline='') as inf, open(args.output_file, 'w', newline='') as ouf:
+		writer = csv.writer(ouf)
+		for row in subset(csv.reader(inf), args.n, args.m, args.seed, args.strata):
+			writer.writerow(row)
+			c += 1
+	
+	print('Wrote {} domains.'.format(c))
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Pipeline: Resolve, dedupe and test a ranked list of domains in one process, without intermediate files.
+
+Run one after the other, ``resolution.py``, ``unique.py`` and ``ecn_spider.py`` each wait for the previous stage to finish, and pass their results on through files. The pipeline runs the three stages at the same time instead:
+
+1. ``resolution.py``'s engine resolves the domains, and its output records are selected in input order, exactly as ``resolution.py`` writes them.
+2. A dedupe stage removes addresses that were already handed to the spider, as ``unique.py`` does.
+3. The remaining addresses go straight into ``ecn_spider.py``'s job queue.
+
+The stages are connected by bounded queues. When the spider falls behind, the queues fill up and resolution slows down to the pace of the spider, so memory use stays bounded however long the input is. The first connections are made seconds after the start, instead of after all domains are resolved.
+
+The output files of the intermediate stages can still be written with ``--resolved``, ``--deduped`` and ``--dropped``, for provenance.
+
+The positional arguments and all options not listed by ``--help`` are those of ``ecn_spider.py``, except that the input file is a list of domains in the format "rank,domain", as read by ``resolution.py``. Options for the resolution stage are passed in one string with ``--resolution``, e.g. ``--resolution "--engine udp --inflight 500 --www never"``. Bogon addresses are handled by the resolution stage with its ``--bogons`` option, the spider's ``--bogons`` option is ignored.
+
+This file is part of ECN-Spider.
+'''
+
+import sys
+import os
+import csv
+import queue
+import shlex
+import threading
+import argparse
+import subprocess
+
+import ecn_spider
+import resolution
+import unique
+
+Q_SIZE = 100  #: Maximum number of resolved records waiting for the dedupe stage
+
+
+def _drain(q):
+	# The records put into q, until the end marker None.
+	while True:
+		row = q.get()
+		if row is None:
+			return
+		yield row
+
+
+def _tee(rows, writer):
+	# Pass on the records, writing each one with writer.
+	for row in rows:
+		writer.writerow(row)
+		yield row
+
+
+def resolver(args, rq, resolved=None):
+	'''
+	Run the resolution stage: resolve the input domains, and put the output records into ``rq`` in input order, followed by None.
+	
+	:param args: The resolution options, as returned by :meth:`resolution.arguments`.
+	:param rq: The bounded queue of resolved records.
+	:param resolved: If not None, a ``csv.writer`` that also gets every resolved record.
+	'''
+	def sink(row):
+		if resolved is not None:
+			resolved.writerow(row)
+		rq.put(row)
+	
+	start = args.debug_skip
+	stop = start + args.debug_count if args.debug_count > 0 else None
+	try:
+		with open(args.input_file, newline='') as inf:
+			out = resolution.OrderedWriter(None, start, sink=sink)
+			resolution.resolve_records(resolution.read_records(inf, start, stop), out, args)
+	finally:
+		rq.put(None)
+
+
+def deduper(rq, jq, dedupe=True, deduped=None, dropped=None):
+	'''
+	Run the dedupe stage: remove already seen addresses from the resolved records in ``rq``, and fill the spider's job queue ``jq`` with the rest.
+	
+	:param rq: The bounded queue of resolved records.
+	:param jq: The job queue of the spider.
+	:param bool dedupe: If False, pass all addresses on.
+	:param deduped: If not None, a ``csv.writer`` that gets every record handed to the spider.
+	:param dropped: If not None, a function that is called with [rank, domain, ip, kept_rank] for every removed address.
+	'''
+	rows = _drain(rq)
+	if dedupe:
+		rows = unique.unique_records(rows, unique.IPSet(), dropped)
+	if deduped is not None:
+		rows = _tee(rows, deduped)
+	try:
+		ecn_spider.fill((ecn_spider.Record._make(row) for row in rows), jq)
+	except Exception:
+		# Keep the resolution stage from blocking on a full queue.
+		for _ in _drain(rq):
+			pass
+		raise
+
+
+def arguments(argv):
+	'''
+	Parse the command-line arguments.
+	
+	:param argv: The command line.
+	:returns: A tuple of the pipeline options, the spider options as returned by :meth:`ecn_spider.arguments`, and the resolution options as returned by :meth:`resolution.arguments`.
+	'''
+	parser = argparse.ArgumentParser(description='Pipeline: Resolve, dedupe and test a list of domains in one process. All further arguments are passed to ecn_spider.py, whose input file is replaced by a list of domains in the format "rank,domain".', epilog='This program is part of ECN-Spider.')
+	
+	parser.add_argument('--resolution', type=str, default='', help='Options of resolution.py for the resolution stage, in one string. --shard, --checkpoint, --answers, --bogon-report and --metrics-port are not supported, use --metrics-port of ecn_spider.py instead.')
+	parser.add_argument('--resolved', type=str, default=None, help='If set, also write the output of the resolution stage to this file, in the format "rank,domain,ipv4,ipv6" of resolution.py.')
+	parser.add_argument('--deduped', type=str, default=None, help='If set, also write the records handed to the spider to this file, in the format of unique.py\'s output.')
+	parser.add_argument('--dropped', type=str, default=None, help='If set, write a record "rank,domain,ip,kept_rank" for every address removed by the dedupe stage to this file.')
+	parser.add_argument('--no-dedupe', action='store_true', dest='no_dedupe', help='If set, hand all resolved addresses to the spider, even if they appear for several domains.')
+	
+	args, rest = parser.parse_known_args(argv)
+	
+	spider_args = ecn_spider.arguments(rest)
+	# The dedupe stage replaces the --unique option of the spider.
+	spider_args.unique = False
+	# Bogons are handled by the resolution stage, checking them again would count them twice.
+	spider_args.bogons = 'keep'
+	if spider_args.daemon is not None:
+		raise ValueError('The option --daemon is not supported by the pipeline.')
+	
+	resolution_args = resolution.arguments([spider_args.input, os.devnull] + shlex.split(args.resolution))
+	for option in ('shard', 'checkpoint', 'answers', 'bogon_report'):
+		if getattr(resolution_args, option) is not None:
+			raise ValueError('The resolution option --{} is not supported by the pipeline.'.format(option.replace('_', '-')))
+	if resolution_args.metrics_port != 0:
+		raise ValueError('The resolution option --metrics-port is not supported by the pipeline, use --metrics-port of ecn_spider.py instead.')
+	
+	return args, spider_args, resolution_args
+
+
+def main(argv):
+	'''
+	Method to be called when run from the command line.
+	'''
+	args, spider_args, resolution_args = arguments(argv)
+	
+	if spider_args.print_filter:
+		print(ecn_spider.capture_filter(spider_args))
+		return 0
+	
+	try:
+		ecn_spider.check_ecn()
+	except subprocess.CalledProcessError:
+		print('Error running the necessary commands as root. Make sure that you can execute "sudo /sbin/sysctl -w net.ipv4.tcp_ecn=$MODE" for $MODE = 0, 1 or 2 as the user ECN-Spider runs as.')
+		return 1
+	
+	files = []
+	
+	def writer(file_name):
+		if file_name is None:
+			return None
+		f = open(file_name, 'w', newline='')
+		files.append(f)
+		return csv.writer(f)
+	
+	resolved = writer(args.resolved)
+	deduped = writer(args.deduped)
+	dropped = writer(args.dropped)
+	
+	logger = ecn_spider.set_up(spider_args)
+	resolution.configure(resolution_args)
+	
+	rq = queue.Queue(Q_SIZE)
+	jq = queue.Queue(ecn_spider.Q_SIZE)
+	
+	ts = ecn_spider.start(spider_args, jq)
+	
+	rt = threading.Thread(target=resolver, name='resolver', args=(resolution_args, rq, resolved), daemon=True)
+	rt.start()
+	dt = threading.Thread(target=deduper, name='deduper', args=(rq, jq, not args.no_dedupe, deduped, dropped.writerow if dropped is not None else None), daemon=True)
+	dt.start()
+	logger.info('Pipeline started.')
+	
+	rt.join()
+	dt.join()
+	
+	ecn_spider.stop(spider_args, ts, jq)
+	
+	for f in files:
+		f.close()
+	
+	resolution.report()
+	
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
@@ -12,19 +12,930 @@ This file is part of ECN-Spider.
 '''
 
 import sys
+import os
+import json
+import heapq
+import array
 import dns.resolver
+import dns.rdatatype
+import dns.name
+import dns.rcode
+import dns.exception
 import csv
 import queue
+import sqlite3
 import threading
 import datetime
 import argparse
+import asyncio
+import concurrent.futures
+import functools
+import time
+import random
+import socket
+import struct
+from math import ceil
+from collections import OrderedDict
 from time import sleep
 
+import metrics
+import bogons
+import unique
+
 TIMEOUT = None  #: The timeout for DNS resolution.
-SLEEP = None  #: Time to sleep before each resolution, for crude rate-limiting.
+LIMITER = None  #: RateLimiter applied to all queries, or None if the query rate is not limited
 WWW = None  #: The value of the -www command line option
+UPSTREAMS = None  #: UpstreamPool of the nameservers to query
+QUERY_SLOTS = None  #: asyncio.Semaphore limiting the number of outstanding queries of the asyncio engine
+UDP_ENGINE = None  #: UDPQueryEngine instance used by the udp engine
+PLAN = 'concurrent'  #: The value of the --plan command line option
+QUERY_POOL = None  #: concurrent.futures.ThreadPoolExecutor making the queries of the threads engine with --plan concurrent
+RETRY_POOL = None  #: DelayedExecutor scheduling the retries of the threads engine with --plan concurrent
+RETRIES = 3  #: Maximum number of retries of a query that failed with a transient error
+RETRY_BACKOFF = 1.0  #: Delay before the first retry in seconds, it doubles with every further retry
+CACHE = None  #: AnswerCache instance shared by all worker threads, or None if caching is disabled
+BOGONS = None  #: bogons.BogonFilter checking the addresses before output, or None if bogons are kept silently
+BOGON_MODE = 'drop'  #: The value of the --bogons command line option
+BOGON_REPORT = None  #: csv.writer of the --bogon-report file, or None
+SELECT = 'first'  #: The value of the --select command line option
+CHOSEN = unique.IPSet()  #: The addresses chosen for the output so far, used by --select dedupe
+DISK_CACHE = None  #: DiskCache instance shared by all worker threads, or None if there is no persistent cache
+NEGATIVE_TTL = 300  #: Time in seconds to cache NXDOMAIN and NODATA answers, if the response carries no SOA record.
 
 Q_SIZE = 100  #: Maximum domain queue size
+INDEX_STRIDE = 1000  #: Number of input records between two entries of the input index
+
+M_QUERIES = metrics.Counter('resolution_queries_total', 'Number of DNS queries made.', ('qtype', ))
+M_QPS = metrics.RateGauge('resolution_queries_per_second', 'Number of DNS queries per second over the last minute.', M_QUERIES)
+M_ERRORS = metrics.Counter('resolution_errors_total', 'Number of failed DNS queries by error class.', ('qtype', 'error'))
+M_QUERY_TIME = metrics.Histogram('resolution_query_seconds', 'DNS query latency.', ('qtype', ))
+M_DOMAINS = metrics.Counter('resolution_domains_total', 'Number of domains handled.')
+M_UPSTREAM_QUERIES = metrics.Counter('resolution_upstream_queries_total', 'Number of DNS queries by upstream nameserver.', ('upstream', ))
+M_UPSTREAM_FAILURES = metrics.Counter('resolution_upstream_failures_total', 'Number of timeouts and SERVFAILs by upstream nameserver.', ('upstream', 'error'))
+M_EJECTIONS = metrics.Counter('resolution_upstream_ejections_total', 'Number of times an upstream nameserver was ejected from the pool.', ('upstream', ))
+M_RATE_WAIT = metrics.Histogram('resolution_rate_limit_wait_seconds', 'Time queries waited for the rate limiter.')
+M_RETRIES = metrics.Counter('resolution_retries_total', 'Number of queries retried after a transient error.', ('error', ))
+M_RECOVERED = metrics.Counter('resolution_recovered_total', 'Number of queries that succeeded or got a definite answer after being retried.')
+M_FAILED = metrics.Counter('resolution_failed_total', 'Number of queries that failed for good, by error class and error.', ('class', 'error'))
+M_BOGONS = metrics.Counter('resolution_bogons_total', 'Number of bogon addresses in answers, by prefix description.', ('prefix', ))
+M_SELECT = metrics.Counter('resolution_selected_total', 'Number of addresses selected by --select dedupe, by whether the address was already chosen for another domain.', ('result', ))
+M_CACHE = metrics.Counter('resolution_cache_lookups_total', 'Number of answer cache lookups by result.', ('result', ))
+
+
+class AnswerCache:
+	'''
+	A thread-safe LRU cache of DNS answers that honors their TTLs.
+	
+	Besides lists of addresses, the cache also stores the classes of the exceptions signalling NXDOMAIN and NODATA, for negative caching.
+	'''
+	def __init__(self, size):
+		'''
+		:param int size: Maximum number of entries in the cache.
+		'''
+		self._size = size
+		self._d = OrderedDict()
+		self._lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+	
+	def get(self, key):
+		'''
+		Look up an unexpired answer.
+		
+		:param key: A tuple (name, query type).
+		:returns: A list of addresses, an exception class, or None if there is no unexpired entry.
+		'''
+		now = time.monotonic()
+		with self._lock:
+			e = self._d.get(key)
+			if e is not None:
+				if e[0] > now:
+					self._d.move_to_end(key)
+					self.hits += 1
+					M_CACHE.inc(labels=('hit', ))
+					return e[1]
+				del self._d[key]
+			self.misses += 1
+		M_CACHE.inc(labels=('miss', ))
+		return None
+	
+	def put(self, key, value, ttl):
+		'''
+		Store an answer.
+		
+		:param key: A tuple (name, query type).
+		:param value: A list of addresses, or an exception class.
+		:param ttl: Time to live of the entry in seconds.
+		'''
+		if ttl <= 0:
+			return
+		with self._lock:
+			self._d[key] = (time.monotonic() + ttl, value)
+			self._d.move_to_end(key)
+			while len(self._d) > self._size:
+				self._d.popitem(last=False)
+	
+	def __len__(self):
+		return len(self._d)
+
+
+class DiskCache:
+	'''
+	A persistent cache of DNS answers in an SQLite database, to carry answers over from one run to the next.
+	
+	An answer is reused while its TTL has not expired, or while it is at most ``max_age`` seconds old. With a ``max_age`` of a day, a daily re-resolution of the same list only queries the names that were not resolved the day before.
+	
+	Reads go through one connection per thread. The database is in WAL mode, so reads never wait for writes, and several processes can share one database. Writes are queued and committed in batches by a writer thread. Call :meth:`close` to commit the remaining writes.
+	'''
+	_ERRORS = {'NXDOMAIN': dns.resolver.NXDOMAIN, 'NoAnswer': dns.resolver.NoAnswer}  # Negative answers by the name they are stored under.
+	
+	def __init__(self, path, max_age=0, batch=1000, interval=1.0):
+		'''
+		:param str path: The database file. It is created if it does not exist.
+		:param float max_age: Age in seconds up to which an answer is reused even when its TTL has expired.
+		:param int batch: Maximum number of writes per transaction.
+		:param float interval: Maximum time in seconds a write waits in the queue.
+		'''
+		self._path = path
+		self._max_age = max_age
+		self._batch = batch
+		self._interval = interval
+		self._local = threading.local()
+		self._stats_lock = threading.Lock()  # Guards hits and misses, which are counted by all reading threads.
+		self.hits = 0
+		self.misses = 0
+		db = self._connection()
+		db.execute('PRAGMA journal_mode=WAL')
+		db.execute('CREATE TABLE IF NOT EXISTS answers (qname TEXT NOT NULL, qtype TEXT NOT NULL, answer TEXT NOT NULL, error TEXT, expires REAL NOT NULL, last_seen REAL NOT NULL, PRIMARY KEY (qname, qtype)) WITHOUT ROWID')
+		db.commit()
+		self._q = queue.Queue()
+		self._writer = threading.Thread(target=self._write, name='cache_writer', daemon=True)
+		self._writer.start()
+	
+	def _connection(self):
+		try:
+			return self._local.db
+		except AttributeError:
+			db = sqlite3.connect(self._path, timeout=30)
+			db.execute('PRAGMA synchronous=NORMAL')
+			self._local.db = db
+			return db
+	
+	def get(self, key):
+		'''
+		Look up a reusable answer.
+		
+		:param key: A tuple (name, query type).
+		:returns: A tuple (list of addresses or exception class, remaining lifetime in seconds), or None if there is no reusable entry.
+		'''
+		row = self._connection().execute('SELECT answer, error, expires, last_seen FROM answers WHERE qname = ? AND qtype = ?', key).fetchone()
+		now = time.time()
+		if row is not None:
+			answer, error, expires, last_seen = row
+			lifetime = max(expires, last_seen + self._max_age) - now
+			if lifetime > 0:
+				with self._stats_lock:
+					self.hits += 1
+				M_CACHE.inc(labels=('disk_hit', ))
+				if error is not None:
+					return (self._ERRORS[error], lifetime)
+				return (answer.split(' '), lifetime)
+		with self._stats_lock:
+			self.misses += 1
+		M_CACHE.inc(labels=('disk_miss', ))
+		return None
+	
+	def put(self, key, value, ttl):
+		'''
+		Queue an answer to be stored.
+		
+		:param key: A tuple (name, query type).
+		:param value: A list of addresses, or an exception class.
+		:param ttl: Time to live of the answer in seconds.
+		'''
+		now = time.time()
+		if isinstance(value, list):
+			self._q.put((key[0], key[1], ' '.join(value), None, now + ttl, now))
+		else:
+			self._q.put((key[0], key[1], '', value.__name__, now + ttl, now))
+	
+	def _write(self):
+		db = self._connection()
+		done = False
+		while not done:
+			rows = [self._q.get()]
+			deadline = time.monotonic() + self._interval
+			while len(rows) < self._batch:
+				try:
+					rows.append(self._q.get(timeout=max(0, deadline - time.monotonic())))
+				except queue.Empty:
+					break
+			if None in rows:
+				done = True
+				rows = [r for r in rows if r is not None]
+			with db:
+				db.executemany('INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?, ?)', rows)
+	
+	def close(self):
+		'''
+		Commit all queued writes and stop the writer thread.
+		'''
+		self._q.put(None)
+		self._writer.join()
+	
+	def __len__(self):
+		return self._connection().execute('SELECT COUNT(*) FROM answers').fetchone()[0]
+
+
+class TimerWheel:
+	'''
+	A hashed timer wheel: scheduling and expiring a timer is O(1), regardless of the number of pending timers.
+	
+	Timers are not cancelled, the owner of an expired timer has to check whether it is still of interest.
+	'''
+	def __init__(self, tick, slots=512):
+		'''
+		:param float tick: Resolution of the wheel in seconds.
+		:param int slots: Number of slots of the wheel. Timers further than ``tick * slots`` in the future go around the wheel more than once.
+		'''
+		self.tick = tick
+		self._slots = [[] for _ in range(slots)]
+		self._pos = 0
+		self._count = 0
+	
+	def schedule(self, delay, item):
+		'''
+		Schedule ``item`` to expire after ``delay`` seconds, rounded up to the next tick.
+		'''
+		ticks = max(1, int(ceil(delay / self.tick)))
+		n = len(self._slots)
+		self._slots[(self._pos + ticks) % n].append([(ticks - 1) // n, item])
+		self._count += 1
+	
+	def advance(self):
+		'''
+		Advance the wheel by one tick.
+		
+		:returns: A list of the items that expired.
+		'''
+		self._pos = (self._pos + 1) % len(self._slots)
+		slot = self._slots[self._pos]
+		expired = [item for rounds, item in slot if rounds == 0]
+		remaining = []
+		for timer in slot:
+			if timer[0] > 0:
+				timer[0] -= 1
+				remaining.append(timer)
+		self._slots[self._pos] = remaining
+		self._count -= len(expired)
+		return expired
+	
+	def __len__(self):
+		return self._count
+
+
+_QTYPES = {'A': 1, 'AAAA': 28}  #: Numeric values of the supported query types.
+_FAMILIES = {1: socket.AF_INET, 28: socket.AF_INET6}  #: Address family of the records of each query type.
+
+
+def pack_query(qid, name, qtype):
+	'''
+	Build a recursive DNS query in wire format.
+	
+	:param int qid: The query id.
+	:param str name: The query name.
+	:param int qtype: The numeric query type.
+	:returns: The query as bytes.
+	'''
+	labels = name.rstrip('.').split('.')
+	try:
+		qname = b''.join(bytes([len(l)]) + l for l in (l.encode('ascii') for l in labels))
+	except UnicodeEncodeError:
+		qname = b''.join(bytes([len(l)]) + l for l in (l.encode('idna') for l in labels))
+	if any(len(l) == 0 or len(l) > 63 for l in labels) or len(qname) > 254:
+		raise dns.name.NameTooLong() if len(qname) > 254 else dns.name.EmptyLabel()
+	return struct.pack('!HHHHHH', qid, 0x0100, 1, 0, 0, 0) + qname + b'\x00' + struct.pack('!HH', qtype, 1)
+
+
+def _skip_name(data, i):
+	# Return the offset after the (possibly compressed) name starting at i.
+	while True:
+		l = data[i]
+		if l == 0:
+			return i + 1
+		if l & 0xC0 == 0xC0:
+			return i + 2
+		i += l + 1
+
+
+def _read_name(data, i):
+	# Return the (possibly compressed) name starting at i in lower case, without the trailing dot.
+	labels = []
+	for _ in range(128):
+		l = data[i]
+		if l == 0:
+			return b'.'.join(labels).decode('ascii', 'replace').lower()
+		if l & 0xC0 == 0xC0:
+			i = struct.unpack_from('!H', data, i)[0] & 0x3FFF
+		else:
+			labels.append(data[i + 1:i + 1 + l])
+			i += l + 1
+	raise IndexError('Compression loop in name.')
+
+
+def unpack_response(data):
+	'''
+	Parse the parts of a DNS response in wire format that are needed for address resolution.
+	
+	:param bytes data: The response.
+	:returns: A tuple (query id, flags, query name in lower case, query type, list of addresses of the query type, TTL of the answer, negative TTL from the SOA record or None, list of the targets of the CNAME chain in lower case).
+	:raises: IndexError or struct.error if the response is malformed.
+	'''
+	qid, flags, qdcount, ancount, nscount = struct.unpack_from('!HHHHH', data)
+	if qdcount != 1:
+		raise IndexError('Response without question.')
+	i = 12
+	labels = []
+	while data[i] != 0:
+		labels.append(data[i + 1:i + 1 + data[i]])
+		i += data[i] + 1
+	qname = b'.'.join(labels).decode('ascii', 'replace').lower()
+	qtype = struct.unpack_from('!H', data, i + 1)[0]
+	i += 5
+	addresses = []
+	ttl = None
+	aliases = []
+	family = _FAMILIES.get(qtype)
+	for _ in range(ancount):
+		i = _skip_name(data, i)
+		rtype, _, rttl, rdlen = struct.unpack_from('!HHIH', data, i)
+		i += 10
+		# The TTL of an answer is the minimum over the CNAME chain leading to it.
+		ttl = rttl if ttl is None else min(ttl, rttl)
+		if rtype == qtype and family is not None:
+			addresses.append(socket.inet_ntop(family, data[i:i + rdlen]))
+		elif rtype == 5:
+			aliases.append(_read_name(data, i))
+		i += rdlen
+	neg_ttl = None
+	for _ in range(nscount):
+		i = _skip_name(data, i)
+		rtype, _, rttl, rdlen = struct.unpack_from('!HHIH', data, i)
+		i += 10
+		if rtype == 6:
+			# The SOA's minimum field is the last 32 bits of its data.
+			neg_ttl = min(rttl, struct.unpack_from('!I', data, i + rdlen - 4)[0])
+		i += rdlen
+	return (qid, flags, qname, qtype, addresses, ttl, neg_ttl, aliases)
+
+
+def _result(name, qtype, parsed):
+	'''
+	Turn a parsed response into a result, or raise the exception a dnspython resolver would raise.
+	
+	:returns: A tuple (list of addresses, TTL in seconds, list of the targets of the CNAME chain).
+	'''
+	_, flags, _, _, addresses, ttl, neg_ttl, aliases = parsed
+	rcode = flags & 0x000F
+	if rcode == dns.rcode.NXDOMAIN:
+		e = dns.resolver.NXDOMAIN(qnames=[dns.name.from_text(name)])
+	elif rcode != dns.rcode.NOERROR:
+		e = dns.resolver.NoNameservers()
+		e.rcode = rcode
+	elif len(addresses) == 0:
+		e = dns.resolver.NoAnswer()
+	else:
+		return (addresses, ttl, aliases)
+	e.negative_ttl = neg_ttl
+	raise e
+
+
+class _UDPProtocol(asyncio.DatagramProtocol):
+	def __init__(self, engine, index):
+		self._engine = engine
+		self._index = index
+	
+	def datagram_received(self, data, addr):
+		self._engine._received(self._index, data, addr)
+	
+	def error_received(self, exc):
+		pass
+
+
+class UDPQueryEngine:
+	'''
+	Send DNS queries over a small pool of long-lived UDP sockets, and match the responses to the queries by (socket, query id, query name, query type).
+	
+	Compared to dnspython's resolvers, which open one socket per query, this avoids churning through ephemeral ports and file descriptors at high query rates. Queries are packed and responses parsed directly, without building dnspython message objects. Timeouts and retransmissions are driven by a single :class:`TimerWheel`. Truncated responses are repeated over TCP.
+	
+	The exceptions raised are the same as those of dnspython's resolvers, so that callers can treat all engines alike.
+	'''
+	def __init__(self, nameservers, sockets=4, timeout=10, retransmit=1.0, tick=0.05):
+		'''
+		:param nameservers: A list of tuples (address, port) of the nameservers to query. They are used in turn.
+		:param int sockets: Number of UDP sockets.
+		:param float timeout: Time in seconds after which an unanswered query fails.
+		:param float retransmit: Interval in seconds between retransmissions of an unanswered query.
+		:param float tick: Resolution of the timer wheel in seconds.
+		'''
+		self._nameservers = list(nameservers)
+		self._num_sockets = sockets
+		self._timeout = timeout
+		self._retransmit = retransmit
+		self._wheel = TimerWheel(tick)
+		self._transports = {}  # Maps (socket index, address family) to a task creating the transport.
+		self._pending = {}  # Maps (socket index, query id, query name, query type) to [future, wire, destination, deadline, transport].
+		self._next = 0
+		self._ticker = None
+		self._loop = None
+	
+	async def _create_transport(self, index, family):
+		local = ('::', 0) if family == socket.AF_INET6 else ('0.0.0.0', 0)
+		t, _ = await self._loop.create_datagram_endpoint(lambda: _UDPProtocol(self, index), local_addr=local, family=family)
+		try:
+			t.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+		except OSError:
+			pass
+		return t
+	
+	async def _transport(self, index, family):
+		# The creation of a socket is shared by all queries that need it before it is ready.
+		t = self._transports.get((index, family))
+		if t is None:
+			t = asyncio.ensure_future(self._create_transport(index, family))
+			self._transports[(index, family)] = t
+		return await t
+	
+	async def query(self, name, qtype, nameserver=None):
+		'''
+		Query the address records of a name.
+		
+		:param str name: The domain name.
+		:param str qtype: The query type, 'A' or 'AAAA'.
+		:param nameserver: A tuple (address, port) of the nameserver to query. If None, the nameservers passed to the constructor are used in turn.
+		:returns: A tuple (list of addresses, TTL in seconds, list of the targets of the CNAME chain).
+		:throws: Instances of ``dns.exception.DNSException``.
+		'''
+		if self._loop is None:
+			self._loop = asyncio.get_running_loop()
+		i = self._next
+		self._next += 1
+		index = i % self._num_sockets
+		dest = nameserver or self._nameservers[i % len(self._nameservers)]
+		family = socket.AF_INET6 if ':' in dest[0] else socket.AF_INET
+		transport = await self._transport(index, family)
+		
+		rdtype = _QTYPES[qtype]
+		qname = name.rstrip('.').lower()
+		while True:
+			qid = random.getrandbits(16)
+			key = (index, qid, qname, rdtype)
+			if key not in self._pending:
+				break
+		wire = pack_query(qid, name, rdtype)
+		future = self._loop.create_future()
+		entry = [future, wire, dest, time.monotonic() + self._timeout, transport]
+		self._pending[key] = entry
+		try:
+			transport.sendto(wire, dest)
+		except OSError as e:
+			del self._pending[key]
+			raise dns.exception.DNSException('Sending query failed: {}'.format(e))
+		self._wheel.schedule(min(self._retransmit, self._timeout), key)
+		if self._ticker is None:
+			self._ticker = self._loop.call_later(self._wheel.tick, self._tick)
+		try:
+			parsed = await future
+		finally:
+			self._pending.pop(key, None)
+		
+		if parsed[1] & 0x0200:
+			# Truncated, repeat over TCP.
+			try:
+				parsed = await asyncio.wait_for(self._query_tcp(wire, dest, qid, qname, rdtype), max(0.1, entry[3] - time.monotonic()))
+			except asyncio.TimeoutError:
+				raise dns.exception.Timeout()
+		return _result(name, qtype, parsed)
+	
+	async def _query_tcp(self, wire, dest, qid, qname, rdtype):
+		try:
+			reader, writer = await asyncio.open_connection(dest[0], dest[1])
+		except OSError as e:
+			raise dns.exception.DNSException('TCP connection failed: {}'.format(e))
+		try:
+			writer.write(struct.pack('!H', len(wire)) + wire)
+			length = struct.unpack('!H', await reader.readexactly(2))[0]
+			parsed = unpack_response(await reader.readexactly(length))
+		except (OSError, asyncio.IncompleteReadError, IndexError, struct.error) as e:
+			raise dns.exception.DNSException('TCP query failed: {}'.format(e))
+		finally:
+			writer.close()
+		# The same check as for responses over UDP, see _received.
+		if parsed[0] != qid or parsed[2] != qname or parsed[3] != rdtype:
+			raise dns.exception.DNSException('TCP response does not match the query.')
+		return parsed
+	
+	def _received(self, index, data, addr):
+		try:
+			parsed = unpack_response(data)
+		except (IndexError, struct.error, ValueError, OSError):
+			return
+		entry = self._pending.get((index, parsed[0], parsed[2], parsed[3]))
+		if entry is None or entry[0].done() or addr[0] != entry[2][0]:
+			return
+		entry[0].set_result(parsed)
+	
+	def _tick(self):
+		now = time.monotonic()
+		for key in self._wheel.advance():
+			entry = self._pending.get(key)
+			if entry is None or entry[0].done():
+				continue
+			if now >= entry[3]:
+				entry[0].set_exception(dns.exception.Timeout())
+				continue
+			try:
+				entry[4].sendto(entry[1], entry[2])
+			except OSError:
+				pass
+			self._wheel.schedule(min(self._retransmit, entry[3] - now), key)
+		if len(self._wheel) > 0:
+			self._ticker = self._loop.call_later(self._wheel.tick, self._tick)
+		else:
+			self._ticker = None
+	
+	def close(self):
+		'''
+		Close all sockets.
+		'''
+		if self._ticker is not None:
+			self._ticker.cancel()
+			self._ticker = None
+		for t in self._transports.values():
+			if t.done() and t.exception() is None:
+				t.result().close()
+		self._transports = {}
+
+
+class Upstream:
+	'''
+	The state and statistics of one upstream nameserver of an :class:`UpstreamPool`.
+	'''
+	def __init__(self, address, port, latency):
+		self.address = address
+		self.port = port
+		self.resolver = None  # Resolver of the threads or asyncio engine querying only this upstream
+		self.outstanding = 0
+		self.latency = latency  # Exponentially weighted moving average of the query time in seconds
+		self.queries = 0
+		self.failures = 0  # Timeouts and SERVFAILs
+		self.consecutive_failures = 0
+		self.ejections = 0
+		self.ejected_until = 0.0
+	
+	@property
+	def nameserver(self):
+		return (self.address, self.port)
+	
+	def __str__(self):
+		return '{}#{}'.format(self.address, self.port)
+
+
+class UpstreamPool:
+	'''
+	Spread queries across several upstream nameservers.
+	
+	Each query goes to the upstream with the lowest expected waiting time, estimated as (outstanding queries + 1) × average query time. An upstream that fails ``eject_after`` queries in a row, by timing out or answering SERVFAIL, is ejected for ``eject_time`` seconds. After that it is re-admitted, and ejected again if it keeps failing. If all upstreams are ejected, the one to be re-admitted first is used.
+	
+	The pool is thread-safe.
+	'''
+	def __init__(self, nameservers, eject_after=5, eject_time=30.0, penalty=10.0, alpha=0.2, latency=0.05):
+		'''
+		:param nameservers: A list of tuples (address, port).
+		:param int eject_after: Number of consecutive failures after which an upstream is ejected.
+		:param float eject_time: Time in seconds an upstream stays ejected.
+		:param float penalty: Query time in seconds recorded for a failed query, usually the timeout.
+		:param float alpha: Weight of a new sample in the average query time.
+		:param float latency: Initial estimate of the query time in seconds.
+		'''
+		self.upstreams = [Upstream(a, p, latency) for a, p in nameservers]
+		self._eject_after = eject_after
+		self._eject_time = eject_time
+		self._penalty = penalty
+		self._alpha = alpha
+		self._lock = threading.Lock()
+	
+	def acquire(self):
+		'''
+		Select the upstream for the next query, and count the query as outstanding on it.
+		
+		:returns: An :class:`Upstream`. Pass it to :meth:`release` when the query is done.
+		'''
+		now = time.monotonic()
+		with self._lock:
+			admitted = [u for u in self.upstreams if u.ejected_until <= now]
+			if admitted:
+				u = min(admitted, key=lambda u: (u.outstanding + 1) * u.latency)
+			else:
+				u = min(self.upstreams, key=lambda u: u.ejected_until)
+			u.outstanding += 1
+			u.queries += 1
+			return u
+	
+	def release(self, u, elapsed, error=None):
+		'''
+		Record the outcome of a query.
+		
+		:param Upstream u: The upstream returned by :meth:`acquire`.
+		:param float elapsed: The query time in seconds.
+		:param error: The exception raised by the query, if it failed.
+		'''
+		failed = isinstance(error, (dns.exception.Timeout, dns.resolver.NoNameservers))
+		with self._lock:
+			u.outstanding -= 1
+			if failed:
+				# A quick SERVFAIL must not make an upstream look attractive, failures count as a full timeout.
+				elapsed = max(elapsed, self._penalty)
+			u.latency += self._alpha * (elapsed - u.latency)
+			if not failed:
+				u.consecutive_failures = 0
+				return
+			u.failures += 1
+			u.consecutive_failures += 1
+			if u.consecutive_failures >= self._eject_after and u.ejected_until <= time.monotonic():
+				u.ejected_until = time.monotonic() + self._eject_time
+				u.consecutive_failures = 0
+				u.ejections += 1
+				M_EJECTIONS.inc(labels=(str(u), ))
+		M_UPSTREAM_FAILURES.inc(labels=(str(u), type(error).__name__))
+	
+	def report(self):
+		'''
+		:returns: A list of lines with the statistics of every upstream.
+		'''
+		with self._lock:
+			return ['Upstream {u}: {q} queries, {f} failures ({r:.1f}%), average query time {l:.1f} ms, ejected {e} times.'.format(u=u, q=u.queries, f=u.failures, r=100.0 * u.failures / u.queries if u.queries else 0.0, l=1000 * u.latency, e=u.ejections) for u in self.upstreams]
+
+
+class TokenBucket:
+	'''
+	A token bucket: on average ``rate`` events per second are allowed, with bursts of up to ``burst`` events.
+	
+	Tokens are reserved rather than polled for. A caller takes a token right away, possibly driving the bucket into debt, and is told how long to wait until its token is due. Waiting callers are therefore served in the order they arrived, and no capacity is lost to polling intervals.
+	'''
+	def __init__(self, rate, burst=None):
+		'''
+		:param float rate: Tokens per second.
+		:param float burst: Capacity of the bucket. Defaults to a tenth of a second's worth of tokens, but at least one.
+		'''
+		self.rate = rate
+		self.burst = burst if burst is not None else max(1.0, rate / 10)
+		self._tokens = self.burst
+		self._t = time.monotonic()
+		self._lock = threading.Lock()
+	
+	def reserve(self):
+		'''
+		Take one token.
+		
+		:returns: The time in seconds until the token may be used.
+		'''
+		with self._lock:
+			now = time.monotonic()
+			self._tokens = min(self.burst, self._tokens + (now - self._t) * self.rate)
+			self._t = now
+			self._tokens -= 1
+			if self._tokens >= 0:
+				return 0.0
+			return -self._tokens / self.rate
+
+
+class RateLimiter:
+	'''
+	Limit the query rate globally, per upstream nameserver and per zone, each with its own :class:`TokenBucket`. A query waits for its zone's token, then for its upstream's, and then for the global one.
+	
+	The zone of a name is approximated by its last two labels, as zone cuts are not known without further queries. Only the buckets of the ``zones`` most recently seen zones are kept. A zone that has not been seen for a while has a full bucket anyway.
+	'''
+	def __init__(self, qps=0, upstream_qps=0, zone_qps=0, zones=10000):
+		'''
+		:param float qps: Limit of the total number of queries per second. 0 means unlimited.
+		:param float upstream_qps: Limit of the queries per second to each upstream nameserver. 0 means unlimited.
+		:param float zone_qps: Limit of the queries per second for the names in each zone. 0 means unlimited.
+		:param int zones: Number of zone buckets kept.
+		'''
+		self._global = TokenBucket(qps) if qps > 0 else None
+		self._upstream_qps = upstream_qps
+		self._upstreams = {}
+		self._zone_qps = zone_qps
+		self._zones = OrderedDict()
+		self._max_zones = zones
+		self._lock = threading.Lock()
+	
+	def _bucket(self, buckets, key, rate):
+		with self._lock:
+			b = buckets.get(key)
+			if b is None:
+				b = TokenBucket(rate)
+				buckets[key] = b
+				if buckets is self._zones and len(buckets) > self._max_zones:
+					buckets.popitem(last=False)
+			elif buckets is self._zones:
+				buckets.move_to_end(key)
+			return b
+	
+	def _stages(self, name, upstream):
+		# The buckets a query takes a token from, one after the other: the zone's first, as its wait is usually the longest, and the global bucket last, right before the query is sent.
+		buckets = []
+		if self._zone_qps > 0:
+			zone = '.'.join(name.rstrip('.').split('.')[-2:])
+			buckets.append(self._bucket(self._zones, zone, self._zone_qps))
+		if self._upstream_qps > 0:
+			buckets.append(self._bucket(self._upstreams, str(upstream), self._upstream_qps))
+		if self._global is not None:
+			buckets.append(self._global)
+		return buckets
+	
+	def acquire(self, name, upstream):
+		'''
+		Block until a query may be sent.
+		
+		The tokens are taken in stages, and each one only after the wait for the previous one, so that a query held back by its zone does not keep global or upstream capacity busy in the meantime, and the global rate holds at the time the queries are sent.
+		
+		:param str name: The query name.
+		:param upstream: The :class:`Upstream` the query goes to.
+		'''
+		total = 0.0
+		for b in self._stages(name, upstream):
+			wait = b.reserve()
+			if wait > 0:
+				sleep(wait)
+				total += wait
+		M_RATE_WAIT.observe(total)
+	
+	async def acquire_async(self, name, upstream):
+		'''
+		The asyncio equivalent of :meth:`acquire`.
+		'''
+		total = 0.0
+		for b in self._stages(name, upstream):
+			wait = b.reserve()
+			if wait > 0:
+				await asyncio.sleep(wait)
+				total += wait
+		M_RATE_WAIT.observe(total)
+
+
+def negative_ttl(e):
+	'''
+	Determine how long a negative answer may be cached, following RFC 2308: The minimum of the TTL of the SOA record in the response and the SOA's minimum field.
+	
+	:param e: An instance of ``dns.resolver.NXDOMAIN`` or ``dns.resolver.NoAnswer``.
+	:returns: The TTL in seconds, or NEGATIVE_TTL if the response does not carry an SOA record.
+	'''
+	# Exceptions raised by the udp engine carry the TTL from the response.
+	ttl = getattr(e, 'negative_ttl', None)
+	if ttl is not None:
+		return ttl
+	try:
+		if isinstance(e, dns.resolver.NXDOMAIN):
+			responses = list(e.responses().values())
+		else:
+			responses = [e.kwargs['response']]
+		for r in responses:
+			for rrset in r.authority:
+				if rrset.rdtype == dns.rdatatype.SOA:
+					return min(rrset.ttl, rrset[0].minimum)
+	except Exception:
+		pass
+	return NEGATIVE_TTL
+
+
+def parse_nameserver(ns):
+	'''
+	Split a nameserver specification into address and port.
+	
+	:param str ns: An IP address, optionally followed by "#" and a port number, e.g. "127.0.0.1#5353".
+	:returns: A tuple (address, port).
+	'''
+	address, _, port = ns.partition('#')
+	return (address, int(port) if port else 53)
+
+
+def _configure(resolver, timeout, nameservers):
+	resolver.lifetime = timeout
+	if nameservers:
+		resolver.nameservers = [a for a, _ in nameservers]
+		resolver.nameserver_ports = dict(nameservers)
+
+
+def set_up_resolver(timeout, cache_size, nameservers=None, engine='threads', sockets=4, retransmit=1.0, eject_after=5, eject_time=30.0, cache_db=None, max_age=0):
+	'''
+	Create the upstream pool and answer cache shared by all worker threads.
+	
+	The system's resolver configuration is only read once here, instead of once per query.
+	
+	:param timeout: Timeout for DNS resolution.
+	:param int cache_size: Maximum number of cached answers. 0 disables the cache.
+	:param nameservers: A list of tuples (address, port) of the nameservers to use instead of the system's configuration.
+	:param str engine: "threads", "asyncio" or "udp". The asyncio engine requires dnspython 2.0 or later.
+	:param int sockets: Number of UDP sockets of the udp engine.
+	:param float retransmit: Retransmission interval of the udp engine in seconds.
+	:param int eject_after: Number of consecutive failures after which an upstream is ejected from the pool.
+	:param float eject_time: Time in seconds an ejected upstream stays out of the pool.
+	:param str cache_db: The file of the persistent answer cache, or None to not keep answers across runs.
+	:param float max_age: Age in seconds up to which answers from the persistent cache are reused even when their TTL has expired.
+	'''
+	if not nameservers:
+		system = dns.resolver.Resolver()
+		nameservers = [(a, system.nameserver_ports.get(a, system.port)) for a in system.nameservers]
+	
+	global UPSTREAMS
+	UPSTREAMS = UpstreamPool(nameservers, eject_after, eject_time, timeout)
+	
+	if engine == 'udp':
+		global UDP_ENGINE
+		UDP_ENGINE = UDPQueryEngine(nameservers, sockets, timeout, retransmit)
+	else:
+		if engine == 'asyncio':
+			from dns.asyncresolver import Resolver
+		else:
+			Resolver = dns.resolver.Resolver
+		for u in UPSTREAMS.upstreams:
+			u.resolver = Resolver(configure=False)
+			_configure(u.resolver, timeout, [u.nameserver])
+	
+	global CACHE
+	CACHE = AnswerCache(cache_size) if cache_size > 0 else None
+	
+	global DISK_CACHE
+	DISK_CACHE = DiskCache(cache_db, max_age) if cache_db else None
+
+
+def _cached(key, memory=True, disk=True):
+	'''
+	Look up ``key`` in the answer cache, and then in the persistent cache.
+	
+	:param bool memory: Whether to look in the answer cache.
+	:param bool disk: Whether to look in the persistent cache. Its reads block, so the event loop of the asyncio engines leaves them to an executor.
+	:returns: A list of addresses, or None on a cache miss.
+	:throws: The cached exception for a negative answer.
+	'''
+	cached = None
+	if memory and CACHE is not None:
+		cached = CACHE.get(key)
+	if cached is None and disk and DISK_CACHE is not None:
+		entry = DISK_CACHE.get(key)
+		if entry is not None:
+			cached = entry[0]
+			if CACHE is not None:
+				CACHE.put(key, cached, entry[1])
+	if cached is not None:
+		if isinstance(cached, list):
+			return cached
+		raise cached()
+	return None
+
+
+def _addresses(answers):
+	'''
+	:param answers: A ``dns.resolver.Answer``.
+	:returns: A tuple (list of addresses, TTL in seconds, list of the targets of the CNAME chain).
+	'''
+	aliases = [r.target.to_text().rstrip('.').lower() for rrset in answers.response.answer if rrset.rdtype == dns.rdatatype.CNAME for r in rrset]
+	return ([a.to_text() for a in answers], answers.expiration - time.time(), aliases)
+
+
+def _query_done(key, t, addresses=None, ttl=0, aliases=(), error=None):
+	'''
+	Update the metrics and the answer cache with the outcome of one query.
+	
+	A successful answer is also cached under each target of the CNAME chain that led to it, as the targets resolve to the same addresses. Names that share a CNAME target, like www/bare pairs and domains hosted by the same provider, then hit the cache when the target is looked up itself.
+	
+	:param key: A tuple (name, query type).
+	:param t: The value of :func:`time.perf_counter` when the query was started.
+	:param addresses: The list of addresses returned, if the query succeeded.
+	:param ttl: The TTL of ``addresses``.
+	:param aliases: The targets of the CNAME chain of the answer.
+	:param error: The exception raised by the query, if it failed.
+	:returns: ``addresses``.
+	'''
+	query = key[1]
+	M_QUERY_TIME.observe(time.perf_counter() - t, (query, ))
+	if error is not None:
+		M_ERRORS.inc(labels=(query, type(error).__name__))
+		if isinstance(error, (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer)):
+			ttl = negative_ttl(error)
+			if CACHE is not None:
+				CACHE.put(key, type(error), ttl)
+			if DISK_CACHE is not None:
+				DISK_CACHE.put(key, type(error), ttl)
+		return None
+	for k in [key] + [(a, query) for a in aliases]:
+		if CACHE is not None:
+			CACHE.put(k, addresses, ttl)
+		if DISK_CACHE is not None:
+			DISK_CACHE.put(k, addresses, ttl)
+	return addresses
 
 
 def resolve(domain, query='A'):
@@ -36,209 +947,685 @@ def resolve(domain, query='A'):
 	:returns: A list of IP addresses as strings.
 	:throws: Instances of ``dns.exception``
 	'''
-	resolver = dns.resolver.Resolver()
-	resolver.lifetime = TIMEOUT
-	answers = resolver.query(domain, query)
-	l = [a.to_text() for a in answers]
-	return l
+	key = (domain.lower(), query)
+	l = _cached(key)
+	if l is not None:
+		return l
+	
+	M_QUERIES.inc(labels=(query, ))
+	u = UPSTREAMS.acquire()
+	M_UPSTREAM_QUERIES.inc(labels=(str(u), ))
+	if LIMITER is not None:
+		LIMITER.acquire(domain, u)
+	t = time.perf_counter()
+	try:
+		# dnspython 2 renamed query() to resolve(), dnspython3 only has query().
+		lookup = getattr(u.resolver, 'resolve', None) or u.resolver.query
+		answers = lookup(domain, query)
+	except Exception as e:
+		UPSTREAMS.release(u, time.perf_counter() - t, e)
+		_query_done(key, t, error=e)
+		raise
+	UPSTREAMS.release(u, time.perf_counter() - t)
+	return _query_done(key, t, *_addresses(answers))
+
+
+async def resolve_async(domain, query='A'):
+	'''
+	Resolve a domain name to IP address(es), using the asyncio resolver.
+	
+	The queries are made by the UDP_ENGINE, if there is one, and by the asyncio resolver of an upstream otherwise. At most ``--inflight`` queries are outstanding at any time.
+	
+	:param str domain: The domain to be resolved.
+	:param str query: The query type. May be either 'A' or 'AAAA'.
+	:returns: A list of IP addresses as strings.
+	:throws: Instances of ``dns.exception``
+	'''
+	key = (domain.lower(), query)
+	l = _cached(key, disk=False)
+	if l is None and DISK_CACHE is not None:
+		l = await asyncio.get_running_loop().run_in_executor(None, functools.partial(_cached, key, memory=False))
+	if l is not None:
+		return l
+	
+	async with QUERY_SLOTS:
+		M_QUERIES.inc(labels=(query, ))
+		u = UPSTREAMS.acquire()
+		M_UPSTREAM_QUERIES.inc(labels=(str(u), ))
+		t = time.perf_counter()
+		try:
+			if LIMITER is not None:
+				await LIMITER.acquire_async(domain, u)
+				t = time.perf_counter()
+			if UDP_ENGINE is not None:
+				l, ttl, aliases = await UDP_ENGINE.query(domain, query, u.nameserver)
+			else:
+				l, ttl, aliases = _addresses(await u.resolver.resolve(domain, query))
+		except asyncio.CancelledError:
+			UPSTREAMS.release(u, time.perf_counter() - t)
+			raise
+		except Exception as e:
+			UPSTREAMS.release(u, time.perf_counter() - t, e)
+			_query_done(key, t, error=e)
+			raise
+		UPSTREAMS.release(u, time.perf_counter() - t)
+		return _query_done(key, t, l, ttl, aliases)
+
+
+def is_transient(e):
+	'''
+	Classify a failed query.
+	
+	:param e: The exception raised by the query.
+	:returns: True if the failure is transient and the query should be retried, that is on timeouts, SERVFAIL and other upstream failures, and on network errors. False if the failure is permanent, as for NXDOMAIN, NODATA and malformed names.
+	'''
+	return isinstance(e, (dns.exception.Timeout, dns.resolver.NoNameservers)) or type(e) is dns.exception.DNSException
+
+
+def backoff(attempt):
+	'''
+	:param int attempt: Number of the retry, starting at 1.
+	:returns: The delay in seconds before the retry: exponential in ``attempt``, with jitter, so that retries of queries that failed together are spread out.
+	'''
+	return RETRY_BACKOFF * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+
+
+def _failed(key, e, attempts):
+	# Record how a query failed for good. A definite negative answer after a retry also counts as recovered.
+	M_FAILED.inc(labels=('transient' if is_transient(e) else 'permanent', type(e).__name__))
+	if attempts > 0 and not is_transient(e):
+		M_RECOVERED.inc()
+
+
+def _retry(key, e, attempts):
+	'''
+	Decide whether a failed query is retried.
+	
+	:param key: A tuple (name, query type).
+	:param e: The exception raised by the query.
+	:param dict attempts: Maps query keys to the number of retries made so far. It is updated.
+	:returns: The delay in seconds before the retry, or None if the query is not retried.
+	'''
+	n = attempts.get(key, 0)
+	if is_transient(e) and n < RETRIES:
+		attempts[key] = n + 1
+		M_RETRIES.inc(labels=(type(e).__name__, ))
+		return backoff(n + 1)
+	_failed(key, e, n)
+	return None
+
+
+class DelayedExecutor:
+	'''
+	Submit calls to an executor after a delay, without holding a thread while waiting.
+	
+	Pending calls are kept in a heap ordered by due time, a single timer thread hands them over to the executor when they are due.
+	'''
+	def __init__(self, executor):
+		'''
+		:param executor: The ``concurrent.futures.Executor`` that makes the calls.
+		'''
+		self._executor = executor
+		self._heap = []
+		self._seq = 0
+		self._cond = threading.Condition()
+		self._shutdown = False
+		self._thread = threading.Thread(target=self._run, name='retry_timer', daemon=True)
+		self._thread.start()
+	
+	def submit(self, delay, fn, *args):
+		'''
+		Call ``fn(*args)`` on the executor after ``delay`` seconds.
+		
+		:returns: A ``concurrent.futures.Future`` of the call. Cancelling it before it is due drops the call.
+		'''
+		f = concurrent.futures.Future()
+		with self._cond:
+			heapq.heappush(self._heap, (time.monotonic() + delay, self._seq, f, fn, args))
+			self._seq += 1
+			self._cond.notify()
+		return f
+	
+	def _run(self):
+		while True:
+			with self._cond:
+				while not self._shutdown and (len(self._heap) == 0 or self._heap[0][0] > time.monotonic()):
+					self._cond.wait(self._heap[0][0] - time.monotonic() if self._heap else None)
+				if self._shutdown:
+					return
+				_, _, f, fn, args = heapq.heappop(self._heap)
+			if f.set_running_or_notify_cancel():
+				self._executor.submit(fn, *args).add_done_callback(lambda inner, f=f: _chain(inner, f))
+	
+	def shutdown(self):
+		'''
+		Stop the timer thread. Calls that are not due yet are dropped.
+		'''
+		with self._cond:
+			self._shutdown = True
+			self._cond.notify()
+		self._thread.join()
+
+
+def _chain(inner, outer):
+	# Copy the outcome of a finished future to another one.
+	e = inner.exception()
+	if e is not None:
+		outer.set_exception(e)
+	else:
+		outer.set_result(inner.result())
+
+
+async def _resolve_later(delay, domain, query):
+	await asyncio.sleep(delay)
+	return await resolve_async(domain, query)
 
 
 def resolve_both(domain):
 	'''
-	Helper function to handle_domain.
+	Resolve a domain name to both its IPv4 and IPv6 addresses.
+	
+	:returns: A tuple of two lists of addresses. A list consists of one empty string if its resolution failed.
 	'''
-	try:
-		a = resolve(domain)
-	except dns.exception.DNSException:
-		a = ['']
+	return tuple(l if isinstance(l, list) else [''] for l in (_resolve_retrying(domain, query) for query in ('A', 'AAAA')))
+
+
+def _resolve_retrying(domain, query):
+	'''
+	Resolve a domain name, retrying transient failures after a backoff.
 	
-	try:
-		a4 = resolve(domain, 'AAAA')
-	except dns.exception.DNSException:
-		a4 = ['']
+	:returns: A list of addresses, or the ``dns.exception.DNSException`` raised by the last attempt if the resolution failed.
+	'''
+	attempts = {}
+	key = (domain, query)
+	while True:
+		try:
+			l = resolve(domain, query)
+			if attempts:
+				M_RECOVERED.inc()
+			return l
+		except dns.exception.DNSException as e:
+			delay = _retry(key, e, attempts)
+			if delay is None:
+				return e
+			sleep(delay)
+
+
+class InputIndex:
+	'''
+	A sparse index of the byte offsets of the records of an input file, so that reading can start at any record without parsing the records before it.
+	
+	The index is kept in a sidecar file next to the input, and rebuilt when the input has changed. Every record is assumed to take exactly one line, which holds for lists of ranked domains.
+	'''
+	_HEADER = struct.Struct('!QQQQ')  # Input size, input modification time in ns, stride, number of records
 	
-	return (a, a4)
+	def __init__(self, offsets, count, stride):
+		'''
+		:param offsets: The byte offset of every ``stride``-th record, starting with the first.
+		:param int count: Number of records in the input.
+		:param int stride: Number of records between two offsets.
+		'''
+		self.offsets = offsets
+		self.count = count
+		self.stride = stride
+	
+	@classmethod
+	def build(cls, path, stride=INDEX_STRIDE):
+		'''
+		Index an input file by reading it once.
+		'''
+		offsets = array.array('Q')
+		count = 0
+		pos = 0
+		with open(path, 'rb') as f:
+			for line in f:
+				if count % stride == 0:
+					offsets.append(pos)
+				count += 1
+				pos += len(line)
+		return cls(offsets, count, stride)
+	
+	@classmethod
+	def load(cls, path, stride=INDEX_STRIDE):
+		'''
+		Load the index of an input file from its sidecar file ``path + '.idx'``. If there is no up-to-date sidecar file, the index is built and saved. If it can not be saved, e.g. because the directory of the input is read-only, the index is only kept in memory.
+		'''
+		st = os.stat(path)
+		try:
+			with open(path + '.idx', 'rb') as f:
+				size, mtime, st_stride, count = cls._HEADER.unpack(f.read(cls._HEADER.size))
+				if (size, mtime, st_stride) == (st.st_size, st.st_mtime_ns, stride):
+					offsets = array.array('Q')
+					offsets.frombytes(f.read())
+					if len(offsets) == (count + stride - 1) // stride:
+						return cls(offsets, count, stride)
+		except (OSError, struct.error):
+			pass
+		
+		index = cls.build(path, stride)
+		try:
+			with open(path + '.idx', 'wb') as f:
+				f.write(cls._HEADER.pack(st.st_size, st.st_mtime_ns, stride, index.count))
+				f.write(index.offsets.tobytes())
+		except OSError as e:
+			print('Could not save the input index, keeping it in memory: {}'.format(e))
+		return index
 
 
-def csv_gen(skip=0, count=0, *args, **kwargs):
+def read_records(inf, start=0, stop=None, index=None):
 	'''
-	A wrapper around :meth:`csv.reader`, that makes it a generator.
+	A generator of the records of a CSV file in a range.
 	
-	:meth:`csv_gen` does not return entire records, instead it extracts one particular field from a record.
+	:param inf: The input file, opened in text mode.
+	:param int start: Number of the first record to read, starting at 0.
+	:param int stop: Number of the record after the last one to read, or None to read to the end.
+	:param InputIndex index: The index of the input file. If given, reading seeks straight to the block of ``start``, otherwise all records before ``start`` are parsed and skipped.
+	:returns: One tuple (record number, record) on each call to :meth:`next()`.
+	'''
+	pos = 0
+	if index is not None and start > 0:
+		block = min(start // index.stride, len(index.offsets) - 1)
+		inf.seek(index.offsets[block])
+		pos = block * index.stride
+	for row in csv.reader(inf):
+		if stop is not None and pos >= stop:
+			break
+		if pos >= start:
+			yield (pos, row)
+		pos += 1
+
+
+def parse_shard(shard):
+	'''
+	Parse a shard specification.
 	
-	:param \*args: Arguments passed to :meth:`csv.reader`.
-	:param \*\*kwargs: Keyword arguments passed to :meth:`csv.reader`.
-	:returns: One field from each record on each call to :meth:`next()`.
+	:param str shard: A string "k/N", for the k-th of N shards, with 1 <= k <= N.
+	:returns: A tuple (k, N).
 	'''
-	reader = csv.reader(*args, **kwargs)
+	try:
+		k, n = (int(x) for x in shard.split('/'))
+	except ValueError:
+		raise ValueError('Shard must have the format "k/N", it was set to {}.'.format(shard))
+	if not 1 <= k <= n:
+		raise ValueError('Shard must have 1 <= k <= N, it was set to {}.'.format(shard))
+	return (k, n)
+
+
+class OrderedWriter:
+	'''
+	Write the output records of the domains in input order, although their resolution completes out of order, and keep a checkpoint of the progress.
 	
-	# Discard the first entries
-	for _ in range(skip):
-		next(reader)
+	Results that arrive early are held back in a reorder buffer until all records before them have been written. The addresses for the output are selected from the answers at that point, see :meth:`select_address`. The checkpoint therefore always describes a prefix of the input: the number of the next record to resolve, and the length of the output written for the records before it.
+	'''
+	def __init__(self, ouf, start, checkpoint=None, state=None, interval=1000, period=5.0, answers=None, sink=None):
+		'''
+		:param ouf: The output file, or None to pass the output records only to ``sink``.
+		:param answers: A file for the complete answers, or None.
+		:param int start: Number of the first record to be resolved.
+		:param str checkpoint: Checkpoint file, or None to keep no checkpoint.
+		:param dict state: Further values to store in the checkpoint.
+		:param int interval: Number of records after which the checkpoint is updated.
+		:param float period: Time in seconds after which the checkpoint is updated, if records were written in the meantime.
+		:param sink: If not None, a function that is called with every output record, in input order.
+		'''
+		self._ouf = ouf
+		self._writer = csv.writer(ouf) if ouf is not None else None
+		self._sink = sink
+		self._answers = answers
+		self._answers_writer = csv.writer(answers) if answers is not None else None
+		self._next = start
+		self._pending = {}
+		self._checkpoint = checkpoint
+		self._state = dict(state or {})
+		self._interval = interval
+		self._period = period
+		self._since = 0
+		self._saved = time.monotonic()
 	
+	def add(self, seq, rows):
+		'''
+		Hand over the output records of one input record.
+		
+		:param int seq: Number of the input record.
+		:param rows: A list of records [rank, name, IPv4 answer, IPv6 answer] as returned by :meth:`www_decide`, possibly empty.
+		'''
+		self._pending[seq] = rows
+		while self._next in self._pending:
+			for rank, name, a, a4 in self._pending.pop(self._next):
+				if self._answers_writer is not None:
+					self._answers_writer.writerow([rank, name, _joined(a), _joined(a4)])
+				row = [rank, name, select_address(rank, name, a), select_address(rank, name, a4)]
+				if self._writer is not None:
+					self._writer.writerow(row)
+				if self._sink is not None:
+					self._sink(row)
+			self._next += 1
+			self._since += 1
+		if self._checkpoint is not None and self._since > 0 and (self._since >= self._interval or time.monotonic() - self._saved >= self._period):
+			self.save()
+	
+	def save(self):
+		'''
+		Flush the output and update the checkpoint.
+		'''
+		self._since = 0
+		self._saved = time.monotonic()
+		if self._ouf is not None:
+			self._ouf.flush()
+		if self._answers is not None:
+			self._answers.flush()
+		if self._checkpoint is None or self._ouf is None:
+			return
+		os.fsync(self._ouf.fileno())
+		state = dict(self._state, next=self._next, offset=self._ouf.tell())
+		if self._answers is not None:
+			os.fsync(self._answers.fileno())
+			state['answers_offset'] = self._answers.tell()
+		with open(self._checkpoint + '.tmp', 'w') as f:
+			json.dump(state, f)
+		os.replace(self._checkpoint + '.tmp', self._checkpoint)
+
+
+def _rank_key(row):
+	try:
+		return int(row[0])
+	except (ValueError, IndexError):
+		return float('inf')
+
+
+def merge(inputs, writer):
+	'''
+	Merge output files of shards, each ordered by rank, into one output ordered by rank. The inputs are streamed, only one record per input is held in memory.
+	
+	:param inputs: A list of open files.
+	:param writer: A ``csv.writer`` for the merged output.
+	:returns: The number of records written.
+	'''
 	c = 0
-	for row in reader:
-		yield row
+	for row in heapq.merge(*(csv.reader(f) for f in inputs), key=_rank_key):
+		writer.writerow(row)
 		c += 1
-		if c % 1000 == 0:
-			print('Parsed {} records so far.'.format(c))
-		if count != 0 and c >= count:
-			break
+	return c
+
+
+def select_address(rank, name, answer):
+	'''
+	Choose the address of an answer for the output.
+	
+	Bogons are handled first, according to ``--bogons``. With ``--select first``, the first remaining address is chosen. With ``--select dedupe``, an address that was already chosen for an earlier record is preferred, so that domains sharing servers collapse onto one address and are tested only once. Otherwise, the numerically smallest address is chosen, so that the choice does not depend on the order of the records in the answer.
+	
+	Records are selected for in input order, which makes the selection reproducible.
+	
+	:param rank: The rank of the domain, for the bogon report.
+	:param str name: The name that was resolved, for the bogon report.
+	:param answer: A list of addresses, or the exception of a failed resolution.
+	:returns: The chosen address, or '' for failed resolutions and answers without a usable address.
+	'''
+	if not isinstance(answer, list):
+		return ''
+	candidates = []
+	for ip in answer:
+		label = BOGONS.match(ip) if BOGONS is not None else None
+		if label is not None:
+			M_BOGONS.inc(labels=(label, ))
+			if BOGON_REPORT is not None:
+				BOGON_REPORT.writerow([rank, name, ip, label])
+			if BOGON_MODE == 'drop':
+				continue
+		candidates.append(ip)
+	if len(candidates) == 0:
+		return ''
+	if SELECT == 'first':
+		return candidates[0]
+	
+	try:
+		chosen = [ip for ip in candidates if ip in CHOSEN]
+		if chosen:
+			M_SELECT.inc(labels=('reused', ))
+			return min(chosen, key=unique.pack)
+		ip = min(candidates, key=unique.pack)
+	except ValueError:
+		# Malformed addresses can not be compared.
+		return candidates[0]
+	CHOSEN.add(ip, rank)
+	M_SELECT.inc(labels=('new', ))
+	return ip
+
 
+def _joined(answer):
+	# An answer in the format of the --answers file: the addresses separated by spaces, or the name of the exception of a failed resolution.
+	if isinstance(answer, list):
+		return ' '.join(answer)
+	if answer is None:
+		return ''
+	return type(answer).__name__
 
-# def handle_domain(fields):
-# 	'''
-# 	Takes a domain name and resolves it to up to one IPv4 up to one IPv6 address.
+
+def www_decide(rank, domain, results):
+	'''
+	Apply the policy of the ``--www`` option to the answers obtained so far for one domain.
 	
-# 	For deciding whether a resolution was successful (and therefore no fallback must be used for www vs. no-www) only A records are considered.
+	For deciding whether a resolution was successful (and therefore no fallback must be used for www vs. no-www) only A records are considered.
 	
-# 	:param str fields: A list of rank and domain name to be resolved. The rank will not be interpreted, but simply passed on to the output.
-# 	:returns: A list of IP addresses. The list may be empty if errors are encountered during the resolution.
-# 	'''
-# 	sleep(SLEEP)
-# 	rank = fields[0]
-# 	domain = fields[1]
+	:param rank: The rank of the domain. It is not interpreted, but simply passed on to the output.
+	:param str domain: The domain from the input file.
+	:param dict results: Maps tuples (name, query type) to the list of addresses returned, or to the ``dns.exception.DNSException`` raised by the query.
+	:returns: A tuple (rows, needed). ``rows`` is None as long as more answers are required, and otherwise a list of records [rank, domain, IPv4 answer, IPv6 answer]. An answer is a list of addresses, the exception of a failed resolution, or None if the name was not resolved. ``needed`` lists the queries whose answers may still be required, in the order they are needed in.
+	'''
+	# NOTE www.com or www.co.uk would be incorrectly handled by checking for a leading "www." first. Alexa's list generally omits the almost ubiquitous "www.", but not always: www.uk.com is a counter-example.
+	wdomain = 'www.' + domain
 	
-# 	# NOTE www.com or www.co.uk would be incorrectly handled by checking for a leading "www." first. Alexa's list generally omits the almost ubiquitous "www.", but not always: www.uk.com is a counter-example.
-# 	wdomain = domain
-# 	#if domain[:4] != 'www.':
-# 		#wdomain = 'www.' + domain
-# 	wdomain = 'www.' + domain
+	# ``domain`` is the 'original' passed in, and ``wdomain`` is domain with a 'www.' prepended where applicable
 	
-# 	# ``domain`` is the 'original' passed in, and ``wdomain`` is domain with a 'www.' prepended where applicable
+	if WWW == 'never':
+		needed = [(domain, 'A'), (domain, 'AAAA')]
+	elif WWW == 'always':
+		needed = [(wdomain, 'A'), (wdomain, 'AAAA')]
+	elif WWW == 'both':
+		needed = [(domain, 'A'), (domain, 'AAAA'), (wdomain, 'A'), (wdomain, 'AAAA')]
+	elif WWW == 'preferred':
+		wa = results.get((wdomain, 'A'))
+		if wa is None:
+			needed = [(wdomain, 'A'), (wdomain, 'AAAA'), (domain, 'A'), (domain, 'AAAA')]
+		elif isinstance(wa, list):
+			needed = [(wdomain, 'AAAA')]
+			if needed[0] in results:
+				return ([[rank, wdomain, wa, results[needed[0]]]], [])
+			return (None, needed)
+		elif isinstance(wa, dns.exception.Timeout):
+			# Just a timeout, using www is OK.
+			needed = [(wdomain, 'AAAA')]
+			if needed[0] in results:
+				return ([[rank, domain, None, results[needed[0]]]], [])
+			return (None, needed)
+		else:
+			# Resolution failed, falling back.
+			needed = [(domain, 'A'), (domain, 'AAAA')]
+	else:
+		raise ValueError('Illegal value for "WWW" option: {}.'.format(WWW))
 	
-# 	if WWW == 'never':
-# 		(a, a4) = resolve_both(domain)
-# 	elif WWW == 'always':
-# 		(a, a4) = resolve_both(wdomain)
-# 		domain = wdomain
-# 	elif WWW == 'both':
-# 		(a, a4) = resolve_both(domain)
-# 		(aw, a4w) = resolve_both(wdomain)
-		
-# 		if len(a) > 1:
-# 			a = [a[0]]
-# 		if len(a4) > 1:
-# 			a4 = [a4[0]]
-		
-# 		if len(aw) > 1:
-# 			aw = [aw[0]]
-# 		if len(a4w) > 1:
-# 			a4w = [a4w[0]]
-		
-# 		ret = [rank] + [domain] + a + a4
-# 		retw = [rank] + [wdomain] + aw + a4w
-# 		return [ret, retw]
-# 	elif WWW == 'preferred':
-# 		try:
-# 			a = resolve(wdomain)
-# 			try:
-# 				a4 = resolve(wdomain, 'AAAA')
-# 			except dns.exception.DNSException:
-# 				a4 = ['']
-# 			domain = wdomain
-# 		except dns.exception.Timeout:
-# 			# Just a timeout, using www is OK.
-# 			a = ['']
-# 			try:
-# 				a4 = resolve(wdomain, 'AAAA')
-# 			except dns.exception.DNSException:
-# 				a4 = ['']
-# 		except dns.exception.DNSException:
-# 			# Resolution failed, falling back.
-# 			(a, a4) = resolve_both(domain)
-# 	else:
-# 		raise Exception('Illegal value for "WWW." option.')
-	
-# 	# To make the code shorter, at this stage ``domain`` might actually have been assigned the value of ``wdomain``, and so, may have an added 'www.'. It depends on the WWW mode.
-	
-# 	# Keep only the first address of each IP version
-# 	if len(a) > 1:
-# 		a = [a[0]]
-# 	if len(a4) > 1:
-# 		a4 = [a4[0]]
-	
-# 	ret = [rank] + [domain] + a + a4
-# 	return [ret]
+	if not all(k in results for k in needed):
+		return (None, needed)
+	
+	rows = []
+	for i in range(0, len(needed), 2):
+		rows.append([rank, needed[i][0], results[needed[i]], results[needed[i + 1]]])
+	return (rows, [])
+
+
+def handle_domain(rank, domain):
+	'''
+	Resolve a domain to up to one IPv4 and up to one IPv6 address, following the ``--www`` policy.
+	
+	With ``--plan sequential``, the queries are made one after the other, and only as long as their answers are needed. With ``--plan concurrent``, all queries that may be needed are made at once on the QUERY_POOL, the policy is applied whenever an answer arrives, and queries that are no longer needed are cancelled.
+	
+	Queries that fail with a transient error are retried after a backoff, up to RETRIES times. With ``--plan concurrent``, the retries are scheduled on the RETRY_POOL, so waiting for them does not hold a query thread.
+	
+	:returns: A list of records [rank, domain, IPv4 answer, IPv6 answer], as returned by :meth:`www_decide`. If the ``--www`` option is not "never", the domain may have been changed to have a prepended "www.".
+	'''
+	results = {}
+	if PLAN == 'sequential':
+		while True:
+			rows, needed = www_decide(rank, domain, results)
+			if rows is not None:
+				return rows
+			key = next(k for k in needed if k not in results)
+			results[key] = _resolve_retrying(*key)
+	
+	running = {}  # Maps query keys to their futures
+	attempts = {}  # Maps query keys to the number of retries made
+	try:
+		while True:
+			rows, needed = www_decide(rank, domain, results)
+			if rows is not None:
+				return rows
+			for key in needed:
+				if key not in results and key not in running:
+					running[key] = QUERY_POOL.submit(resolve, *key)
+			for key in [k for k in running if k not in needed]:
+				running.pop(key).cancel()
+			done, _ = concurrent.futures.wait(running.values(), return_when=concurrent.futures.FIRST_COMPLETED)
+			for key in [k for k, f in running.items() if f in done]:
+				try:
+					results[key] = running.pop(key).result()
+					if key in attempts:
+						M_RECOVERED.inc()
+				except dns.exception.DNSException as e:
+					delay = _retry(key, e, attempts)
+					if delay is None:
+						results[key] = e
+					else:
+						running[key] = RETRY_POOL.submit(delay, resolve, *key)
+	finally:
+		for f in running.values():
+			f.cancel()
+
+
+def _retrieve(task):
+	if not task.cancelled():
+		task.exception()
+
+
+def _drop(task):
+	# Cancel a task whose result is no longer needed. Its exception is retrieved once it is done, so that asyncio does not report it as never retrieved. That includes a task that finishes with an exception after all, because its query completed before the cancellation took effect.
+	if not task.done():
+		task.cancel()
+	task.add_done_callback(_retrieve)
+
+
+async def handle_domain_async(rank, domain):
+	'''
+	The asyncio equivalent of :meth:`handle_domain`. With ``--plan concurrent``, the queries are made by concurrent tasks.
+	'''
+	results = {}
+	attempts = {}  # Maps query keys to the number of retries made
+	if PLAN == 'sequential':
+		while True:
+			rows, needed = www_decide(rank, domain, results)
+			if rows is not None:
+				return rows
+			key = next(k for k in needed if k not in results)
+			while key not in results:
+				try:
+					results[key] = await resolve_async(*key)
+					if key in attempts:
+						M_RECOVERED.inc()
+				except dns.exception.DNSException as e:
+					delay = _retry(key, e, attempts)
+					if delay is None:
+						results[key] = e
+					else:
+						await asyncio.sleep(delay)
+	
+	running = {}  # Maps query keys to their tasks
+	try:
+		while True:
+			rows, needed = www_decide(rank, domain, results)
+			if rows is not None:
+				return rows
+			for key in needed:
+				if key not in results and key not in running:
+					running[key] = asyncio.ensure_future(resolve_async(*key))
+			for key in [k for k in running if k not in needed]:
+				_drop(running.pop(key))
+			done, _ = await asyncio.wait(running.values(), return_when=asyncio.FIRST_COMPLETED)
+			for key in [k for k, t in running.items() if t in done]:
+				try:
+					results[key] = running.pop(key).result()
+					if key in attempts:
+						M_RECOVERED.inc()
+				except dns.exception.DNSException as e:
+					delay = _retry(key, e, attempts)
+					if delay is None:
+						results[key] = e
+					else:
+						running[key] = asyncio.ensure_future(_resolve_later(delay, *key))
+	finally:
+		for t in running.values():
+			_drop(t)
+
 
 def resolution_worker(iq, oq):
 	while True:
-		entry = iq.get()
+		item = iq.get()
 
-		# Shutdown and cascade
-		if entry is None:
-			print("Input cascading shutdown signal")
-			oq.put(None)
+		# Shutdown
+		if item is None:
 			iq.task_done()
 			break
 
+		seq, entry = item
+		rows = []
 		try:
-			rank = entry[0]
-			domain = entry[1]
-
-			# NOTE www.com or www.co.uk would be incorrectly handled by checking for a leading "www." first. Alexa's list generally omits the almost ubiquitous "www.", but not always: www.uk.com is a counter-example.
-			wdomain = domain
-			#if domain[:4] != 'www.':
-				#wdomain = 'www.' + domain
-			wdomain = 'www.' + domain
-			
-			# ``domain`` is the 'original' passed in, and ``wdomain`` is domain with a 'www.' prepended where applicable
-			
-			if WWW == 'never':
-				(a, a4) = resolve_both(domain)
-			elif WWW == 'always':
-				(a, a4) = resolve_both(wdomain)
-				domain = wdomain
-			elif WWW == 'both':
-				(a, a4) = resolve_both(domain)
-				(aw, a4w) = resolve_both(wdomain)
-				
-				if len(a) > 1:
-					a = [a[0]]
-				if len(a4) > 1:
-					a4 = [a4[0]]
-				
-				if len(aw) > 1:
-					aw = [aw[0]]
-				if len(a4w) > 1:
-					a4w = [a4w[0]]
-				
-				ret = [rank] + [domain] + a + a4
-				retw = [rank] + [wdomain] + aw + a4w
-				return [ret, retw]
-			elif WWW == 'preferred':
-				try:
-					a = resolve(wdomain)
-					try:
-						a4 = resolve(wdomain, 'AAAA')
-					except dns.exception.DNSException:
-						a4 = ['']
-					domain = wdomain
-				except dns.exception.Timeout:
-					# Just a timeout, using www is OK.
-					a = ['']
-					try:
-						a4 = resolve(wdomain, 'AAAA')
-					except dns.exception.DNSException:
-						a4 = ['']
-				except dns.exception.DNSException:
-					# Resolution failed, falling back.
-					(a, a4) = resolve_both(domain)
-			else:
-				print("Internal error: illegal WWW value")
-				sys.exit(1)
-
-			# Keep only the first address of each IP version
-			a = a[0]
-			a4 = a4[0]
-			
-			oq.put((rank, domain, a, a4))
+			rows = handle_domain(entry[0], entry[1])
+			M_DOMAINS.inc()
 		except Exception as e:
-			print("Discarding resolution for "+domain+": "+repr(e))
+			print("Discarding resolution for "+repr(entry)+": "+repr(e))
 		finally:
+			# Also hand over failed records, the output is held back until they are done.
+			oq.put((seq, rows))
 			iq.task_done()
 
-def output_worker(oq, writer):
+
+async def resolve_all_async(reader, out, inflight):
+	'''
+	Resolve all domains from ``reader`` with the asyncio engine, and write the results to ``out``.
+	
+	:param reader: An iterable of tuples (record number, input record [rank, domain]).
+	:param OrderedWriter out: The writer of the output records.
+	:param int inflight: Maximum number of domains being resolved at once.
+	'''
+	global QUERY_SLOTS
+	# A domain has at most four queries outstanding.
+	QUERY_SLOTS = asyncio.Semaphore(4 * inflight)
+	slots = asyncio.Semaphore(inflight)
+	tasks = set()
+	
+	async def one(seq, entry):
+		rows = []
+		try:
+			rows = await handle_domain_async(entry[0], entry[1])
+			M_DOMAINS.inc()
+		except Exception as e:
+			print("Discarding resolution for "+repr(entry)+": "+repr(e))
+		finally:
+			out.add(seq, rows)
+			slots.release()
+	
+	for seq, entry in reader:
+		await slots.acquire()
+		t = asyncio.ensure_future(one(seq, entry))
+		tasks.add(t)
+		t.add_done_callback(tasks.discard)
+	
+	if tasks:
+		await asyncio.wait(tasks)
+	
+	if UDP_ENGINE is not None:
+		UDP_ENGINE.close()
+
+
+def output_worker(oq, out):
 	print("output thread started")
 	while True:
 		entry = oq.get()
@@ -246,9 +1633,119 @@ def output_worker(oq, writer):
 			print("Output handling shutdown signal")
 			oq.task_done()
 			break
-		writer.writerow(entry)
+		out.add(*entry)
 		oq.task_done()
 
+def configure(args):
+	'''
+	Set the module globals from the command-line arguments, and set up the resolver.
+	
+	:param args: The return value of :meth:`arguments`.
+	'''
+	global TIMEOUT
+	TIMEOUT = args.timeout
+	
+	global WWW
+	WWW = args.www
+	
+	global LIMITER
+	if args.qps > 0 or args.upstream_qps > 0 or args.zone_qps > 0:
+		LIMITER = RateLimiter(args.qps, args.upstream_qps, args.zone_qps)
+	
+	global PLAN
+	PLAN = args.plan
+	
+	global RETRIES, RETRY_BACKOFF
+	RETRIES = args.retries
+	RETRY_BACKOFF = args.retry_backoff
+	
+	global SELECT
+	SELECT = args.select
+	
+	global BOGONS, BOGON_MODE
+	BOGON_MODE = args.bogons
+	if args.bogons != 'keep':
+		BOGONS = bogons.load(args.bogon_file)
+	
+	global QUERY_POOL
+	if args.engine == 'threads' and args.plan == 'concurrent':
+		# Up to four queries per domain are made at once.
+		QUERY_POOL = concurrent.futures.ThreadPoolExecutor(4 * args.workers, thread_name_prefix='query')
+		global RETRY_POOL
+		RETRY_POOL = DelayedExecutor(QUERY_POOL)
+	
+	set_up_resolver(args.timeout, args.cache_size, args.nameserver, args.engine, args.sockets, args.retransmit, args.eject_after, args.eject_time, args.cache_db, args.max_age)
+
+
+def resolve_records(reader, out, args):
+	'''
+	Resolve all domains from ``reader`` with the engine selected by ``args``, and hand the results to ``out``. :meth:`configure` must have been called.
+	
+	:param reader: An iterable of tuples (record number, input record [rank, domain]).
+	:param OrderedWriter out: The writer of the output records.
+	:param args: The return value of :meth:`arguments`.
+	'''
+	if args.engine in ('asyncio', 'udp'):
+		print('Resolving with up to {} queries in flight...'.format(args.inflight))
+		asyncio.run(resolve_all_async(reader, out, args.inflight))
+	else:
+		iq = queue.Queue(Q_SIZE)
+		oq = queue.Queue(Q_SIZE)
+		ts = {}
+
+		print('Starting worker threads...')
+		for i in range(args.workers):
+			t = threading.Thread(target=resolution_worker, name='worker_{}'.format(i), args=(iq, oq), daemon=True)
+			t.start()
+			ts[t.name] = t
+
+		print('Starting output thread...')
+		ot = threading.Thread(target=output_worker, name='output_worker', args=(oq, out), daemon=True)
+		ot.start()
+
+		print('Enqueueing domains...')
+
+		for d in reader:
+			iq.put(d)
+
+		# now enqueue one quit signal per worker
+		for _ in range(args.workers):
+			iq.put(None)
+
+		# wait for queues to drain
+		iq.join()
+		oq.put(None)
+		ot.join()
+
+		if QUERY_POOL is not None:
+			RETRY_POOL.shutdown()
+			QUERY_POOL.shutdown()
+
+
+def report():
+	'''
+	Print the statistics of the upstreams, the address selection, bogons, retries and caches, and close the persistent cache.
+	'''
+	for line in UPSTREAMS.report():
+		print(line)
+	if SELECT == 'dedupe':
+		selected = M_SELECT.values()
+		print('Selected {} distinct addresses, reused already selected addresses {} times.'.format(len(CHOSEN), selected.get(('reused', ), 0)))
+	if BOGONS is not None:
+		print('Bogon addresses ({}): {}.'.format('dropped' if BOGON_MODE == 'drop' else 'flagged', ', '.join('{} {}'.format(v, k[0]) for k, v in sorted(M_BOGONS.values().items())) or 'none'))
+	failed = M_FAILED.values()
+	print('Made {retries} retries after transient errors, {recovered} queries recovered. Failed queries: {transient} transient, {permanent} permanent.'.format(retries=M_RETRIES.value, recovered=M_RECOVERED.value, transient=sum(v for k, v in failed.items() if k[0] == 'transient'), permanent=sum(v for k, v in failed.items() if k[0] == 'permanent')))
+	for (cls, error), v in sorted(failed.items()):
+		print('  {} {}: {}'.format(cls, error, v))
+	if CACHE is not None:
+		lookups = CACHE.hits + CACHE.misses
+		print('Answer cache: {hits} hits, {misses} misses ({rate:.1f}% hit rate), {size} entries.'.format(hits=CACHE.hits, misses=CACHE.misses, rate=100.0 * CACHE.hits / lookups if lookups else 0.0, size=len(CACHE)))
+	if DISK_CACHE is not None:
+		DISK_CACHE.close()
+		lookups = DISK_CACHE.hits + DISK_CACHE.misses
+		print('Persistent cache: {hits} hits, {misses} misses ({rate:.1f}% hit rate), {size} entries.'.format(hits=DISK_CACHE.hits, misses=DISK_CACHE.misses, rate=100.0 * DISK_CACHE.hits / lookups if lookups else 0.0, size=len(DISK_CACHE)))
+
+
 def arguments(argv):
 	'''
 	Parse the command-line arguments.
@@ -262,12 +1759,37 @@ def arguments(argv):
 	parser.add_argument('input_file', type=str, help='CSV format input data file with one domain per line. The domain must be in one field of a record, that record is selected with the "position" argument.')
 	parser.add_argument('output_file', type=str, help='CSV format output data file with domain names and associated IP addresses. Each record has the format: "domain,IPv4,IPv6".')
 	
+	parser.add_argument('--engine', default='threads', choices=['threads', 'asyncio', 'udp'], help='Resolution engine. "threads" resolves with --workers threads making blocking queries. "asyncio" resolves up to --inflight domains at once from a single thread, and requires dnspython 2.0 or later. "udp" works like "asyncio", but sends all queries over --sockets long-lived UDP sockets.')
 	parser.add_argument('--workers', '-w', type=int, default='5', help='The number of worker threads used for resolution.')
+	parser.add_argument('--inflight', type=int, default='1000', help='The maximum number of domains being resolved at once by the asyncio and udp engines. Each domain has up to four queries outstanding.')
+	parser.add_argument('--sockets', type=int, default='4', help='The number of UDP sockets of the udp engine.')
+	parser.add_argument('--retransmit', type=float, default='1', help='The interval in seconds between retransmissions of unanswered queries by the udp engine.')
+	parser.add_argument('--plan', default='concurrent', choices=['sequential', 'concurrent'], help='Query planning for each domain. "sequential" makes the A and AAAA queries for the names required by --www one after the other, and only as long as they are needed. "concurrent" makes all queries that may be needed at once, applies the --www policy as soon as enough answers have arrived and cancels the remaining queries. This reduces the time per domain to about one round-trip, at the price of some queries that turn out not to be needed (with --www preferred, the queries for the domain without "www.").')
+	parser.add_argument('--nameserver', action='append', default=None, help='Address of a nameserver to use instead of the ones configured in /etc/resolv.conf, optionally with a port, e.g. "127.0.0.1#5353". May be given multiple times. Queries are spread across the nameservers by their number of outstanding queries and their average query time, and nameservers that keep timing out or failing are taken out of the pool for a while.')
+	parser.add_argument('--retries', type=int, default='3', help='Maximum number of retries of a query that failed with a transient error: a timeout, SERVFAIL or a network error. Queries that fail with NXDOMAIN or NODATA are not retried.')
+	parser.add_argument('--retry-backoff', type=float, default='1', dest='retry_backoff', help='Delay in seconds before the first retry of a query. The delay doubles with every further retry, and is randomized by +/-50%%.')
+	parser.add_argument('--eject-after', type=int, default='5', dest='eject_after', help='Number of consecutive timeouts or SERVFAILs after which a nameserver is taken out of the pool.')
+	parser.add_argument('--eject-time', type=float, default='30', dest='eject_time', help='Time in seconds after which a nameserver that was taken out of the pool is used again.')
 	parser.add_argument('--verbosity', '-v', type=int, default='50', help='Frequency of message output during the resolution phase of the program. A value of N here will print a message for every N processed domains.')
 	parser.add_argument('--timeout', '-t', type=int, default='10', help='Timeout for DNS resolution.')
-	parser.add_argument('--sleep', '-s', type=float, default='0', help='Sleep before every request. Useful for rate-limiting.')
+	parser.add_argument('--qps', type=float, default='0', help='Limit of the total number of DNS queries per second. 0 means unlimited.')
+	parser.add_argument('--upstream-qps', type=float, default='0', dest='upstream_qps', help='Limit of the number of DNS queries per second sent to each nameserver. 0 means unlimited.')
+	parser.add_argument('--zone-qps', type=float, default='0', dest='zone_qps', help='Limit of the number of DNS queries per second for the names in each zone, where the zone is approximated by the last two labels of a name. 0 means unlimited.')
+	parser.add_argument('--sleep', '-s', type=float, default='0', help='Deprecated, use --qps instead. Sleep before every request. It is converted to the equivalent --qps, the number of workers divided by the sleep time.')
 	parser.add_argument('--www', default='preferred', choices=['never', 'preferred', 'always', 'both'], help='Mode for prepending "www." to every domain before resolution. "never" will never prepend "www.". "preferred" will prepend "www." if the resolution of the domain including "www." is successful (more specifically: an A record is returned), and otherwise fall back to omitting the "www.". "always" will prepend "www." and will return no IP address in the output file, even when the domain without "www." can be resolved to one. "both" behaves as "always" and "never" together, that is, it resolves each domain with and without a prepended "www.". All values for this option will never stack the www\'s, that is "www.example.com" will never be expanded to "www.www.example.com". An existing "www." prefix from a domain from the input file will never be dropped. If this value is not "never", then the output file may contain different FQDNs from the input file, as "example.com" might be turned into "www.example.com".')
 	
+	parser.add_argument('--cache-size', type=int, default='100000', dest='cache_size', help='Maximum number of DNS answers kept in the in-memory cache shared by all workers. Answers are cached for their TTL, NXDOMAIN and NODATA answers for the TTL of the SOA record in the response. 0 disables the cache.')
+	parser.add_argument('--select', default='first', choices=['first', 'dedupe'], help='Selection of the one IPv4 and one IPv6 address written for each name, when an answer holds several addresses. "first" selects the first address of the answer, as returned by the nameserver. "dedupe" prefers an address that was already selected for an earlier domain, so that domains hosted on the same servers are tested only once after removing duplicate addresses, and otherwise selects the numerically smallest address. Its results do not depend on the order of the addresses in the answers.')
+	parser.add_argument('--answers', type=str, default=None, help='CSV format output file with the complete answers, in the format "rank,domain,IPv4 addresses,IPv6 addresses". The addresses of an answer are separated by spaces. For failed resolutions, the field holds the error instead, such as "NXDOMAIN".')
+	parser.add_argument('--bogons', default='drop', choices=['drop', 'flag', 'keep'], help='Handling of bogon addresses in answers: private, loopback, link-local, multicast, documentation and other addresses that are not reachable on the public Internet. "drop" uses the next address of the answer that is not a bogon, or none. "flag" keeps the address, but counts it and lists it in the --bogon-report. "keep" does not check addresses.')
+	parser.add_argument('--bogon-file', action='append', default=[], dest='bogon_file', help='File with further bogon prefixes, one per line, optionally followed by a description. May be given multiple times.')
+	parser.add_argument('--bogon-report', type=str, default=None, dest='bogon_report', help='CSV format output file listing every bogon address found, in the format "rank,name,ip,description".')
+	parser.add_argument('--cache-db', type=str, default=None, dest='cache_db', help='SQLite database file of a persistent answer cache, which is kept across runs. Several runs may share one file at the same time.')
+	parser.add_argument('--max-age', type=float, default='0', dest='max_age', help='Age in seconds up to which answers from the persistent cache are reused, even when their TTL has expired. For example, 86400 reuses every answer obtained within the last day. With 0, only unexpired answers are reused.')
+	parser.add_argument('--metrics-port', type=int, default='0', dest='metrics_port', help='If set, serve live counters and histograms in the Prometheus text format on http://127.0.0.1:PORT/metrics.')
+	
+	parser.add_argument('--shard', type=str, default=None, help='Resolve only the k-th of N equal parts of the input, given as "k/N". The output files of all shards can be combined with "resolution.py merge". The input is indexed once, so that each shard starts reading at its first record. The index is kept next to the input file, with the extension ".idx", or only in memory if it can not be written there.')
+	parser.add_argument('--checkpoint', type=str, default=None, help='Checkpoint file. The progress is saved to it regularly. If it exists when the program starts, the interrupted run continues where the checkpoint was saved, and the output file is appended to.')
 	parser.add_argument('--debug-skip', type=int, default='0', dest='debug_skip', help='Skip the first N domains, and do not resolve them.')
 	parser.add_argument('--debug-count', type=int, default='0', dest='debug_count', help='Perform resolution for at most N domains. All of them if this value is set to 0.')
 	
@@ -280,77 +1802,191 @@ def arguments(argv):
 		raise ValueError('Verbosity must be a positive integer, it was set to {}.'.format(args.verbosity))
 	if args.sleep < 0:
 		raise ValueError('Sleep must be a non-negative float, it was set to {}.'.format(args.sleep))
+	if args.qps < 0:
+		raise ValueError('QPS must be a non-negative float, it was set to {}.'.format(args.qps))
+	if args.upstream_qps < 0:
+		raise ValueError('Upstream-qps must be a non-negative float, it was set to {}.'.format(args.upstream_qps))
+	if args.zone_qps < 0:
+		raise ValueError('Zone-qps must be a non-negative float, it was set to {}.'.format(args.zone_qps))
+	if args.sleep > 0 and args.qps == 0:
+		args.qps = args.workers / args.sleep
+		print('--sleep is deprecated, limiting the query rate to --qps {:.2f} instead.'.format(args.qps))
 	if args.timeout <= 0:
 		raise ValueError('Timeout must be a positive integer, it was set to {}.'.format(args.timeout))
 	if args.debug_skip < 0:
 		raise ValueError('Debug-skip must be a non-negative integer, it was set to {}.'.format(args.debug_skip))
 	if args.debug_count < 0:
 		raise ValueError('Debug-count must be a non-negative integer, it was set to {}.'.format(args.debug_count))
+	if args.metrics_port < 0 or args.metrics_port > 65535:
+		raise ValueError('Metrics-port must be a valid TCP port number, it was set to {}.'.format(args.metrics_port))
+	if args.cache_size < 0:
+		raise ValueError('Cache-size must be a non-negative integer, it was set to {}.'.format(args.cache_size))
+	if args.inflight <= 0:
+		raise ValueError('Inflight must be a positive integer, it was set to {}.'.format(args.inflight))
+	if args.sockets <= 0:
+		raise ValueError('Sockets must be a positive integer, it was set to {}.'.format(args.sockets))
+	if args.retransmit <= 0:
+		raise ValueError('Retransmit must be a positive float, it was set to {}.'.format(args.retransmit))
+	if args.max_age < 0:
+		raise ValueError('Max-age must be a non-negative float, it was set to {}.'.format(args.max_age))
+	if args.retries < 0:
+		raise ValueError('Retries must be a non-negative integer, it was set to {}.'.format(args.retries))
+	if args.retry_backoff < 0:
+		raise ValueError('Retry-backoff must be a non-negative float, it was set to {}.'.format(args.retry_backoff))
+	if args.eject_after <= 0:
+		raise ValueError('Eject-after must be a positive integer, it was set to {}.'.format(args.eject_after))
+	if args.eject_time < 0:
+		raise ValueError('Eject-time must be a non-negative float, it was set to {}.'.format(args.eject_time))
+	if args.nameserver is not None:
+		args.nameserver = [parse_nameserver(ns) for ns in args.nameserver]
+	if args.shard is not None:
+		args.shard = parse_shard(args.shard)
 	
 	return args
 
 
+def merge_arguments(argv):
+	'''
+	Parse the command-line arguments of the merge command.
+	
+	:param argv: The command line, without the leading "merge".
+	:returns: The return value of ``argparse.ArgumentParser.parse_args``.
+	'''
+	parser = argparse.ArgumentParser(prog='resolution.py merge', description='Merge the output files of the shards of a resolution into one output file ordered by rank.', epilog='This program is part of ECN-Spider.')
+	
+	parser.add_argument('output_file', type=str, help='CSV format output data file.')
+	parser.add_argument('input_files', type=str, nargs='+', help='CSV format output data files of the shards, as written by resolution.py with --shard.')
+	
+	return parser.parse_args(argv)
+
+
+def merge_main(argv):
+	'''
+	Method to be called for the merge command.
+	'''
+	args = merge_arguments(argv)
+	
+	inputs = [open(f, newline='') for f in args.input_files]
+	try:
+		with open(args.output_file, 'w', newline='') as ouf:
+			c = merge(inputs, csv.writer(ouf))
+	finally:
+		for f in inputs:
+			f.close()
+	
+	print('Merged {} records from {} files.'.format(c, len(inputs)))
+	return 0
+
+
 def main(argv):
 	'''
 	Method to be called when run from the command line.
 	'''
+	if len(argv) > 0 and argv[0] == 'merge':
+		return merge_main(argv[1:])
+	
 	args = arguments(argv)
 	
-	global TIMEOUT
-	TIMEOUT = args.timeout
+	configure(args)
 	
-	global WWW
-	WWW = args.www
+	if args.metrics_port != 0:
+		metrics.start_server(args.metrics_port)
+		print('Serving metrics on port {}.'.format(args.metrics_port))
 	
-	global SLEEP
-	SLEEP = args.sleep
+	dc = 0  # Number of enqueued domains
+	
+	def progress(reader):
+		# Pass on the input records, printing the enqueueing rate every args.verbosity records.
+		nonlocal dc
+		tl = t0  # Time since last printed message
+		for d in reader:
+			yield d
+			dc += 1
+			if dc % args.verbosity == 0:
+				tt = datetime.datetime.now()
+				current_rate = float(args.verbosity) / (tt - tl).total_seconds()
+				average_rate = float(dc) / (tt - t0).total_seconds()
+				tl = tt
+				print('Enqueued {num_dom:>6} domains. Rate: {cur:9.2f} Hz. Average rate: {avg:9.2f} Hz.'.format(num_dom=dc, cur=current_rate, avg=average_rate))
 	
-	with open(args.input_file) as inf, open(args.output_file, 'w', newline='') as ouf:
+	# Determine the range of input records to resolve.
+	index = None
+	if args.shard is not None:
+		# Only sharding needs the number of records up front. Otherwise, the records before the start are skipped by reading them, and nothing is written next to the input.
+		index = InputIndex.load(args.input_file)
+	start = 0
+	stop = None
+	if args.shard is not None:
+		k, n = args.shard
+		start = index.count * (k - 1) // n
+		stop = index.count * k // n
+		print('Shard {}/{}: records {} to {}.'.format(k, n, start, stop - 1))
+	start += args.debug_skip
+	if args.debug_count > 0:
+		stop = start + args.debug_count if stop is None else min(stop, start + args.debug_count)
+	
+	state = {'input': os.path.abspath(args.input_file), 'records': index.count if index is not None else None, 'start': start, 'stop': stop}
+	offset = None
+	if args.checkpoint is not None and os.path.exists(args.checkpoint):
+		with open(args.checkpoint) as f:
+			saved = json.load(f)
+		if any(saved.get(k) != v for k, v in state.items()):
+			raise ValueError('Checkpoint {} belongs to a different input or record range.'.format(args.checkpoint))
+		start = saved['next']
+		offset = saved['offset']
+		answers_offset = saved.get('answers_offset')
+		if (args.answers is None) != (answers_offset is None):
+			raise ValueError('Checkpoint {} was saved {} --answers.'.format(args.checkpoint, 'without' if answers_offset is None else 'with'))
+		print('Resuming from checkpoint at record {}.'.format(start))
+	
+	global BOGON_REPORT
+	bogon_file = None
+	if args.bogon_report is not None:
+		bogon_file = open(args.bogon_report, 'w' if offset is None else 'a', newline='')
+		BOGON_REPORT = csv.writer(bogon_file)
+	
+	answers = None
+	if args.answers is not None:
+		answers = open(args.answers, 'w' if offset is None else 'r+', newline='')
+		if offset is not None:
+			answers.seek(answers_offset)
+			answers.truncate()
+	
+	with open(args.input_file, newline='') as inf, open(args.output_file, 'w' if offset is None else 'r+', newline='') as ouf:
+		if offset is not None:
+			# Drop the output written after the checkpoint was saved.
+			ouf.truncate(offset)
+			if args.select == 'dedupe':
+				# Restore the addresses chosen before the interruption.
+				ouf.seek(0)
+				for row in csv.reader(ouf):
+					for ip in row[2:4]:
+						if ip != '':
+							CHOSEN.add(ip, row[0])
+			ouf.seek(offset)
 		print('Opening input file.')
-		reader = csv_gen(args.debug_skip, args.debug_count, inf)
+		reader = read_records(inf, start, stop, index)
 		print('Opening output file.')
-		writer = csv.writer(ouf)
+		out = OrderedWriter(ouf, start, args.checkpoint, state, answers=answers)
 		
 		t0 = datetime.datetime.now()  # Start time of resolution
-		tl = t0  # Time since last printed message
 		
-		iq = queue.Queue(Q_SIZE)
-		oq = queue.Queue(Q_SIZE)
-		ts = {}
-
-		print('Starting worker threads...')
-		for i in range(args.workers):
-			t = threading.Thread(target=resolution_worker, name='worker_{}'.format(i), args=(iq, oq), daemon=True)
-			t.start()
-			ts[t.name] = t
-
-		print('Starting output thread...')
-		ot = threading.Thread(target=output_worker, name='output_worker'.format(i), args=(oq, writer), daemon=True)
-		ot.start()
-
-		print('Enqueueing domains...')
-
-		for dc, d in enumerate(reader):
-			iq.put(d)
-			if (dc + 1) % args.verbosity == 0:
-				tt = datetime.datetime.now()
-				current_rate = float(args.verbosity) / (tt - tl).total_seconds()
-				average_rate = float(dc+1) / (tt - t0).total_seconds()
-				tl = tt
-				print('Enqueued {num_dom:>6} domains. Rate: {cur:9.2f} Hz. Average rate: {avg:9.2f} Hz.'.format(num_dom=dc+1, cur=current_rate, avg=average_rate))
-
-		# now enqueue a quit signal
-		iq.put(None)
-
-		# wait for queues to drain
-		iq.join()
-		ot.join()
+		resolve_records(progress(reader), out, args)
+		
+		out.save()
+	
+	if bogon_file is not None:
+		bogon_file.close()
+	if answers is not None:
+		answers.close()
 
 	t1 = datetime.datetime.now()
-	time = t1 - t0
-	average_rate = float(dc+1) / time.total_seconds()
+	runtime = t1 - t0
+	average_rate = float(dc) / runtime.total_seconds()
 	print('Resolution completed.')
-	print('Resolved {num_dom} domains. Total time: {time}. Average rate: {avg:.2f} domains per second.'.format(num_dom=dc+1, time=time, avg=average_rate))
+	print('Resolved {num_dom} domains. Total time: {time}. Average rate: {avg:.2f} domains per second.'.format(num_dom=dc, time=runtime, avg=average_rate))
+	report()
+	return 0
 
 if __name__ == '__main__':
 	sys.exit(main(sys.argv[1:]))
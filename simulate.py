@@ -0,0 +1,709 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Simulate: Run the scheduler of ``ecn_spider.py`` against a model of the network, on a virtual clock.
+
+Changes to the way ``ecn_spider.py`` schedules its work, such as the barriers between the master and the workers, ``--request-mode``, ``--prealloc-sockets`` or the size of the job queue, are hard to evaluate against the real Internet: a run takes hours, and no two runs see the same network. This script runs the unchanged :meth:`ecn_spider.fill`, :meth:`ecn_spider.master` and :meth:`ecn_spider.worker` against models instead:
+
+- The connects of :meth:`ecn_spider.setup_socket` and the requests of :meth:`ecn_spider.make_get` take the time a model of the web servers gives them, and succeed or fail as it says, see :class:`NetworkModel` and :class:`ReplayModel`.
+- Changing the kernel's ECN setting with :meth:`ecn_spider.set_ecn` only changes a variable, and takes ``--sysctl-time``. Connects see the setting at the time they start.
+- The semaphores, the job queue and the request threads of ``--request-mode immediate`` are replaced by versions that wait on the virtual clock.
+
+The threads of the simulation take turns: exactly one of them runs at a time, until it sleeps or blocks, and the clock then resumes the thread that is due next, advancing the virtual time as needed. Waiting costs no real time, and the order of all events only depends on the input and the seed, so running the same simulation twice gives the same output files. Code runs in zero virtual time, so the simulation shows where the scheduler waits, not where it burns CPU.
+
+The output and retry data files have the format of ``ecn_spider.py``'s, with times in seconds since the start of the simulation. At the end, the throughput, the distribution of the job durations and the connect results are printed. ``--profile`` and ``--trace`` record the phases of the threads in virtual time.
+
+The positional arguments and all options not listed by ``--help`` are those of ``ecn_spider.py``. ``--triage``, ``--capture``, ``--daemon`` and ``--metrics-port`` are not supported.
+
+This file is part of ECN-Spider.
+'''
+
+import sys
+import csv
+import time
+import heapq
+import queue
+import random
+import argparse
+import datetime
+import logging
+import itertools
+import threading
+import http.client
+import concurrent.futures
+from collections import deque, namedtuple
+
+import ecn_spider
+
+TIMED_OUT = 'socket.timeout'  #: Error of a connect that timed out, as returned by :meth:`ecn_spider.setup_socket`
+REFUSED = 'Connection refused'  #: Error of a connect that was answered with a RST
+EPHEMERAL_PORTS = (32768, 60999)  #: Local ports of the simulated connections without --port-range, --eoff-ports or --eon-ports
+
+#: Result of a connect and a request in a :class:`ReplayModel`.
+Outcome = namedtuple('Outcome', ['connect_err', 'connect_time', 'http_err', 'status', 'request_time'])
+
+
+class Clock:
+	'''
+	A virtual clock that runs a set of threads one at a time, in a deterministic order.
+	
+	A thread of the simulation runs until it calls :meth:`sleep` or :meth:`block`. The clock then resumes the thread that is due next, and advances the virtual time to the time it is due. Threads that are due at the same time are resumed in the order they became due.
+	'''
+	def __init__(self):
+		self.now = 0.0  #: Virtual time in seconds since the start of the simulation.
+		self.errors = []  #: Exceptions raised by the threads of the simulation.
+		self._due = []  # Heap of (due time, sequence number, lock the thread waits on)
+		self._seq = itertools.count()
+		self._local = threading.local()
+		self._finished = threading.Event()
+	
+	def spawn(self, target, name, *args):
+		'''
+		Add a thread to the simulation, which calls ``target(*args)`` once it is its turn.
+		
+		:param str name: Name of the thread.
+		'''
+		lock = threading.Lock()
+		lock.acquire()
+		
+		def run():
+			lock.acquire()
+			self._local.lock = lock
+			try:
+				target(*args)
+			except BaseException as e:
+				# The other threads are left suspended, so that the simulation ends here.
+				logging.getLogger('default').exception('Thread %s of the simulation failed.', name)
+				self.errors.append(e)
+				self._finished.set()
+			else:
+				self._resume_next()
+		
+		threading.Thread(target=run, name=name, daemon=True).start()
+		self._make_due(self.now, lock)
+	
+	def run(self):
+		'''
+		Run the simulation until no thread is due any more, because all threads have ended or the remaining ones are blocked for good, or until a thread raises an exception.
+		
+		:raises: The exception raised by a thread of the simulation.
+		'''
+		self._resume_next()
+		self._finished.wait()
+		if self.errors:
+			raise self.errors[0]
+	
+	def sleep(self, seconds):
+		'''
+		Suspend the calling thread for ``seconds`` of virtual time.
+		'''
+		lock = self._local.lock
+		self._make_due(self.now + max(seconds, 0.0), lock)
+		self._resume_next()
+		lock.acquire()
+	
+	def block(self, waiters):
+		'''
+		Suspend the calling thread until it is woken up by :meth:`wake`.
+		
+		:param list waiters: The list of threads waiting for the same condition.
+		'''
+		lock = self._local.lock
+		waiters.append(lock)
+		self._resume_next()
+		lock.acquire()
+	
+	def wake(self, waiters, n=None):
+		'''
+		Make threads suspended by :meth:`block` due now, in the order they were suspended.
+		
+		:param list waiters: The list of threads waiting for the condition.
+		:param int n: Number of threads to wake up. All, if None.
+		'''
+		if n is None or n >= len(waiters):
+			woken = list(waiters)
+			waiters.clear()
+		else:
+			woken = waiters[:n]
+			del waiters[:n]
+		for lock in woken:
+			self._make_due(self.now, lock)
+	
+	def _make_due(self, t, lock):
+		heapq.heappush(self._due, (t, next(self._seq), lock))
+	
+	def _resume_next(self):
+		if not self._due:
+			self._finished.set()
+			return
+		t, _, lock = heapq.heappop(self._due)
+		self.now = t
+		lock.release()
+
+
+class VirtualTime:
+	'''
+	A stand-in for the :mod:`time` module that reads the virtual clock.
+	'''
+	def __init__(self, clock):
+		self._clock = clock
+	
+	def time(self):
+		return self._clock.now
+	
+	def monotonic(self):
+		return self._clock.now
+	
+	def perf_counter(self):
+		return self._clock.now
+	
+	def perf_counter_ns(self):
+		return int(self._clock.now * 1e9)
+
+
+class SimSemaphore:
+	'''
+	A stand-in for :class:`ecn_spider.SemaphoreN` that waits on the virtual clock. It starts out empty.
+	'''
+	def __init__(self, clock):
+		self._clock = clock
+		self._value = 0
+		self._waiters = []
+	
+	def acquire(self, blocking=True, timeout=None):
+		if timeout is not None:
+			# Poll in small steps of virtual time, as a wait on the clock can not be cut short.
+			deadline = self._clock.now + timeout
+			while self._value == 0 and self._clock.now < deadline:
+				self._clock.sleep(min(0.01, deadline - self._clock.now))
+			blocking = False
+		if not blocking and self._value == 0:
+			return False
+		while self._value == 0:
+			self._clock.block(self._waiters)
+		self._value -= 1
+		return True
+	
+	def release(self):
+		self.release_n(1)
+	
+	def acquire_n(self, value=1):
+		for _ in range(value):
+			self.acquire()
+	
+	def release_n(self, value=1):
+		self._value += value
+		self._clock.wake(self._waiters, value)
+	
+	def empty(self):
+		self._value = 0
+
+
+class SimQueue:
+	'''
+	A stand-in for the job queue that waits on the virtual clock.
+	'''
+	def __init__(self, clock, maxsize=0):
+		'''
+		:param int maxsize: Maximum number of items in the queue. Unbounded, if 0.
+		'''
+		self._clock = clock
+		self.maxsize = maxsize
+		self._items = deque()
+		self._unfinished = 0
+		self._getters = []
+		self._putters = []
+		self._joiners = []
+	
+	def qsize(self):
+		return len(self._items)
+	
+	def put(self, item):
+		while self.maxsize > 0 and len(self._items) >= self.maxsize:
+			self._clock.block(self._putters)
+		self._items.append(item)
+		self._unfinished += 1
+		self._clock.wake(self._getters, 1)
+	
+	def get(self):
+		while not self._items:
+			self._clock.block(self._getters)
+		return self._pop()
+	
+	def get_nowait(self):
+		if not self._items:
+			raise queue.Empty
+		return self._pop()
+	
+	def _pop(self):
+		item = self._items.popleft()
+		self._clock.wake(self._putters, 1)
+		return item
+	
+	def task_done(self):
+		self._unfinished -= 1
+		if self._unfinished == 0:
+			self._clock.wake(self._joiners)
+	
+	def join(self):
+		while self._unfinished > 0:
+			self._clock.block(self._joiners)
+
+
+class SimExecutor:
+	'''
+	A stand-in for the thread pool making the requests of ``--request-mode immediate``, whose threads run on the virtual clock.
+	'''
+	def __init__(self, clock, workers):
+		'''
+		:param int workers: Number of threads.
+		'''
+		self._tasks = SimQueue(clock)
+		self._workers = workers
+		for i in range(workers):
+			clock.spawn(self._run, 'request_{}'.format(i))
+	
+	def _run(self):
+		while True:
+			task = self._tasks.get()
+			if task is None:
+				return
+			f, fn, args = task
+			try:
+				f.set_result(fn(*args))
+			except Exception as e:
+				f.set_exception(e)
+	
+	def submit(self, fn, *args):
+		f = concurrent.futures.Future()
+		self._tasks.put((f, fn, args))
+		return f
+	
+	def shutdown(self):
+		for _ in range(self._workers):
+			self._tasks.put(None)
+
+
+class SimConnection(http.client.HTTPConnection):
+	'''
+	A connection made in the simulation. It only has what :meth:`ecn_spider.worker` uses: the ``host``, and a ``sock`` with :meth:`getsockname`.
+	'''
+	class _Socket:
+		def __init__(self, port):
+			self._port = port
+		
+		def getsockname(self):
+			return ('0.0.0.0', self._port)
+	
+	def __init__(self, host, port, ecn):
+		'''
+		:param str host: The address connected to.
+		:param int port: The local port.
+		:param bool ecn: Whether the connection uses ECN.
+		'''
+		self.host = host
+		self.port = 80
+		self.sock = self._Socket(port)
+		self.ecn = ecn
+	
+	def close(self):
+		pass
+
+
+class NetworkModel:
+	'''
+	A synthetic model of the web servers under test.
+	
+	Every address has fixed properties, drawn from a random number generator seeded with the seed and the address, so that it behaves the same whenever it is tested: a base round-trip time and server response time, both log-normally distributed, and whether it is reachable, refuses connections, drops all SYNs (a black hole), or only drops SYNs that negotiate ECN.
+	
+	Single connections vary from the base times by ``jitter``, and their SYNs are lost with probability ``loss``. A lost SYN is sent again after 1, 2, 4, ... seconds, as Linux does, until the timeout is reached.
+	'''
+	def __init__(self, seed=0, rtt=0.08, spread=0.8, jitter=0.1, server_time=0.05, loss=0.01, refused=0.02, blackhole=0.05, ecn_blackhole=0.01):
+		'''
+		:param seed: Seed of the properties of the addresses.
+		:param float rtt: Median base round-trip time of the addresses in seconds.
+		:param float spread: Standard deviation of the logarithm of the base round-trip times and server response times.
+		:param float jitter: Standard deviation of the logarithm of the variation of single connections from the base times.
+		:param float server_time: Median base time the servers take to answer a request, in seconds.
+		:param float loss: Probability that a SYN is lost.
+		:param float refused, blackhole, ecn_blackhole: Shares of the addresses that refuse connections, drop all SYNs and drop SYNs negotiating ECN.
+		'''
+		self.seed = seed
+		self.rtt = rtt
+		self.spread = spread
+		self.jitter = jitter
+		self.server_time = server_time
+		self.loss = loss
+		self.refused = refused
+		self.blackhole = blackhole
+		self.ecn_blackhole = ecn_blackhole
+	
+	def target(self, ip):
+		'''
+		:returns: A tuple of the kind of the address ('ok', 'refused', 'blackhole' or 'ecn_blackhole'), its base round-trip time and its base server response time.
+		'''
+		r = random.Random('{}/{}'.format(self.seed, ip))
+		u = r.random()
+		if u < self.blackhole:
+			kind = 'blackhole'
+		elif u < self.blackhole + self.refused:
+			kind = 'refused'
+		elif u < self.blackhole + self.refused + self.ecn_blackhole:
+			kind = 'ecn_blackhole'
+		else:
+			kind = 'ok'
+		return (kind, self.rtt * r.lognormvariate(0, self.spread), self.server_time * r.lognormvariate(0, self.spread))
+	
+	def connect(self, ip, ecn, timeout, rng):
+		'''
+		Model a connect.
+		
+		:param str ip: The address connected to.
+		:param bool ecn: Whether the connect negotiates ECN.
+		:param timeout: The timeout of the connect in seconds.
+		:param random.Random rng: Source of randomness for the variation of single connections.
+		:returns: A tuple of the error or None, and the duration of the connect in seconds.
+		'''
+		kind, rtt, _ = self.target(ip)
+		if kind == 'blackhole' or (ecn and kind == 'ecn_blackhole'):
+			return (TIMED_OUT, timeout)
+		t = 0.0
+		rto = 1.0
+		while rng.random() < self.loss:
+			t += rto
+			rto *= 2
+			if t >= timeout:
+				return (TIMED_OUT, timeout)
+		t += rtt * rng.lognormvariate(0, self.jitter)
+		if t >= timeout:
+			return (TIMED_OUT, timeout)
+		return (REFUSED if kind == 'refused' else None, t)
+	
+	def request(self, ip, ecn, timeout, rng):
+		'''
+		Model a request on a connection made by :meth:`connect`.
+		
+		:returns: A tuple of the error or None, the HTTP status code or None, and the duration of the request in seconds.
+		'''
+		_, rtt, server_time = self.target(ip)
+		t = rtt * rng.lognormvariate(0, self.jitter) + server_time * rng.lognormvariate(0, self.jitter)
+		if t >= timeout:
+			return ('timed out', None, timeout)
+		return (None, 200, t)
+
+
+class ReplayModel:
+	'''
+	A model of the web servers under test that replays the output file of an earlier run of ``ecn_spider.py``.
+	
+	An address found in the file gets the results and durations it had there: those of the connection without ECN while ECN is off in the simulation, and those of the connection with ECN otherwise. Any other address gets the record of an address drawn from the file, so that a simulation with a new input sees the same mix of results. Connects and requests that took longer than the timeout of the simulation time out.
+	
+	The durations of the requests are read as written with ``--request-mode deferred``.
+	'''
+	def __init__(self, file_name, seed=0):
+		'''
+		:param str file_name: The output file of an earlier run.
+		:param seed: Seed of the selection of records for addresses that are not in the file.
+		:raises: ValueError if the file holds no usable record.
+		'''
+		self.seed = seed
+		self._by_ip = {}
+		self._records = []
+		with open(file_name, newline='') as f:
+			for row in csv.reader(f):
+				d = dict(zip(ecn_spider.OUTPUT_FIELDS, row))
+				try:
+					eoff = self._outcome(d, 'eoff')
+					eon = self._outcome(d, 'eon')
+				except (KeyError, ValueError):
+					continue
+				if eon.connect_err == 'no_attempt':
+					eon = eoff
+				record = {'eoff': eoff, 'eon': eon}
+				self._by_ip[d['ip']] = record
+				self._records.append(record)
+		if not self._records:
+			raise ValueError('{} holds no usable records.'.format(file_name))
+	
+	@staticmethod
+	def _outcome(d, note):
+		# With --request-mode deferred, the request with ECN is made first.
+		if note == 'eon':
+			request_time = float(d['inter_req_time']) - float(d['pre_req_time'])
+		else:
+			request_time = float(d['post_req_time']) - float(d['inter_req_time'])
+		return Outcome(
+			d[note + '_err'] or None,
+			float(d['post_conn_{}_time'.format(note)]) - float(d['pre_conn_{}_time'.format(note)]),
+			d['http_err_' + note] or None,
+			int(d['status_' + note]) if d['status_' + note] else None,
+			max(request_time, 0.0))
+	
+	def _record(self, ip):
+		record = self._by_ip.get(ip)
+		if record is None:
+			record = self._records[random.Random('{}/{}'.format(self.seed, ip)).randrange(len(self._records))]
+		return record
+	
+	def connect(self, ip, ecn, timeout, rng):
+		'''
+		Replay a connect, see :meth:`NetworkModel.connect`.
+		'''
+		o = self._record(ip)['eon' if ecn else 'eoff']
+		if o.connect_err == TIMED_OUT or o.connect_time >= timeout:
+			return (TIMED_OUT, timeout)
+		return (o.connect_err, o.connect_time)
+	
+	def request(self, ip, ecn, timeout, rng):
+		'''
+		Replay a request, see :meth:`NetworkModel.request`.
+		'''
+		o = self._record(ip)['eon' if ecn else 'eoff']
+		if o.http_err == 'no_attempt':
+			# The connection was made in the simulation, but not in the replayed run.
+			return (None, 200, o.connect_time)
+		if o.request_time >= timeout:
+			return ('timed out', None, timeout)
+		return (o.http_err, o.status, o.request_time)
+
+
+class Simulation:
+	'''
+	The models that replace the network and the ECN setting of the kernel in :mod:`ecn_spider`, see :meth:`install`.
+	'''
+	def __init__(self, clock, model, seed=0, sysctl_time=0.005):
+		'''
+		:param Clock clock: The virtual clock.
+		:param model: The model of the web servers, a :class:`NetworkModel` or a :class:`ReplayModel`.
+		:param seed: Seed of the variation of single connections.
+		:param float sysctl_time: Time a change of the ECN setting takes, in seconds.
+		'''
+		self.clock = clock
+		self.model = model
+		self.rng = random.Random(seed)
+		self.sysctl_time = sysctl_time
+		self.ecn = ecn_spider.ECN_STATE['on_demand']
+		self.flips = 0  #: Number of changes of the ECN setting
+		self.wrong_mode = 0  #: Number of connects of the paired test that started while ECN was set for the other mode
+		self.end = None  #: Virtual time at which the last job was done
+		self._ports = {}
+	
+	def install(self):
+		'''
+		Replace the clock, the connects, the requests and the ECN setting of :mod:`ecn_spider` with the models.
+		'''
+		ecn_spider.time = VirtualTime(self.clock)
+		ecn_spider.sleep = self.clock.sleep
+		ecn_spider.set_ecn = self.set_ecn
+		ecn_spider.prepare_socket = self.prepare_socket
+		ecn_spider.discard_socket = self.discard_socket
+		ecn_spider.setup_socket = self.setup_socket
+		ecn_spider.make_get = self.make_get
+	
+	def set_ecn(self, value):
+		self.clock.sleep(self.sysctl_time)
+		self.ecn = ecn_spider.ECN_STATE.get(value, value)
+		self.flips += 1
+	
+	def _port(self, mode):
+		args = ecn_spider.ARGS
+		ports = (getattr(args, mode + '_ports') if mode is not None else None) or args.port_range or EPHEMERAL_PORTS
+		cycle = self._ports.get(ports)
+		if cycle is None:
+			cycle = self._ports[ports] = itertools.cycle(range(ports[0], ports[1] + 1))
+		return next(cycle)
+	
+	def prepare_socket(self, ip, timeout, mode=None):
+		return (None, None)
+	
+	def discard_socket(self, prepared):
+		pass
+	
+	def setup_socket(self, ip, timeout, prepared=None, mode=None):
+		ecn = self.ecn == ecn_spider.ECN_STATE['always']
+		if mode is not None and ecn != (mode == 'eon'):
+			self.wrong_mode += 1
+		err, seconds = self.model.connect(ip, ecn, timeout, self.rng)
+		self.clock.sleep(seconds)
+		if err is not None:
+			return (err, None)
+		return (None, SimConnection(ip, self._port(mode), ecn))
+	
+	def make_get(self, client, domain, note):
+		err, status, seconds = self.model.request(client.host, client.ecn, ecn_spider.ARGS.timeout, self.rng)
+		self.clock.sleep(seconds)
+		ecn_spider.M_REQ_TIME.observe(seconds, (note, ))
+		ecn_spider.M_HTTP_ERRORS.inc(labels=(note, ecn_spider.E['success'] if err is None else err))
+		return {'http_err_' + note: err, 'status_' + note: status, 'headers_' + note: None}
+	
+	def filler(self, records, queue_, sink):
+		'''
+		Fill the job queue, wait for the jobs to be done, and end the run, like :meth:`ecn_spider.main`.
+		'''
+		ecn_spider.fill(records, queue_, sink)
+		queue_.join()
+		self.end = self.clock.now
+		ecn_spider.RUN = False
+		if ecn_spider.REQUEST_POOL is not None:
+			ecn_spider.REQUEST_POOL.shutdown()
+
+
+class Summary:
+	'''
+	Statistics of the output records of a simulation.
+	'''
+	def __init__(self):
+		self.durations = []  #: Time from the first connect of every job to its output record
+		self.results = {}  #: Number of jobs by the pair of connect results (ECN off, ECN on), each 'ok' or 'failed'
+	
+	def add(self, row):
+		d = dict(zip(ecn_spider.OUTPUT_FIELDS, row))
+		self.durations.append(d['record_time'] - d['pre_conn_eoff_time'])
+		key = ('ok' if d['eoff_err'] is None else 'failed', 'ok' if d['eon_err'] is None else 'failed')
+		self.results[key] = self.results.get(key, 0) + 1
+	
+	def percentile(self, p):
+		'''
+		:returns: The ``p``-th percentile of the job durations, or 0 if there are none.
+		'''
+		if not self.durations:
+			return 0.0
+		s = sorted(self.durations)
+		return s[int((len(s) - 1) * p / 100)]
+
+
+def synthetic_records(n):
+	'''
+	A generator of ``n`` input records with distinct addresses from 10.0.0.0/8.
+	'''
+	for i in range(n):
+		yield ecn_spider.Record(str(i + 1), 'sim{}.example'.format(i + 1), '10.{}.{}.{}'.format(i >> 16 & 255, i >> 8 & 255, i & 255), '')
+
+
+def arguments(argv):
+	'''
+	Parse the command-line arguments.
+	
+	:param argv: The command line.
+	:returns: A tuple of the simulation options, and the spider options as returned by :meth:`ecn_spider.arguments`.
+	'''
+	parser = argparse.ArgumentParser(description='Simulate: Run the scheduler of ecn_spider.py against a model of the network, on a virtual clock. All further arguments are passed to ecn_spider.py.', epilog='This program is part of ECN-Spider.')
+	
+	parser.add_argument('--seed', type=int, default='0', help='Seed of the network model. Simulations with the same seed, input and options produce the same output.')
+	parser.add_argument('--jobs', type=int, default='0', help='If set, simulate N synthetic domains with addresses from 10.0.0.0/8 instead of reading the input file, which is ignored.')
+	parser.add_argument('--replay', type=str, default=None, help='Output file of an earlier run of ecn_spider.py. If set, the addresses behave as they did in that run, see ReplayModel, and the options of the synthetic model are ignored.')
+	parser.add_argument('--rtt', type=float, default='80', help='Median round-trip time of the addresses in milliseconds.')
+	parser.add_argument('--spread', type=float, default='0.8', help='Spread of the round-trip times and server response times of the addresses, as the standard deviation of their logarithm.')
+	parser.add_argument('--jitter', type=float, default='0.1', help='Variation of single connections from the round-trip time and server response time of their address, as the standard deviation of its logarithm.')
+	parser.add_argument('--server-time', type=float, default='50', dest='server_time', help='Median time the servers take to answer a request, in milliseconds.')
+	parser.add_argument('--loss', type=float, default='0.01', help='Probability that a SYN is lost. Lost SYNs are sent again after 1, 2, 4, ... seconds.')
+	parser.add_argument('--refused', type=float, default='0.02', help='Share of the addresses that refuse connections.')
+	parser.add_argument('--blackhole', type=float, default='0.05', help='Share of the addresses that drop all SYNs.')
+	parser.add_argument('--ecn-blackhole', type=float, default='0.01', dest='ecn_blackhole', help='Share of the addresses that drop SYNs negotiating ECN.')
+	parser.add_argument('--sysctl-time', type=float, default='5', dest='sysctl_time', help='Time a change of the ECN setting takes, in milliseconds.')
+	
+	args, rest = parser.parse_known_args(argv)
+	
+	if args.jobs < 0 or args.jobs > 1 << 24:
+		raise ValueError('Jobs must be an integer between 0 and 2^24, it was set to {}.'.format(args.jobs))
+	for option in ('rtt', 'server_time'):
+		if getattr(args, option) <= 0:
+			raise ValueError('{} must be a positive float, it was set to {}.'.format(option.replace('_', '-').capitalize(), getattr(args, option)))
+	for option in ('spread', 'jitter', 'sysctl_time'):
+		if getattr(args, option) < 0:
+			raise ValueError('{} must be a non-negative float, it was set to {}.'.format(option.replace('_', '-').capitalize(), getattr(args, option)))
+	for option in ('loss', 'refused', 'blackhole', 'ecn_blackhole'):
+		if not 0 <= getattr(args, option) <= 1:
+			raise ValueError('{} must be between 0 and 1, it was set to {}.'.format(option.replace('_', '-').capitalize(), getattr(args, option)))
+	if args.refused + args.blackhole + args.ecn_blackhole > 1:
+		raise ValueError('Refused, blackhole and ecn-blackhole must not add up to more than 1.')
+	
+	# No tcpdump is needed, as no packet is sent.
+	spider_args = ecn_spider.arguments(rest + ['--no-tcpdump-check'])
+	for option in ('triage', 'capture', 'daemon'):
+		if getattr(spider_args, option) not in (None, False):
+			raise ValueError('The option --{} is not supported by the simulation.'.format(option))
+	if spider_args.metrics_port != 0:
+		raise ValueError('The option --metrics-port is not supported by the simulation.')
+	if args.jobs > 0:
+		# The synthetic addresses are private.
+		spider_args.bogons = 'keep'
+	
+	return args, spider_args
+
+
+def main(argv):
+	'''
+	Method to be called when run from the command line.
+	'''
+	args, spider_args = arguments(argv)
+	
+	if args.replay is not None:
+		model = ReplayModel(args.replay, args.seed)
+	else:
+		model = NetworkModel(args.seed, args.rtt / 1000, args.spread, args.jitter, args.server_time / 1000, args.loss, args.refused, args.blackhole, args.ecn_blackhole)
+	
+	clock = Clock()
+	sim = Simulation(clock, model, args.seed, args.sysctl_time / 1000)
+	sim.install()
+	
+	logger = ecn_spider.set_up(spider_args)
+	
+	q = SimQueue(clock, ecn_spider.Q_SIZE)
+	ecn_on, ecn_on_rdy, ecn_off, ecn_off_rdy = (SimSemaphore(clock) for _ in range(4))
+	ecn_spider.RUN = True
+	
+	if spider_args.request_mode == 'immediate':
+		ecn_spider.REQUEST_POOL = SimExecutor(clock, spider_args.request_workers or 4 * spider_args.workers)
+		ecn_spider.REQUEST_SLOTS = SimSemaphore(clock)
+		ecn_spider.REQUEST_SLOTS.release_n(ecn_spider.request_slots(spider_args))
+	
+	inf = None
+	if args.jobs > 0:
+		records = synthetic_records(args.jobs)
+	else:
+		inf = open(spider_args.input)
+		records = ecn_spider.domain_reader(spider_args.debug_count, inf)
+	
+	summary = Summary()
+	clock.spawn(sim.filler, 'filler', records, q, summary.add)
+	clock.spawn(ecn_spider.master, 'master', spider_args.workers, ecn_on, ecn_on_rdy, ecn_off, ecn_off_rdy)
+	for i in range(spider_args.workers):
+		clock.spawn(ecn_spider.worker, 'worker_{}'.format(i), q, spider_args.timeout, ecn_on, ecn_on_rdy, ecn_off, ecn_off_rdy)
+	
+	logger.info('Simulation started.')
+	wall = time.perf_counter()
+	try:
+		clock.run()
+	except Exception:
+		ecn_spider.stop_logging()
+		raise
+	wall = time.perf_counter() - wall
+	
+	if inf is not None:
+		inf.close()
+	
+	end = sim.end if sim.end is not None else clock.now
+	logger.info('All done.')
+	if ecn_spider.TRACER.enabled:
+		ecn_spider.log_phase_summary(ecn_spider.TRACER, datetime.timedelta(seconds=end))
+	if spider_args.trace is not None:
+		ecn_spider.TRACER.write_chrome_trace(spider_args.trace)
+		logger.info('Wrote phase trace to %s.', spider_args.trace)
+	ecn_spider.stop_logging()
+	
+	jobs = len(summary.durations)
+	rounds = sim.flips // 2
+	print('Simulated {jobs} jobs in {end:.1f} s of virtual time ({rate:.2f} jobs/s), which took {wall:.1f} s ({speedup:.0f} times faster than real time).'.format(jobs=jobs, end=end, rate=jobs / end if end > 0 else 0.0, wall=wall, speedup=end / wall if wall > 0 else 0.0))
+	print('ECN setting changed {flips} times, {rounds} rounds of {round_ms:.1f} ms on average.'.format(flips=sim.flips, rounds=rounds, round_ms=1000 * end / rounds if rounds > 0 else 0.0))
+	print('Job duration from the first connect to the output record [s]: p50 {:.3f}, p90 {:.3f}, p99 {:.3f}, p99.9 {:.3f}, max {:.3f}.'.format(*(summary.percentile(p) for p in (50, 90, 99, 99.9, 100))))
+	print('Connect results: both succeeded {}, only without ECN {}, only with ECN {}, both failed {}.'.format(*(summary.results.get(k, 0) for k in (('ok', 'ok'), ('ok', 'failed'), ('failed', 'ok'), ('failed', 'failed')))))
+	print('Connects of the paired test made with the ECN setting of the other mode: {}.'.format(sim.wrong_mode))
+	print('Scheduled {} retries.'.format(ecn_spider.retry_count.value))
+	
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
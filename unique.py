@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Unique: Make the IPv4 and IPv6 addresses of a list of resolved domains unique.
+
+The input is read and written as a stream of records in the format "rank,domain,ipv4,ipv6", which is both the output format of ``resolution.py`` and the input format of ``ecn_spider.py``. An address that was already seen in an earlier record is removed from the record. A record is dropped entirely, if all its addresses were removed. For every removed address, a record "rank,domain,ip,kept_rank" can be written to a side file, so that the statistics can still be weighted by domain after the test.
+
+Seen addresses are kept as packed integers in a set. Alternatively, a Bloom filter of bounded size can be used. With a Bloom filter, a small fraction of unique addresses will be dropped as false positives, and the rank of the record that kept an address is not known.
+
+This file is part of ECN-Spider.
+'''
+
+import sys
+import csv
+import socket
+import hashlib
+import logging
+import argparse
+from math import ceil, log
+
+_V6_TAG = 1 << 128  #: Added to packed IPv6 addresses, so that they can never collide with IPv4 addresses.
+
+
+def pack(ip):
+	'''
+	Convert an IP address to an integer.
+	
+	:param str ip: An IPv4 or IPv6 address. IPv6 addresses may be enclosed in square brackets, as used for the jobs of ``ecn_spider.py``.
+	:returns: An integer unique to the address, IPv6 addresses are tagged to be distinct from all IPv4 addresses.
+	:raises: ValueError if ``ip`` is not a valid address.
+	'''
+	if ip[:1] == '[':
+		ip = ip[1:-1]
+	try:
+		if ':' in ip:
+			return int.from_bytes(socket.inet_pton(socket.AF_INET6, ip), 'big') | _V6_TAG
+		return int.from_bytes(socket.inet_pton(socket.AF_INET, ip), 'big')
+	except OSError:
+		raise ValueError('Not a valid IP address: {}.'.format(ip))
+
+
+class IPSet():
+	'''
+	An exact set of IP addresses, stored as packed integers. For every address, the rank of the record that added it is kept.
+	'''
+	def __init__(self):
+		self._d = {}
+	
+	def add(self, ip, rank=''):
+		'''
+		Add an address to the set, if it is not in the set yet.
+		
+		:param str ip: The address.
+		:param rank: The rank of the record the address belongs to.
+		:returns: None if the address was added, otherwise the rank of the record that added it first.
+		'''
+		key = pack(ip)
+		kept = self._d.get(key)
+		if kept is None:
+			self._d[key] = rank
+		return kept
+	
+	def __contains__(self, ip):
+		return pack(ip) in self._d
+	
+	def __len__(self):
+		return len(self._d)
+
+
+class BloomFilter():
+	'''
+	A set of IP addresses with a bounded memory footprint, and a configurable rate of false positives.
+	'''
+	def __init__(self, capacity, error_rate=0.001):
+		'''
+		:param int capacity: Number of addresses that can be added before the false positive rate exceeds ``error_rate``.
+		:param float error_rate: False positive rate.
+		'''
+		if capacity <= 0:
+			raise ValueError('Capacity must be a positive integer, it was set to {}.'.format(capacity))
+		if not 0 < error_rate < 1:
+			raise ValueError('Error rate must be between 0 and 1, it was set to {}.'.format(error_rate))
+		self._m = int(ceil(-capacity * log(error_rate) / (log(2) ** 2)))  # Number of bits
+		self._k = max(1, int(round(self._m / capacity * log(2))))  # Number of hash functions
+		self._bits = bytearray((self._m + 7) // 8)
+		self._n = 0
+	
+	def _indexes(self, key):
+		# Double hashing: the k indexes are derived from two 64 bit halves of one digest.
+		h = hashlib.blake2b(key.to_bytes(17, 'big'), digest_size=16).digest()
+		h1 = int.from_bytes(h[:8], 'big')
+		h2 = int.from_bytes(h[8:], 'big') | 1
+		m = self._m
+		return [(h1 + i * h2) % m for i in range(self._k)]
+	
+	def add(self, ip, rank=''):
+		'''
+		Add an address to the filter, if it is not in the filter yet.
+		
+		:param str ip: The address.
+		:param rank: Ignored, the Bloom filter does not keep the rank of the record that added an address.
+		:returns: None if the address was added, otherwise an empty string.
+		'''
+		bits = self._bits
+		new = False
+		for i in self._indexes(pack(ip)):
+			byte = i >> 3
+			mask = 1 << (i & 7)
+			if not bits[byte] & mask:
+				bits[byte] |= mask
+				new = True
+		if new:
+			self._n += 1
+			return None
+		return ''
+	
+	def __contains__(self, ip):
+		bits = self._bits
+		return all(bits[i >> 3] & (1 << (i & 7)) for i in self._indexes(pack(ip)))
+	
+	def __len__(self):
+		return self._n
+
+
+def _add(seen, ip, rank):
+	try:
+		return seen.add(ip, rank)
+	except ValueError:
+		# Malformed addresses can not be compared, they are passed on unchanged.
+		return None
+
+
+def unique_records(records, seen, dropped=None):
+	'''
+	A generator that removes already seen addresses from a stream of records.
+	
+	:param records: An iterable of records in the format [rank, domain, ipv4, ipv6].
+	:param seen: An instance of :class:`IPSet` or :class:`BloomFilter`. It is updated with the addresses of the records.
+	:param dropped: If not None, a function that is called with [rank, domain, ip, kept_rank] for every removed address.
+	:returns: One record with only unique addresses on each call to :meth:`next()`. Records of which all addresses were removed are skipped, as are empty records, and records with fewer than four fields, which are logged as a warning.
+	'''
+	logger = logging.getLogger('default')
+	for row in records:
+		if len(row) < 4:
+			if any(f.strip() for f in row):
+				logger.warning('Skipping malformed record: %s', ','.join(row))
+			continue
+		rank, domain, ipv4, ipv6 = row[0], row[1], row[2], row[3]
+		had_ip = ipv4 != '' or ipv6 != ''
+		if ipv4 != '':
+			kept = _add(seen, ipv4, rank)
+			if kept is not None:
+				if dropped is not None:
+					dropped([rank, domain, ipv4, kept])
+				ipv4 = ''
+		if ipv6 != '':
+			kept = _add(seen, ipv6, rank)
+			if kept is not None:
+				if dropped is not None:
+					dropped([rank, domain, ipv6, kept])
+				ipv6 = ''
+		if had_ip and ipv4 == '' and ipv6 == '':
+			continue
+		yield [rank, domain, ipv4, ipv6]
+
+
+def arguments(argv):
+	'''
+	Parse the command-line arguments.
+	
+	:param argv: The command line.
+	:returns: The return value of ``argparse.ArgumentParser.parse_args``.
+	'''
+	parser = argparse.ArgumentParser(description='Unique: Make the IP addresses in a list of resolved domains unique.', epilog='This program is part of ECN-Spider.')
+	
+	parser.add_argument('input_file', type=str, help='CSV format input data file, as written by resolution.py. Each record has the format: "rank,domain,IPv4,IPv6".')
+	parser.add_argument('output_file', type=str, help='CSV format output data file in the same format, with every IP address appearing at most once.')
+	
+	parser.add_argument('--dropped', type=str, default=None, help='CSV format output data file. For every removed address, a record "rank,domain,ip,kept_rank" is written, where "kept_rank" is the rank of the record that kept the address. "kept_rank" is empty when --bloom is used.')
+	parser.add_argument('--bloom', type=int, default='0', help='If set, use a Bloom filter sized for N unique addresses instead of an exact set. This bounds memory usage, at the price of dropping a small fraction of unique addresses.')
+	parser.add_argument('--error-rate', type=float, default='0.001', dest='error_rate', help='False positive rate of the Bloom filter.')
+	
+	args = parser.parse_args(argv)
+	
+	if args.bloom < 0:
+		raise ValueError('Bloom must be a non-negative integer, it was set to {}.'.format(args.bloom))
+	if not 0 < args.error_rate < 1:
+		raise ValueError('Error-rate must be between 0 and 1, it was set to {}.'.format(args.error_rate))
+	
+	return args
+
+
+def main(argv):
+	'''
+	Method to be called when run from the command line.
+	'''
+	args = arguments(argv)
+	
+	if args.bloom > 0:
+		seen = BloomFilter(args.bloom, args.error_rate)
+	else:
+		seen = IPSet()
+	
+	c_in = 0
+	c_out = 0
+	c_dropped = 0
+	
+	with open(args.input_file) as inf, open(args.output_file, 'w', newline='') as ouf:
+		dropped_file = None
+		dropped = None
+		if args.dropped is not None:
+			dropped_file = open(args.dropped, 'w', newline='')
+			dropped = csv.writer(dropped_file).writerow
+		
+		def counting_reader():
+			nonlocal c_in
+			for row in csv.reader(inf):
+				c_in += 1
+				yield row
+		
+		def counting_dropped(row):
+			nonlocal c_dropped
+			c_dropped += 1
+			if dropped is not None:
+				dropped(row)
+		
+		writer = csv.writer(ouf)
+		try:
+			for row in unique_records(counting_reader(), seen, counting_dropped):
+				writer.writerow(row)
+				c_out += 1
+		finally:
+			if dropped_file is not None:
+				dropped_file.close()
+	
+	print('Read {} records, wrote {} records. Removed {} duplicate addresses, kept {} unique addresses.'.format(c_in, c_out, c_dropped, len(seen)))
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))